@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+'''Startup-time regression benchmark for the command-line program.
+
+Runs "python -X importtime -c 'import rganalysis.main'" several times
+and reports the best total import time. Fails (with exit status 1) if
+any module that should only be imported on demand shows up at
+startup, or if the best time exceeds the budget given with
+--budget-ms.
+
+Usage: python benchmarks/importtime.py [--runs N] [--budget-ms MS]
+
+'''
+
+from typing import Dict, List, Tuple
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+# Modules that must not be imported just to start the program. They
+# are all needed eventually, but only once there is work to do.
+LAZY_MODULES = (
+    'mutagen',
+    'multiprocessing',
+    'sqlite3',
+    'parse',
+    'lxml',
+    'audiotools',
+    'tkinter',
+    'numpy',
+)
+
+line_re = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$')
+
+def import_times(module: str) -> Dict[str, Tuple[int, int]]:
+    '''Return {module: (self_us, cumulative_us)} for importing module.'''
+    env = dict(os.environ)
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [repo, env.get('PYTHONPATH')]))
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                       stderr=subprocess.PIPE, env=env, universal_newlines=True, check=True)
+    times = {}
+    for line in p.stderr.splitlines():
+        m = line_re.match(line)
+        if m:
+            times[m.group(4)] = (int(m.group(1)), int(m.group(2)))
+    return times
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=None)
+    parser.add_argument('--module', default='rganalysis.main')
+    args = parser.parse_args()
+
+    totals = []                 # type: List[int]
+    for _ in range(args.runs):
+        times = import_times(args.module)
+        totals.append(times[args.module][1])
+    best_ms = min(totals) / 1000
+    print("import {}: best {:.1f} ms over {} runs".format(args.module, best_ms, args.runs))
+    slowest = sorted(times.items(), key=lambda kv: kv[1][0], reverse=True)[:10]
+    for (name, (self_us, cumulative_us)) in slowest:
+        print("  {:>8.1f} ms  {}".format(self_us / 1000, name))
+
+    failed = False
+    eager = sorted(name for name in times if name.split('.')[0] in LAZY_MODULES)
+    if eager:
+        print("FAIL: modules imported at startup: {}".format(", ".join(eager)))
+        failed = True
+    if args.budget_ms is not None and best_ms > args.budget_ms:
+        print("FAIL: import time {:.1f} ms exceeds budget of {:.1f} ms".format(best_ms, args.budget_ms))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+'''Benchmark of reading albums in walk order and in on-disk order.
+
+Writes albums of noise as WAV files in a shuffled order, so that
+their position on disk does not follow the order in which they are
+found, then reads them with a WorkerPool once with each io_order,
+evicting the files from the page cache before each run, and reports
+the time taken and the read rate. The workers only read the files,
+so that the time is that of the I/O rather than of the analysis.
+The difference is only meaningful on a spinning disk, so --dir should
+be a directory on one; on an SSD, both orders should take about as
+long.
+
+Usage: python benchmarks/io_order.py [--dir DIR] [--albums N] [--tracks N] [--seconds S] [--jobs N]
+
+'''
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import wave
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from mutagen.id3 import TALB
+from mutagen.wave import WAVE
+
+from rganalysis import RGTrackSet
+from rganalysis.api import find_track_sets, make_gain_backend
+from rganalysis.engine import WorkerPool
+from rganalysis.results import SKIPPED, AlbumResult
+
+READ_SIZE = 1 << 20
+
+class ReadHandler(object):
+    '''Reads every file of a track set, and reports it as skipped.'''
+    def __call__(self, track_set: RGTrackSet) -> AlbumResult:
+        for fname in track_set.filenames:
+            with open(fname, 'rb') as f:
+                while f.read(READ_SIZE):
+                    pass
+        return track_set.result(SKIPPED)
+
+def write_albums(root: str, albums: int, tracks: int, seconds: float) -> int:
+    '''Write the albums in a random order, and return their total size in bytes.'''
+    rng = np.random.default_rng(0)
+    block = (0.1 * rng.standard_normal((int(seconds * 44100), 2)) * 32767).astype('<i2').tobytes()
+    fnames = [ os.path.join(root, '{:03d}'.format(a), '{:02d}.wav'.format(t + 1))
+               for a in range(albums) for t in range(tracks) ]
+    random.Random(0).shuffle(fnames)
+    for fname in fnames:
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        with wave.open(fname, 'wb') as w:
+            w.setnchannels(2)
+            w.setsampwidth(2)
+            w.setframerate(44100)
+            w.writeframes(block)
+        # Untagged WAV files are not recognized as music
+        track = WAVE(fname)
+        track.add_tags()
+        track.tags.add(TALB(encoding=3, text=[os.path.basename(os.path.dirname(fname))]))
+        track.save()
+        with open(fname, 'rb') as f:
+            os.fsync(f.fileno())
+    return sum(os.path.getsize(f) for f in fnames)
+
+def evict(root: str) -> None:
+    for (dirpath, _, fnames) in os.walk(root):
+        for fname in fnames:
+            fd = os.open(os.path.join(dirpath, fname), os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dir', help="directory in which to write the albums (default: a temporary directory)")
+    parser.add_argument('--albums', type=int, default=40)
+    parser.add_argument('--tracks', type=int, default=10, help="tracks per album")
+    parser.add_argument('--seconds', type=float, default=30.0, help="seconds of audio per track")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    backend = make_gain_backend('native')
+    with tempfile.TemporaryDirectory(dir=args.dir) as root:
+        size = write_albums(root, args.albums, args.tracks, args.seconds)
+        print("Wrote {} albums, {:.0f} MB".format(args.albums, size / 1e6))
+        for io_order in ('walk', 'locality'):
+            track_sets = list(find_track_sets([root], backend, dry_run=True))
+            evict(root)
+            start = time.perf_counter()
+            with WorkerPool(args.jobs, io_order=io_order) as pool:
+                results = list(pool.run(track_sets, ReadHandler()))
+            elapsed = time.perf_counter() - start
+            if len(results) != args.albums:
+                sys.exit("Failed to read every album with io_order={}".format(io_order))
+            print("{:>8}: {:6.2f} s  {:6.1f} MB/s".format(io_order, elapsed, size / 1e6 / elapsed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+'''Throughput benchmark for the pipe backend with concurrent decoders.
+
+Analyzes an album of synthetic tracks with the pipe backend (see
+rganalysis.backends.pipe), using benchmarks/synthetic_decoder.py as
+the decoder, once with each number of concurrent decoders given by
+--jobs, read by threads of the analyzing process, and once with each
+number of decoder processes given by --decode-jobs, which pass the
+audio to the analyzing process through shared memory (see
+rganalysis.transport). Reports the time taken and the speed in
+multiples of realtime. The gain values must be the same every time.
+
+Usage: python benchmarks/pipe_backend.py [--tracks N] [--seconds S] [--jobs 1,2,4]
+           [--decode-jobs 1,2,4]
+
+'''
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import wave
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=12)
+    parser.add_argument('--seconds', type=float, default=180.0, help="seconds of audio per track")
+    parser.add_argument('--jobs', default='1,2,4', help="comma-separated numbers of concurrent decoders")
+    parser.add_argument('--decode-jobs', default='1,2,4', help="comma-separated numbers of decoder processes")
+    args = parser.parse_args()
+
+    decoder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'synthetic_decoder.py')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # The tracks only need to be files that mutagen can read the
+        # sample rate and channels of; the decoder makes up the audio
+        fnames = []
+        for i in range(args.tracks):
+            fname = os.path.join(tmpdir, '{:02d}.wav'.format(i + 1))
+            with wave.open(fname, 'wb') as w:
+                w.setnchannels(2)
+                w.setsampwidth(2)
+                w.setframerate(44100)
+                w.writeframes(b'\0' * 4)
+            fnames.append(fname)
+        config = os.path.join(tmpdir, 'decoders.json')
+        with open(config, 'w') as f:
+            json.dump({'.wav': {'command': [sys.executable, decoder, '--seconds', str(args.seconds),
+                                            '--rate', '{rate}', '--channels', '{channels}', '{file}'],
+                                'format': 's16le'}}, f)
+        # Without an installed decoder, the backend is only usable
+        # once it is configured
+        os.environ['RGANALYSIS_DECODERS'] = config
+        from rganalysis.backends.pipe import PipeGainComputer, load_decoders
+        decoders = load_decoders(config)
+        reference = None
+        audio_seconds = args.tracks * args.seconds
+        configs = [ ('{:>3} decoders, threads'.format(j), PipeGainComputer(decoders, jobs=int(j)))
+                    for j in args.jobs.split(',') if j ]
+        configs += [ ('{:>3} decoder processes'.format(j), PipeGainComputer(decoders, decode_jobs=int(j)))
+                     for j in args.decode_jobs.split(',') if j ]
+        for (name, backend) in configs:
+            start = time.perf_counter()
+            rginfo = backend.compute_gain(fnames)
+            elapsed = time.perf_counter() - start
+            if reference is None:
+                reference = (name, rginfo)
+            elif rginfo != reference[1]:
+                sys.exit("Results with {} differ from those with {}".format(name.strip(), reference[0].strip()))
+            print("{:<24}: {:6.2f} s  {:6.0f}x realtime".format(name, elapsed, audio_seconds / elapsed))
+
+if __name__ == '__main__':
+    main()
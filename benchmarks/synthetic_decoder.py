@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+'''Stand-in decoder that writes synthetic raw PCM to standard output.
+
+Emits a tone with some noise, as if it were the decoded audio of
+FILE, for testing and benchmarking the pipe backend (see
+rganalysis.backends.pipe) without real decoders or music files. The
+level of the tone depends on the file name, so different files get
+different gains, and the output is the same on every run. Use it as
+a decoder in a $RGANALYSIS_DECODERS file, e.g.:
+
+    {"*": {"command": ["python", "benchmarks/synthetic_decoder.py",
+                       "--rate", "{rate}", "--channels", "{channels}", "{file}"],
+           "format": "s16le"}}
+
+Usage: python benchmarks/synthetic_decoder.py [--seconds S] [--rate HZ]
+           [--channels N] [--format s16le|f32le] FILE
+
+'''
+
+import argparse
+import sys
+import zlib
+
+import numpy as np
+
+CHUNK_FRAMES = 1 << 16
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=60.0)
+    parser.add_argument('--rate', type=int, default=44100)
+    parser.add_argument('--channels', type=int, default=2)
+    parser.add_argument('--format', choices=('s16le', 'f32le'), default='s16le')
+    parser.add_argument('file')
+    args = parser.parse_args()
+
+    seed = zlib.crc32(args.file.encode())
+    rng = np.random.default_rng(seed)
+    level = 0.05 + 0.9 * (seed % 1000) / 1000
+    frames = int(args.seconds * args.rate)
+    out = sys.stdout.buffer
+    for start in range(0, frames, CHUNK_FRAMES):
+        t = np.arange(start, min(frames, start + CHUNK_FRAMES)) / args.rate
+        tone = level * np.sin(2 * np.pi * 440 * t)
+        x = tone[:, None] + 0.01 * rng.standard_normal((len(t), args.channels))
+        if args.format == 's16le':
+            out.write((np.clip(x, -1, 1) * 32767).astype('<i2').tobytes())
+        else:
+            out.write(x.astype('<f4').tobytes())
+    out.flush()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+'''Microbenchmark of the tag checks on very large track sets.
+
+Builds a track set of --tracks tracks with in-memory tags in the
+format written by rganalysis ("-6.54 dB"), without any files, and
+times the checks that a run makes on every track set before and after
+analysis: has_valid_rgdata, has_true_peak_data, result and
+want_album_gain. Each is timed "cold", with the parsed tag values
+forgotten before every call (as if nothing were cached), and "warm",
+reusing them. Also times parse_gain on its own.
+
+Usage: python benchmarks/track_set_checks.py [--tracks N] [--repeat N]
+
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rganalysis import RGTrack, RGTrackSet
+from rganalysis.backends import NullGainComputer
+from rganalysis.common import format_gain, format_peak, parse_gain
+from rganalysis.results import SKIPPED
+
+class FakeInfo(object):
+    length = 180.0
+
+class FakeMusicFile(dict):
+    '''Enough of a mutagen file for RGTrack, with its tags in a dict.'''
+    info = FakeInfo()
+
+    def __init__(self, filename: str, tags: dict) -> None:
+        super(FakeMusicFile, self).__init__(tags)
+        self.filename = filename
+
+def make_track_set(directory: str, tracks: int) -> RGTrackSet:
+    rg_tracks = []
+    for i in range(tracks):
+        tags = {
+            'album': ['Album'],
+            'replaygain_track_gain': [format_gain(-6.54 - i % 100 / 100)],
+            'replaygain_track_peak': [format_peak(0.9)],
+            'replaygain_album_gain': [format_gain(-7.01)],
+            'replaygain_album_peak': [format_peak(0.99)],
+            'replaygain_track_true_peak': [format_peak(0.95)],
+            'replaygain_album_true_peak': [format_peak(1.01)],
+        }
+        rg_tracks.append(RGTrack(FakeMusicFile(os.path.join(directory, '{:05d}.flac'.format(i)), tags)))
+    return RGTrackSet(rg_tracks, gain_backend=NullGainComputer())
+
+def best_time(func, repeat: int) -> float:
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        track_set = make_track_set(directory, args.tracks)
+        tracks = list(track_set.RGTracks.values())
+        def forget() -> None:
+            for t in tracks:
+                t.tags_changed()
+            track_set._track_gain_signal = None
+        checks = [
+            ('has_valid_rgdata', track_set.has_valid_rgdata),
+            ('has_true_peak_data', track_set.has_true_peak_data),
+            ('result', lambda: track_set.result(SKIPPED)),
+            ('want_album_gain', track_set.want_album_gain),
+        ]
+        assert track_set.has_valid_rgdata()
+        print("Track set of {} tracks:".format(args.tracks))
+        for (name, check) in checks:
+            def cold() -> None:
+                forget()
+                check()
+            cold_time = best_time(cold, args.repeat)
+            warm_time = best_time(check, args.repeat)
+            print("  {:<20} cold {:8.2f} ms  warm {:8.2f} ms".format(name, cold_time * 1e3, warm_time * 1e3))
+
+    values = [ format_gain(-6.54 - i / 100) for i in range(1000) ]
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        for v in values:
+            parse_gain(v)
+    elapsed = time.perf_counter() - start
+    print("parse_gain: {:.2f} us per value".format(elapsed / args.repeat / len(values) * 1e6))
+
+if __name__ == '__main__':
+    main()
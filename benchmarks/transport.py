@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+'''Throughput benchmark for passing decoded audio between processes.
+
+Sends the same amount of float32 PCM from a child process to the
+parent, once through a multiprocessing pipe (pickling each block) and
+once through a PCMRing (see rganalysis.transport), and reports the
+throughput of each in MB/s and in multiples of realtime for the
+given sample rate and channels.
+
+Usage: python benchmarks/transport.py [--seconds S] [--rate HZ] [--channels N]
+
+'''
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from rganalysis.transport import PCMRing, END_OF_STREAM, SLOT_SAMPLES
+
+def make_block(channels: int) -> np.ndarray:
+    return np.random.standard_normal((SLOT_SAMPLES // channels, channels)).astype(np.float32)
+
+def pipe_producer(conn, blocks: int, channels: int) -> None:
+    block = make_block(channels)
+    for _ in range(blocks):
+        conn.send(block)
+    conn.send(None)
+    conn.close()
+
+def ring_producer(ring: PCMRing, blocks: int, channels: int, rate: int) -> None:
+    block = make_block(channels)
+    for _ in range(blocks):
+        ring.put(block, rate)
+    ring.mark(END_OF_STREAM)
+
+def via_pipe(blocks: int, channels: int, rate: int) -> float:
+    (recv_conn, send_conn) = multiprocessing.Pipe(duplex=False)
+    p = multiprocessing.Process(target=pipe_producer, args=(send_conn, blocks, channels))
+    start = time.perf_counter()
+    p.start()
+    send_conn.close()
+    total = 0.0
+    while True:
+        block = recv_conn.recv()
+        if block is None:
+            break
+        total += float(block[0, 0])
+    elapsed = time.perf_counter() - start
+    p.join()
+    return elapsed
+
+def via_ring(blocks: int, channels: int, rate: int) -> float:
+    ring = PCMRing()
+    p = multiprocessing.Process(target=ring_producer, args=(ring, blocks, channels, rate))
+    start = time.perf_counter()
+    p.start()
+    total = 0.0
+    while True:
+        (frames, _, samples) = ring.get()
+        if frames < 0:
+            break
+        total += float(samples[0, 0])
+        ring.release()
+    elapsed = time.perf_counter() - start
+    p.join()
+    ring.unlink()
+    return elapsed
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=600.0, help="seconds of audio to send")
+    parser.add_argument('--rate', type=int, default=192000)
+    parser.add_argument('--channels', type=int, default=2)
+    args = parser.parse_args()
+
+    block_frames = SLOT_SAMPLES // args.channels
+    blocks = max(1, int(args.seconds * args.rate / block_frames))
+    megabytes = blocks * block_frames * args.channels * 4 / 1e6
+    audio_seconds = blocks * block_frames / args.rate
+    for (name, method) in (('pipe', via_pipe), ('shared memory', via_ring)):
+        elapsed = method(blocks, args.channels, args.rate)
+        print("{:>14}: {:8.0f} MB/s  {:6.0f}x realtime".format(
+            name, megabytes / elapsed, audio_seconds / elapsed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+'''Benchmark of the cost of true-peak measurement.
+
+Writes a WAV file of noise and analyzes it with the native backend
+(see rganalysis.backends.native), with and without true peak, and
+reports the time taken by each and their ratio, which should be
+about 1.3 or less. Also times the TruePeakMeter on its own.
+
+Usage: python benchmarks/true_peak.py [--seconds S] [--rate HZ] [--repeat N]
+
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import timeit
+import wave
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from rganalysis.backends import get_backend
+from rganalysis.dsp import TruePeakMeter
+
+def write_noise(fname: str, seconds: float, rate: int) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    samples = (0.1 * rng.standard_normal((int(seconds * rate), 2)) * 32767).astype('<i2')
+    with wave.open(fname, 'wb') as w:
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(samples.tobytes())
+    return samples.astype(np.float32) / 32768
+
+def best_time(func, repeat: int) -> float:
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=180.0)
+    parser.add_argument('--rate', type=int, default=44100)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    backend = get_backend('native')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, 'noise.wav')
+        samples = write_noise(fname, args.seconds, args.rate)
+        # Warm up the page cache and the filters
+        backend.compute_gain([fname], true_peak=True)
+        plain = best_time(lambda: backend.compute_gain([fname]), args.repeat)
+        with_true_peak = best_time(lambda: backend.compute_gain([fname], true_peak=True), args.repeat)
+    def meter_only() -> None:
+        TruePeakMeter().update(samples)
+    meter = best_time(meter_only, args.repeat)
+    print("{:.0f} s of {} Hz stereo audio:".format(args.seconds, args.rate))
+    print("  without true peak {:7.3f} s  ({:.0f}x realtime)".format(plain, args.seconds / plain))
+    print("  with true peak    {:7.3f} s  ({:.0f}x realtime)".format(with_true_peak, args.seconds / with_true_peak))
+    print("  TruePeakMeter     {:7.3f} s".format(meter))
+    print("Cost of true peak: {:.2f}x".format(with_true_peak / plain))
+
+if __name__ == '__main__':
+    main()
@@ -5,22 +5,19 @@
 # License as published by the Free Software Foundation.
 
 from typing import (
-    Any, Callable, Dict, Iterable, List, Sequence, Set, Tuple, Union, cast
+    IO, TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, Union, cast
 )
 
 import os.path
 import re
-import sys
-
-from itertools import groupby
-from mutagen import File as MusicFile
-from mutagen import FileType as MusicFileType
-from mutagen.easyid3 import EasyID3
-from mutagen.easymp4 import EasyMP4Tags
 
 from rganalysis.common import logger, format_gain, format_peak, parse_gain, parse_peak
 from rganalysis.backends import GainComputer
-from rganalysis.fixup_id3 import fixup_ID3
+from rganalysis.profiling import stage
+from rganalysis.results import AlbumResult, TrackResult, CONSISTENT, DRIFTED
+
+if TYPE_CHECKING:
+    from mutagen import FileType as MusicFileType
 
 rg_tags = (
     'replaygain_track_gain',
@@ -28,27 +25,110 @@ rg_tags = (
     'replaygain_album_gain',
     'replaygain_album_peak',
     'replaygain_reference_loudness',
+    'replaygain_track_true_peak',
+    'replaygain_album_true_peak',
+    # Only on tracks with provisional tags from a fast estimate (see
+    # rganalysis.backends.estimate)
+    'replaygain_track_gain_error',
+    'replaygain_album_gain_error',
 )
-for tag in rg_tags:
-    # Support replaygain tags for M4A/MP4
-    EasyMP4Tags.RegisterFreeformKey(tag, tag)
+
+# Lower-case names of the ReplayGain tags in every format, as seen
+# through mutagen's non-easy interface
+_all_rg_tag_names = { tag.lower() for tag in
+                      list(rg_tags) +
+                      [ 'QuodLibet::' + tag for tag in rg_tags ] +
+                      [ 'TXXX:' + tag for tag in rg_tags ] +
+                      [ 'RVA2:track', 'RVA2:album' ] }
+
+def rg_tag_keys(track: 'MusicFileType') -> List[str]:
+    '''Return the keys of all ReplayGain tags in a non-easy mutagen file.'''
+    return [ k for k in track.keys() if k.lower() in _all_rg_tag_names ]
+
+_mutagen_file = None            # type: Optional[Callable]
+_easy_types = {}                # type: Dict[type, type]
+
+def MusicFile(filename: str, easy: bool = False) -> 'MusicFileType':
+    '''mutagen.File, imported on first use.
+
+    Importing mutagen is a large part of the startup time, so it is
+    deferred until a file actually needs to be opened.
+
+    With easy=True, WAV and AIFF files, which mutagen has no easy
+    variant of, are opened as rganalysis.easyiff.EasyWAVE and
+    EasyAIFF.
+
+    '''
+    global _mutagen_file, _easy_types
+    if _mutagen_file is None:
+        from mutagen import File
+        from mutagen.easyid3 import EasyID3
+        from mutagen.easymp4 import EasyMP4Tags
+        from rganalysis.easyiff import easy_types
+        for tag in rg_tags:
+            # Support replaygain tags for M4A/MP4
+            EasyMP4Tags.RegisterFreeformKey(tag, tag)
+            # EasyID3 only knows the standard replaygain tags
+            if tag not in EasyID3.valid_keys:
+                EasyID3.RegisterTXXXKey(tag, tag)
+        (_mutagen_file, _easy_types) = (File, easy_types)
+    track = _mutagen_file(filename, easy=easy)
+    if easy and type(track) in _easy_types:
+        track = _easy_types[type(track)](filename)
+    return track
 
 def fullpath(f: str) -> str:
     '''os.path.realpath + expanduser'''
     return os.path.realpath(os.path.expanduser(f))
 
+def fullpaths(paths: Iterable[str]) -> Iterator[str]:
+    '''fullpath for many paths, resolving each directory only once.
+
+    os.path.realpath examines every component of a path, so resolving
+    a long list of files in the same few directories repeats the same
+    work for each file. Here the real path of each directory is
+    remembered, and only the last component of each path is checked
+    for a symlink.
+
+    '''
+    resolved = {}               # type: Dict[str, str]
+    for p in paths:
+        p = os.path.expanduser(p)
+        if os.pardir in p.split(os.sep):
+            # ".." must be resolved after any symlinks before it
+            yield os.path.realpath(p)
+            continue
+        (directory, name) = os.path.split(os.path.abspath(p))
+        if directory not in resolved:
+            resolved[directory] = os.path.realpath(directory)
+        p = os.path.join(resolved[directory], name)
+        yield os.path.realpath(p) if os.path.islink(p) else p
+
+def read_file_list(f: IO[bytes], null: bool = False) -> Iterator[str]:
+    '''Read a list of paths from a binary file, one per line.
+
+    If null is True, the paths are separated by NUL characters
+    instead, as output by "find -print0", so that they may contain
+    newlines. Empty entries are ignored.
+
+    '''
+    separator = b'\0' if null else b'\n'
+    for entry in f.read().split(separator):
+        if not null:
+            entry = entry.rstrip(b'\r')
+        if entry:
+            yield os.fsdecode(entry)
+
 def Property(function: Callable) -> Callable:
-    keys = 'fget', 'fset', 'fdel'
-    func_locals = {'doc':function.__doc__}
-    def probe_func(frame, event, arg): # type: ignore
-        if event == 'return':
-            locals = frame.f_locals
-            func_locals.update(dict((k,locals.get(k)) for k in keys))
-            sys.settrace(None)
-        return probe_func
-    sys.settrace(probe_func)
-    function()
-    return property(**func_locals) # type: ignore
+    '''Make a property from a function that returns its locals().
+
+    The function should define any of fget, fset, fdel and doc as
+    local variables, which are passed on to property.
+
+    '''
+    func_locals = function()
+    return property(func_locals.get('fget'), func_locals.get('fset'), # type: ignore
+                    func_locals.get('fdel'), func_locals.get('doc', function.__doc__))
 
 def get_multi(d: Dict[Any, Any], keys: Iterable[Any], default: Any = None) -> Any:
     '''Like "dict.get", but keys is a list of keys to try.
@@ -65,15 +145,15 @@ def get_multi(d: Dict[Any, Any], keys: Iterable[Any], default: Any = None) -> An
     return default
 
 # Tag names copied from Quod Libet
-def get_album(mf: MusicFile) -> str:
+def get_album(mf: 'MusicFileType') -> str:
     return get_multi(mf, ("albumsort", "album"), [''])[0]
-def get_albumartist(mf: MusicFile) -> str:
+def get_albumartist(mf: 'MusicFileType') -> str:
     return get_multi(mf, ("albumartistsort", "albumartist", "artistsort", "artist"), [''])[0]
-def get_albumid(mf: MusicFile) -> str:
+def get_albumid(mf: 'MusicFileType') -> str:
     return get_multi(mf, ("album_grouping_key", "labelid", "musicbrainz_albumid"), [''])[0]
-def get_discnumber(mf: MusicFile) -> str:
+def get_discnumber(mf: 'MusicFileType') -> str:
     return mf.get("discnumber", [''])[0]
-def get_full_classname(mf: MusicFile) -> str:
+def get_full_classname(mf: 'MusicFileType') -> str:
     t = type(mf)
     return "{}.{}".format(t.__module__, t.__qualname__)
 
@@ -81,12 +161,15 @@ class RGTrack(object):
     '''Represents a single track along with methods for analyzing it
     for replaygain information.'''
 
-    def __init__(self, track: Union[MusicFileType, str]) -> None:
-        if not isinstance(track, MusicFileType):
+    def __init__(self, track: Union['MusicFileType', str]) -> None:
+        if isinstance(track, str):
             track = MusicFile(track, easy=True)
         self.track = track # type: MusicFileType
         self.filename = self.track.filename
         self.directory = os.path.dirname(self.filename)
+        # Parsed tag values by tag name, None for missing or invalid
+        # tags. See _tag_value.
+        self._rg_values = {}    # type: Dict[str, Optional[float]]
 
     def __repr__(self) -> str:
         return "RGTrack(MusicFile({}, easy=True))".format(repr(self.filename))
@@ -96,6 +179,28 @@ class RGTrack(object):
         tags are not checked for accuracy, only existence.'''
         return self.gain is not None and self.peak is not None
 
+    def _tag_value(self, tag: str, parser: Callable[[str], float]) -> Optional[float]:
+        '''Return the value of tag parsed by parser, or None if the tag
+        is missing or invalid.
+
+        Each tag is only parsed once, until the tags are changed
+        through this object (see tags_changed).'''
+        try:
+            return self._rg_values[tag]
+        except KeyError:
+            pass
+        try:
+            value = parser(self.track[tag][0]) # type: Optional[float]
+        except (KeyError, ValueError):
+            value = None
+        self._rg_values[tag] = value
+        return value
+
+    def tags_changed(self) -> None:
+        '''Forget the parsed tag values. This must be called after
+        modifying self.track directly.'''
+        self._rg_values.clear()
+
 
     def track_set_key(self) -> Tuple:
         '''Return a tuple that uniquely identifies the track's "album".
@@ -142,21 +247,19 @@ class RGTrack(object):
         you put in.'''
         tag = 'replaygain_track_gain'
         def fget(self) -> float:
-            try:
-                tval = self.track[tag][0]
-                gain = parse_gain(tval)
-                return gain
-            except (KeyError, ValueError):
-                return None
+            return self._tag_value(tag, parse_gain)
         def fset(self, value: float) -> None:
             logger.debug("Setting %s to %s for %s" % (tag, value, self.filename))
             if value is None:
                 del self.gain
             else:
                 self.track[tag] = format_gain(value)
+                self.tags_changed()
         def fdel(self) -> None:
             if tag in self.track.keys():
                 del self.track[tag]
+                self.tags_changed()
+        return locals()
 
     @Property
     def peak():                 # type: ignore
@@ -167,21 +270,19 @@ class RGTrack(object):
         you put in.'''
         tag = 'replaygain_track_peak'
         def fget(self) -> float:
-            try:
-                tval = self.track[tag][0]
-                peak = parse_peak(tval)
-                return peak
-            except (KeyError, ValueError):
-                return None
+            return self._tag_value(tag, parse_peak)
         def fset(self, value) -> None:
             logger.debug("Setting %s to %s for %s" % (tag, value, self.filename))
             if value is None:
                 del self.peak
             else:
                 self.track[tag] = format_peak(value)
+                self.tags_changed()
         def fdel(self) -> None:
             if tag in self.track.keys():
                 del self.track[tag]
+                self.tags_changed()
+        return locals()
 
     @Property
     def album_gain():           # type: ignore
@@ -192,21 +293,19 @@ class RGTrack(object):
         you put in.'''
         tag = 'replaygain_album_gain'
         def fget(self) -> float:
-            try:
-                tval = self.track[tag][0]
-                gain = parse_gain(tval)
-                return gain
-            except (KeyError, ValueError):
-                return None
+            return self._tag_value(tag, parse_gain)
         def fset(self, value) -> None:
             logger.debug("Setting %s to %s for %s" % (tag, value, self.filename))
             if value is None:
                 del self.album_gain
             else:
                 self.track[tag] = format_gain(value)
+                self.tags_changed()
         def fdel(self) -> None:
             if tag in self.track.keys():
                 del self.track[tag]
+                self.tags_changed()
+        return locals()
 
     @Property
     def album_peak():           # type: ignore
@@ -217,26 +316,111 @@ class RGTrack(object):
         you put in.'''
         tag = 'replaygain_album_peak'
         def fget(self) -> float:
-            try:
-                tval = self.track[tag][0]
-                peak = parse_peak(tval)
-                return peak
-            except (KeyError, ValueError):
-                return None
+            return self._tag_value(tag, parse_peak)
         def fset(self, value) -> None:
             logger.debug("Setting %s to %s for %s" % (tag, value, self.filename))
             if value is None:
                 del self.album_peak
             else:
                 self.track[tag] = format_peak(value)
+                self.tags_changed()
+        def fdel(self) -> None:
+            if tag in self.track.keys():
+                del self.track[tag]
+                self.tags_changed()
+        return locals()
+
+    @Property
+    def true_peak():            # type: ignore
+        doc = '''Track true peak, or None if the track does not have a true peak tag.
+
+        This is only set when true peak measurement is requested
+        with the "separate" mode.'''
+        tag = 'replaygain_track_true_peak'
+        def fget(self) -> float:
+            return self._tag_value(tag, parse_peak)
+        def fset(self, value) -> None:
+            logger.debug("Setting %s to %s for %s" % (tag, value, self.filename))
+            if value is None:
+                del self.true_peak
+            else:
+                self.track[tag] = format_peak(value)
+                self.tags_changed()
+        def fdel(self) -> None:
+            if tag in self.track.keys():
+                del self.track[tag]
+                self.tags_changed()
+        return locals()
+
+    @Property
+    def album_true_peak():      # type: ignore
+        doc = '''Album true peak, or None if the track does not have an album true peak tag.'''
+        tag = 'replaygain_album_true_peak'
+        def fget(self) -> float:
+            return self._tag_value(tag, parse_peak)
+        def fset(self, value) -> None:
+            logger.debug("Setting %s to %s for %s" % (tag, value, self.filename))
+            if value is None:
+                del self.album_true_peak
+            else:
+                self.track[tag] = format_peak(value)
+                self.tags_changed()
+        def fdel(self) -> None:
+            if tag in self.track.keys():
+                del self.track[tag]
+                self.tags_changed()
+        return locals()
+
+    @Property
+    def gain_error():           # type: ignore
+        doc = '''Uncertainty of the track gain in dB, or None if the tags are not provisional.
+
+        Only tags estimated from excerpts of the audio have this tag,
+        which marks them as provisional until a full analysis.'''
+        tag = 'replaygain_track_gain_error'
+        def fget(self) -> float:
+            return self._tag_value(tag, parse_gain)
+        def fset(self, value) -> None:
+            logger.debug("Setting %s to %s for %s" % (tag, value, self.filename))
+            if value is None:
+                del self.gain_error
+            else:
+                self.track[tag] = format_gain(value)
+                self.tags_changed()
+        def fdel(self) -> None:
+            if tag in self.track.keys():
+                del self.track[tag]
+                self.tags_changed()
+        return locals()
+
+    @Property
+    def album_gain_error():     # type: ignore
+        doc = '''Uncertainty of the album gain in dB, or None if the tags are not provisional.'''
+        tag = 'replaygain_album_gain_error'
+        def fget(self) -> float:
+            return self._tag_value(tag, parse_gain)
+        def fset(self, value) -> None:
+            logger.debug("Setting %s to %s for %s" % (tag, value, self.filename))
+            if value is None:
+                del self.album_gain_error
+            else:
+                self.track[tag] = format_gain(value)
+                self.tags_changed()
         def fdel(self) -> None:
             if tag in self.track.keys():
                 del self.track[tag]
+                self.tags_changed()
+        return locals()
+
+    def is_provisional(self) -> bool:
+        '''Returns True if the track's tags are marked as provisional estimates.'''
+        return self.gain_error is not None
 
     @Property
     def length_seconds():       # type: ignore
         def fget(self) -> float:
             return self.track.info.length
+        return locals()
 
     def cleanup_tags(self) -> None:
         '''Delete any ReplayGain tags from track.
@@ -246,33 +430,35 @@ class RGTrack(object):
         disk.
 
         '''
-        tags_to_clean = set(rg_tags) # type: Set[str]
-        tags_to_clean.update('QuodLibet::' + tag for tag in rg_tags)
-        tags_to_clean.update('TXXX:' + tag for tag in rg_tags)
-        tags_to_clean.update(['RVA2:track', 'RVA2:album'])
-        tags_to_clean = { tag.lower() for tag in tags_to_clean }
         # Need a non-easy interface for proper ID3 cleanup
         t = MusicFile(self.filename, easy=False)
-        tags_to_delete = []
-        for k in t.keys():
-            if k.lower() in tags_to_clean:
-                tags_to_delete.append(k)
-        for k in tags_to_delete:
+        for k in rg_tag_keys(t):
             logger.debug("Deleting tag: %s", repr(k))
             del t[k]
         t.save()
         # Re-init to pick up tag changes
         new_track = type(self.track)(self.filename)
         self.track = new_track
+        self.tags_changed()
 
     def save(self, cleanup: bool = True, fixup_id3: bool = True) -> None:
         if cleanup:
-            (tgain, tpeak, again, apeak) = \
-                (self.gain, self.peak, self.album_gain, self.album_peak)
+            (tgain, tpeak, again, apeak, ttpeak, atpeak, terror, aerror) = \
+                (self.gain, self.peak, self.album_gain, self.album_peak,
+                 self.true_peak, self.album_true_peak, self.gain_error, self.album_gain_error)
             self.cleanup_tags()
             (self.gain, self.peak, self.album_gain, self.album_peak) = (tgain, tpeak, again, apeak) # type: ignore
+            if ttpeak is not None:
+                self.true_peak = ttpeak
+            if atpeak is not None:
+                self.album_true_peak = atpeak
+            if terror is not None:
+                self.gain_error = terror
+            if aerror is not None:
+                self.album_gain_error = aerror
         self.track.save()
         if fixup_id3:
+            from rganalysis.fixup_id3 import fixup_ID3
             fixup_ID3(self.filename)
 
 class RGTrackDryRun(RGTrack):
@@ -306,37 +492,85 @@ class RGTrackSet(object):
         self.num_tracks = len(self.RGTracks)
         self.length_seconds = sum(t.length_seconds for t in self.RGTracks.values())
         self.directory = next(iter(self.RGTracks.values())).directory
+        # Set by do_gain when the gain values are estimates
+        self.provisional = False
+        self.gain_errors = {}   # type: Dict[str, Optional[float]]
+        self.album_gain_error = None # type: Optional[float]
+        # Whether the directory has a track gain signal file, checked
+        # on first use
+        self._track_gain_signal = None # type: Optional[bool]
 
     def __repr__(self) -> str:
         return "RGTrackSet(%s, gain_type=%s)" % (repr(self.RGTracks.values()), repr(self.gain_type))
 
     @classmethod
-    def MakeTrackSets(cls: type, tracks: Iterable[RGTrack], gain_backend: GainComputer) -> Iterable:
+    def MakeTrackSets(cls: type, tracks: Iterable[RGTrack], gain_backend: GainComputer,
+                      ordered: bool = False, cue_sheets: Optional[bool] = None) -> Iterable:
         '''Takes an iterable of RGTrack objects and returns an iterable of
         RGTrackSet objects, one for each track_set_key represented in
         the RGTrack objects.
 
-        The input iterable need not be completely sorted, but tracks
-        from the same directory should be yielded consecutively with
-        each other, or else they will not be grouped.
+        The input iterable may be in any order, in which case no
+        track set is yielded until all tracks have been read, since
+        tracks from any directory may still come. If ordered is True,
+        tracks from the same directory must be yielded consecutively
+        with each other (as they are when found by os.walk), and each
+        directory's track sets are yielded as soon as its tracks have
+        been read (see rganalysis.grouping).
 
         Second argument 'backend' should be an instance of
         GainComputer that will be passed to the RGTrackSet
         constructor. In addition, its supports_file method will be
         used to filter the tracks.
 
+        A file with a CUE sheet that splits it into several tracks
+        (see rganalysis.cue) becomes a CueTrackSet of its own, if
+        cue_sheets is True, or if it is None (the default) and CUE
+        sheets can be used for analysis with gain_backend (see
+        rganalysis.cue.use_cue_sheets). Only reading the tags of CUE
+        track sets needs neither numpy nor scipy.
+
         '''
-        tracks = (tr for tr in tracks if gain_backend.supports_file(cast(str, tr.filename)))
-        tracks_by_dir = groupby(tracks, lambda tr: os.path.dirname(cast(str, tr.filename)))
-        for (dirname, tracks_in_dir) in tracks_by_dir:
+        from rganalysis.cue import CueTrackSet, find_cue_sheet, use_cue_sheets
+        from rganalysis.grouping import group_by_directory
+        if cue_sheets is None:
+            cue_sheets = use_cue_sheets(gain_backend)
+        # Unsupported files by extension
+        unsupported = {}        # type: Dict[str, int]
+        def supported(tr: RGTrack) -> bool:
+            if gain_backend.supports_file(cast(str, tr.filename)):
+                return True
+            ext = os.path.splitext(tr.filename)[1].lower() or "[no extension]"
+            if ext not in unsupported:
+                logger.warning("Skipping %s files, such as %s, which the backend does not support",
+                               ext, repr(tr.filename))
+                unsupported[ext] = 0
+            unsupported[ext] += 1
+            return False
+        for (dirname, tracks_in_dir) in group_by_directory(filter(supported, tracks), ordered):
             track_sets = {}     # type: Dict[Tuple, List[RGTrack]]
+            cue_track_sets = [] # type: List[RGTrackSet]
+            # Only look for sidecar CUE sheets in directories that have any
+            try:
+                sidecars = any(f.lower().endswith('.cue') for f in os.listdir(dirname))
+            except OSError:
+                sidecars = False
             for tr in tracks_in_dir:
+                cue = find_cue_sheet(tr, sidecars) if cue_sheets else None
+                if cue is not None:
+                    cue_track_sets.append(CueTrackSet(tr, cue[0], cue[1], gain_backend=gain_backend))
+                    continue
                 tskey = tr.track_set_key() # type: Tuple
                 try:
                     track_sets[tskey].append(tr)
                 except KeyError:
                     track_sets[tskey] = [ tr, ]
             yield from ( cls(track_sets[k], gain_backend=gain_backend) for k in sorted(track_sets.keys()) )
+            yield from sorted(cue_track_sets, key=lambda ts: ts.filenames[0])
+        if unsupported:
+            logger.warning("Skipped %s files that the backend does not support: %s",
+                           sum(unsupported.values()),
+                           ", ".join("{} {}".format(n, ext) for (ext, n) in sorted(unsupported.items())))
 
     def want_album_gain(self) -> bool:
         '''Return true if this track set should have album gain tags,
@@ -347,14 +581,22 @@ class RGTrackSet(object):
             elif self.gain_type == "track":
                 return False
             elif self.gain_type == "auto":
-                # Check for track gain signal files
-                return not any(os.path.exists(os.path.join(cast(str, self.directory), f)) for f in self.track_gain_signal_filenames)
+                return not self.has_track_gain_signal()
             else:
                 raise TypeError('RGTrackSet.gain_type must be either "track", "album", or "auto"')
         else:
             # Single track(s), so no album gain
             return False
 
+    def has_track_gain_signal(self) -> bool:
+        '''Return true if the track set's directory contains one of the
+        track_gain_signal_filenames. The directory is only checked
+        once for each track set.'''
+        if self._track_gain_signal is None:
+            self._track_gain_signal = any(os.path.exists(os.path.join(cast(str, self.directory), f))
+                                          for f in self.track_gain_signal_filenames)
+        return self._track_gain_signal
+
     @Property
     def gain():                 # type: ignore
         doc = '''Album gain value, or None if tracks do not all agree on it.
@@ -373,6 +615,7 @@ class RGTrackSet(object):
         def fdel(self) -> None:
             for t in self.RGTracks.values():
                 del t.album_gain
+        return locals()
 
     @Property
     def peak():                 # type: ignore
@@ -392,6 +635,7 @@ class RGTrackSet(object):
         def fdel(self) -> None:
             for t in self.RGTracks.values():
                 del t.album_peak
+        return locals()
 
     def track_set_key(self) -> Tuple:
         return next(iter(self.RGTracks.values())).track_set_key()
@@ -434,6 +678,7 @@ class RGTrackSet(object):
         logger.debug("Setting %s to %s in all tracks in %s.", tag, value, self.track_set_key_string())
         for t in self.RGTracks.values():
             t.track[tag] = str(value)
+            t.tags_changed()
 
     def _del_tag(self, tag: str) -> None:
         '''Delete tag from all tracks in the album.'''
@@ -442,47 +687,90 @@ class RGTrackSet(object):
             try:
                 del t.track[tag]
             except KeyError: pass
+            t.tags_changed()
 
     def do_gain(self, force: bool = False, gain_type: Union[None, str] = None,
-                dry_run: bool = False, verbose: bool = False) -> None:
+                dry_run: bool = False, verbose: bool = False,
+                true_peak: str = "off") -> bool:
         '''Analyze all tracks in the album, and add replay gain tags
         to the tracks based on the analysis.
 
         If force is False (the default) and the album already has
-        replay gain tags, then do nothing.
+        replay gain tags, then do nothing. Returns True if the album
+        was analyzed, or False if it was skipped.
 
         gain_type can be one of "album", "track", or "auto", as
         described in the help. If provided to this method, it will sef
         the object's gain_type field.
+
+        true_peak can be "off" (the default), "replace" to write the
+        true peak in place of the sample peak in the peak tags, or
+        "separate" to write it to separate true peak tags.
         '''
         if gain_type is not None:
             self.gain_type = gain_type
+        if true_peak not in ("off", "replace", "separate"):
+            raise TypeError('true_peak must be either "off", "replace", or "separate"')
         # This performs some additional checks
         gain_type = "album" if self.want_album_gain() else "track"
         assert gain_type in ("album", "track")
-        if self.has_valid_rgdata():
-            if force:
+        if self.has_valid_rgdata() and (true_peak != "separate" or self.has_true_peak_data()):
+            if self.has_provisional_tags():
+                logger.info("Reanalyzing track set %s, which has provisional tags from a fast estimate", repr(self.track_set_key_string()))
+            elif force:
                 logger.info("Forcing reanalysis of previously-analyzed track set %s", repr(self.track_set_key_string()))
             else:
                 logger.info("Skipping previously-analyzed track set %s", repr(self.track_set_key_string()))
-                return
+                return False
         else:
             logger.info('Analyzing track set %s', repr(self.track_set_key_string()))
-        rginfo = self.gain_backend.compute_gain(self.filenames)
+        with stage('analyze'):
+            if true_peak == "off":
+                rginfo = self.gain_backend.compute_gain(self.filenames, album=(gain_type == "album"))
+            else:
+                rginfo = self.gain_backend.compute_gain(self.filenames, album=(gain_type == "album"), true_peak=True)
+        peak_tag = "true_peak" if true_peak == "replace" else "peak"
         # Save track gains
         for fname in self.RGTracks.keys():
             track = self.RGTracks[fname]
             track_rginfo = rginfo[fname]
-            (track.gain, track.peak) = (track_rginfo["replaygain_track_gain"], track_rginfo["replaygain_track_peak"]) # type: ignore
+            (track.gain, track.peak) = (track_rginfo["replaygain_track_gain"], track_rginfo["replaygain_track_" + peak_tag]) # type: ignore
+            if true_peak == "separate":
+                track.true_peak = track_rginfo["replaygain_track_true_peak"]
         # Set or unset album gain
         if gain_type == "album":
             album_rginfo = next(iter(rginfo.values()))
-            (self.gain, self.peak) = (track_rginfo["replaygain_album_gain"], track_rginfo["replaygain_album_peak"]) # type: ignore
+            (self.gain, self.peak) = (album_rginfo["replaygain_album_gain"], album_rginfo["replaygain_album_" + peak_tag]) # type: ignore
+            if true_peak == "separate":
+                for t in self.RGTracks.values():
+                    t.album_true_peak = album_rginfo["replaygain_album_true_peak"]
         else:
             del self.gain
             del self.peak
+            for t in self.RGTracks.values():
+                del t.album_true_peak
+        self.provisional = self.gain_backend.provisional
+        if self.provisional:
+            self.gain_errors = { fname: rginfo[fname].get("replaygain_track_gain_error") for fname in self.filenames }
+            if gain_type == "album":
+                self.album_gain_error = album_rginfo.get("replaygain_album_gain_error")
+        # The error tags mark provisional tags in the files themselves,
+        # so that a later full analysis replaces them
+        for (fname, t) in self.RGTracks.items():
+            if self.provisional:
+                error = self.gain_errors.get(fname)
+                t.gain_error = 0.0 if error is None else error
+                t.album_gain_error = (0.0 if self.album_gain_error is None else self.album_gain_error) \
+                    if gain_type == "album" else None
+            else:
+                del t.gain_error
+                del t.album_gain_error
         # Now save the tags to the files
-        self.save()
+        with stage('write'):
+            self.save()
+        if not dry_run:
+            self.gain_backend.tags_saved(rginfo)
+        return True
 
     def is_multitrack_album(self) -> bool:
         '''Returns True if this track set represents at least two
@@ -506,9 +794,8 @@ class RGTrackSet(object):
         a collection of albumless songs, then only track gain data is
         checked.'''
         # Make sure every track has valid gain data
-        for t in self.RGTracks.values():
-            if not t.has_valid_rgdata():
-                return False
+        if not self.has_track_rgdata():
+            return False
         # For "real" albums, check the album gain data
         if self.want_album_gain():
             # These will only be non-null if all tracks agree on their
@@ -517,16 +804,116 @@ class RGTrackSet(object):
         else:
             return self.gain is None and self.peak is None
 
+    def has_track_rgdata(self) -> bool:
+        '''Returns true if all tracks have track gain and peak tags,
+        whatever their album gain tags.'''
+        return all(t.has_valid_rgdata() for t in self.RGTracks.values())
+
+    def has_provisional_tags(self) -> bool:
+        '''Returns true if the album's tags are provisional estimates
+        that a full analysis should replace.
+
+        This is the case if any track is marked as provisional in its
+        tags (see RGTrack.is_provisional), or in the gain cache (see
+        GainComputer.is_provisional). Estimates are never replaced by
+        other estimates.'''
+        if self.gain_backend.provisional:
+            return False
+        return any(t.is_provisional() for t in self.RGTracks.values()) or \
+            self.gain_backend.is_provisional(self.filenames)
+
+    def has_true_peak_data(self) -> bool:
+        '''Returns true if all tracks have true peak tags, and also
+        album true peak tags if want_album_gain is True.'''
+        album = self.want_album_gain()
+        for t in self.RGTracks.values():
+            if t.true_peak is None or (album and t.album_true_peak is None):
+                return False
+        return True
+
+    def result(self, status: str, error: Optional[str] = None,
+               quarantined: Sequence[str] = ()) -> AlbumResult:
+        '''Return an AlbumResult with the album's current gain values.
+
+        status, error and quarantined are as described for AlbumResult.'''
+        album = self.want_album_gain()
+        return AlbumResult(
+            key=self.track_set_key_string(),
+            directory=self.directory,
+            status=status,
+            gain_type="album" if album else "track",
+            album_gain=self.gain if album else None,
+            album_peak=self.peak if album else None,
+            tracks=[ TrackResult(k, self.RGTracks[k].gain, self.RGTracks[k].peak, self.gain_errors.get(k),
+                                 self.RGTracks[k].true_peak)
+                     for k in self.filenames ],
+            error=error,
+            quarantined=list(quarantined),
+            provisional=self.provisional,
+            album_gain_error=self.album_gain_error if album else None,
+            drift=None,
+            album_true_peak=self.RGTracks[self.filenames[0]].album_true_peak if album else None)
+
+    def audit_gain(self, tolerance: float = 0.5, gain_type: Union[None, str] = None) -> AlbumResult:
+        '''Analyze all tracks in the album and compare the result with their tags.
+
+        The files are not modified. Returns an AlbumResult holding
+        the newly measured gain values, whose status is "drifted" if
+        any track gain (or the album gain, if want_album_gain is
+        True) differs from the stored value by more than tolerance
+        dB, or "consistent" otherwise. Peaks are not compared, since
+        backends differ in how they measure them.
+
+        gain_type is as for do_gain.
+        '''
+        if gain_type is not None:
+            self.gain_type = gain_type
+        album = self.want_album_gain()
+        logger.info('Auditing track set %s', repr(self.track_set_key_string()))
+        rginfo = self.gain_backend.compute_gain(self.filenames, album=album)
+        diffs = [ abs(rginfo[k]["replaygain_track_gain"] - self.RGTracks[k].gain) for k in self.filenames ]
+        album_rginfo = rginfo[self.filenames[0]]
+        if album:
+            diffs.append(abs(album_rginfo["replaygain_album_gain"] - self.gain))
+        drift = max(diffs)
+        if drift > tolerance:
+            logger.warning("Gain of track set %s differs from its tags by up to %.2f dB", repr(self.track_set_key_string()), drift)
+        return AlbumResult(
+            key=self.track_set_key_string(),
+            directory=self.directory,
+            status=DRIFTED if drift > tolerance else CONSISTENT,
+            gain_type="album" if album else "track",
+            album_gain=album_rginfo["replaygain_album_gain"] if album else None,
+            album_peak=album_rginfo["replaygain_album_peak"] if album else None,
+            tracks=[ TrackResult(k, rginfo[k]["replaygain_track_gain"], rginfo[k]["replaygain_track_peak"], None, None)
+                     for k in self.filenames ],
+            error=None,
+            quarantined=[],
+            provisional=False,
+            album_gain_error=None,
+            drift=drift,
+            album_true_peak=None)
+
     def report(self) -> None:
         '''Report calculated replay gain tags.'''
         for k in self.filenames:
             track = self.RGTracks[k]
-            logger.info("Set track gain tags for %s:\n\tTrack Gain: %s\n\tTrack Peak: %s", track.filename, track.gain, track.peak)
+            logger.info("Set track gain tags for %s:\n\tTrack Gain: %s%s\n\tTrack Peak: %s", track.filename, track.gain,
+                        self._format_error(self.gain_errors.get(k)), track.peak)
         if self.want_album_gain():
-            logger.info("Set album gain tags for %s:\n\tAlbum Gain: %s\n\tAlbum Peak: %s", self.track_set_key_string(), self.gain, self.peak)
+            logger.info("Set album gain tags for %s:\n\tAlbum Gain: %s%s\n\tAlbum Peak: %s", self.track_set_key_string(), self.gain,
+                        self._format_error(self.album_gain_error), self.peak)
         else:
             logger.info("Did not set album gain tags for %s.", self.track_set_key_string())
 
+    def _format_error(self, error: Optional[float]) -> str:
+        if not self.provisional:
+            return ""
+        elif error is None:
+            return " (provisional estimate)"
+        else:
+            return " (provisional estimate, +/- {:.2f} dB)".format(error)
+
     def save(self) -> None:
         '''Save the calculated replaygain tags'''
         self.report()
@@ -579,14 +966,18 @@ def remove_redundant_paths(paths: Iterable[str]) -> Iterable[str]:
     Paths should be normalized before passing to this function.
 
     '''
-    seen_paths = set()          # type: Set[str]
-    # Sorting ensures that parent directories appear before children
-    for p in unique(sorted(paths)):
-        if any(is_subpath(p, seen) for seen in seen_paths):
+    def components(p: str) -> List[str]:
+        return p.rstrip(os.sep).split(os.sep)
+    # Sorting by components puts every path right after its parent
+    # directories and their other subpaths, so each path only needs
+    # to be compared with the last one kept
+    last = None                 # type: Optional[List[str]]
+    for p in sorted(set(paths), key=components):
+        parts = components(p)
+        if last is not None and parts[:len(last)] == last:
             continue
-        else:
-            yield p
-            seen_paths.add(p)
+        yield p
+        last = parts
 
 def is_music_file(file: str) -> bool:
     # Exists?
@@ -607,14 +998,34 @@ def is_music_file(file: str) -> bool:
     # OK!
     return True
 
-def get_all_music_files (paths: Iterable[str], ignore_hidden: bool = True) -> Iterable[MusicFileType]:
+def get_all_music_files (paths: Iterable[str], ignore_hidden: bool = True) -> Iterable['MusicFileType']:
     '''Recursively search in one or more paths for music files.
 
     By default, hidden files and directories are ignored.
 
     '''
-    paths = map(fullpath, paths)
-    for p in remove_redundant_paths(paths):
+    return open_music_files(find_candidate_files(paths, ignore_hidden))
+
+def open_music_files(candidates: Iterable[Tuple[str, bool]]) -> Iterator['MusicFileType']:
+    '''Open the music files among candidates, as yielded by find_candidate_files.'''
+    for (fname, explicit) in candidates:
+        if explicit:
+            logger.debug("Checking for music files at %s", repr(fname))
+            f = MusicFile(fname, easy=True)
+            if f is not None:
+                yield f
+        elif is_music_file(fname):
+            yield MusicFile(fname, easy=True)
+
+def find_candidate_files(paths: Iterable[str], ignore_hidden: bool = True) -> Iterator[Tuple[str, bool]]:
+    '''Recursively list the files in one or more paths, without opening them.
+
+    Yields (file name, explicit), where explicit is True for files
+    given directly in paths rather than found in a directory. By
+    default, hidden files and directories are ignored.
+
+    '''
+    for p in remove_redundant_paths(fullpaths(paths)):
         if os.path.isdir(p):
             files = []          # type: Iterable[str]
             for root, dirs, files in os.walk(p, followlinks=True):
@@ -623,11 +1034,15 @@ def get_all_music_files (paths: Iterable[str], ignore_hidden: bool = True) -> It
                     # Modify dirs in place to cut off os.walk
                     dirs[:] = list(remove_hidden_paths(dirs))
                     files = remove_hidden_paths(files)
-                files = filter(lambda f: is_music_file(os.path.join(root, f)), files)
                 for f in files:
-                    yield MusicFile(os.path.join(root, f), easy=True)
+                    yield (os.path.join(root, f), False)
         else:
-            logger.debug("Checking for music files at %s", repr(p))
-            f = MusicFile(p, easy=True)
-            if f is not None:
-                yield f
+            yield (p, True)
+
+def __getattr__(name: str) -> Any:
+    # rganalysis.api pulls in the execution engine, so it is only
+    # imported when it is used
+    if name == 'analyze':
+        from rganalysis.api import analyze
+        return analyze
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
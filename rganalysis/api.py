@@ -0,0 +1,246 @@
+'''Python API for analyzing music files.
+
+This provides the same functionality as the command-line program, but
+returns structured results instead of only logging them:
+
+    from rganalysis import analyze
+    for album in analyze(["~/Music"], backend="bs1770gain", jobs=4):
+        print(album.key, album.status, album.album_gain)
+
+To check a random sample of the existing tags instead, use audit:
+
+    from rganalysis.api import audit
+    report = audit(["~/Music"], rate=0.01)
+    print(report.drift_rate, [ r.key for r in report.drifted ])
+
+To analyze several batches of files without starting a new pool of
+workers each time, create a WorkerPool and pass it to each call:
+
+    from rganalysis.engine import WorkerPool
+    with WorkerPool(jobs=4) as pool:
+        for album in analyze(paths, pool=pool): ...
+
+'''
+
+from typing import Iterable, Iterator, Optional, Tuple, Union, cast
+
+import os.path
+import random
+
+from rganalysis import (
+    RGTrack, RGTrackDryRun, RGTrackSet, find_candidate_files, fullpath, fullpaths, open_music_files, unique
+)
+from rganalysis.backends import GainComputer, select_backend
+from rganalysis.cache import GainCache, CachingGainComputer
+from rganalysis.common import logger
+from rganalysis.profiling import staged
+from rganalysis.engine import AuditHandler, RetryPolicy, TrackSetHandler, WorkerPool, default_job_count
+from rganalysis.grouping import sort_by_directory
+from rganalysis.quarantine import SkipList
+from rganalysis.results import AlbumResult, AuditReport, DRIFTED, FAILED
+
+def make_gain_backend(backend: str = 'auto', gain_cache: Optional[str] = None,
+                      fast_estimate: Optional[Tuple[float, float]] = None,
+                      decode_jobs: Optional[int] = None) -> GainComputer:
+    '''Return the GainComputer for backend, wrapped in a gain cache if requested.
+
+    backend is a backend name, or "auto" to use the first available
+    backend. gain_cache is the path to a gain cache file, or None to
+    disable caching.
+
+    If fast_estimate is given, it is a tuple of (excerpt seconds,
+    interval seconds), and the estimate backend is used instead of
+    backend (see rganalysis.backends.estimate). The resulting tags are
+    marked as provisional in the files (see RGTrack.is_provisional).
+
+    If decode_jobs is given, the pipe backend reads its decoders'
+    output in that many processes, which pass the audio to the
+    analysis through shared memory (see rganalysis.transport). Other
+    backends ignore it.
+
+    '''
+    if fast_estimate is not None:
+        from rganalysis.backends.estimate import EstimateGainComputer
+        (name, gain_backend) = ('estimate', EstimateGainComputer(*fast_estimate))
+        logger.info("Estimating ReplayGain from %s seconds out of every %s seconds of audio", *fast_estimate)
+    else:
+        (name, gain_backend) = select_backend(backend)
+        logger.info("Using the %s backend to compute ReplayGain", name)
+    if decode_jobs is not None:
+        if name == 'pipe':
+            from rganalysis.backends.pipe import PipeGainComputer
+            pipe = cast(PipeGainComputer, gain_backend)
+            gain_backend = PipeGainComputer(pipe.decoders, pipe.jobs, pipe.read_size, decode_jobs)
+            logger.info("Decoding in %s processes per album", decode_jobs)
+        else:
+            logger.warning("Only the pipe backend can decode in separate processes, not the %s backend", name)
+    if gain_cache is not None:
+        logger.debug("Caching gain values in %s", gain_cache)
+        gain_backend = CachingGainComputer(gain_backend, name, GainCache(fullpath(gain_cache)))
+    return gain_backend
+
+def find_track_sets(paths: Iterable[str], gain_backend: GainComputer,
+                    include_hidden: bool = False, dry_run: bool = False,
+                    skip_list: Optional[SkipList] = None,
+                    max_files: Optional[int] = None) -> Iterator[RGTrackSet]:
+    '''Find music files in paths and group them into track sets.
+
+    Files in skip_list, if given, are left out. If paths are all
+    directories, each directory's track sets are yielded as soon as
+    it has been read. Otherwise, the file names are first sorted by
+    directory, keeping at most about max_files of them in memory if
+    it is given (see rganalysis.grouping).
+
+    '''
+    music_directories = list(unique(fullpaths(paths)))
+    if len(music_directories) <= 20:
+        logger.info("Searching for music files in the following locations:\n%s", "\n".join(music_directories),)
+    else:
+        logger.info("Searching for music files in %s locations", len(music_directories))
+    candidates = find_candidate_files(music_directories, ignore_hidden=(not include_hidden))
+    if not all(os.path.isdir(p) for p in music_directories):
+        # Explicit files may come in any order
+        candidates = sort_by_directory(candidates, max_files)
+    all_music_files = open_music_files(candidates)
+    if skip_list is not None:
+        all_music_files = ( f for f in all_music_files if not skip_list.should_skip(f.filename) )
+    track_constructor = RGTrackDryRun if dry_run else RGTrack
+    tracks = map(track_constructor, staged(all_music_files, 'discover'))
+    return staged(RGTrackSet.MakeTrackSets(tracks, gain_backend=gain_backend, ordered=True), 'group')
+
+def analyze(paths: Iterable[str],
+            backend: Union[str, GainComputer] = 'auto',
+            jobs: Optional[int] = None,
+            force: bool = False,
+            gain_type: str = 'auto',
+            dry_run: bool = False,
+            include_hidden: bool = False,
+            gain_cache: Optional[str] = None,
+            timeout_factor: float = 2.0,
+            retries: int = 2,
+            skip_list: Optional[str] = None,
+            min_jobs: Optional[int] = None,
+            max_read_rate: Optional[int] = None,
+            io_priority: str = 'normal',
+            io_order: str = 'walk',
+            true_peak: str = 'off',
+            fast_estimate: Optional[Tuple[float, float]] = None,
+            decode_jobs: Optional[int] = None,
+            pool: Optional[WorkerPool] = None) -> Iterator[AlbumResult]:
+    '''Add replaygain tags to the music files in paths.
+
+    Returns a generator of AlbumResult objects, one for each track
+    set found, yielded as soon as each track set has been processed.
+    Files and directories are discovered lazily as the generator is
+    consumed.
+
+    backend is the name of a backend (or "auto"), or a GainComputer
+    instance. If dry_run is True, files are analyzed but never
+    modified. gain_cache is the path of the gain cache file (see
+    rganalysis.cache), or None (the default) to use no cache.
+    timeout_factor and retries are passed to RetryPolicy. skip_list
+    is the path of the list of quarantined files (see
+    rganalysis.quarantine), or None (the default) to neither skip nor
+    quarantine any files. The locations used by the command-line
+    program are given by rganalysis.common.default_cache_path and
+    default_skip_list_path. fast_estimate and decode_jobs are passed
+    to make_gain_backend, and any results with provisional estimates
+    have provisional set to True. The other arguments
+    correspond to the options of the command-line program.
+
+    If pool is given, its workers are used and it is left open
+    afterwards; otherwise a new pool of jobs workers (by default, one
+    per CPU) is used for this call only, created with min_jobs,
+    max_read_rate, io_priority and io_order as described for
+    WorkerPool.
+
+    '''
+    if isinstance(backend, GainComputer):
+        gain_backend = backend
+    else:
+        gain_backend = make_gain_backend(backend, gain_cache, fast_estimate, decode_jobs)
+    skips = SkipList(skip_list) if skip_list is not None else None
+    track_sets = find_track_sets(paths, gain_backend, include_hidden=include_hidden,
+                                 dry_run=dry_run, skip_list=skips)
+    handler = TrackSetHandler(force=force, gain_type=gain_type, dry_run=dry_run, true_peak=true_peak)
+    policy = RetryPolicy(timeout_factor=timeout_factor, retries=retries)
+    try:
+        if pool is not None:
+            yield from pool.run(track_sets, handler, policy, skips)
+        else:
+            with WorkerPool(jobs or default_job_count(), min_jobs=min_jobs,
+                            max_read_rate=max_read_rate, io_priority=io_priority,
+                            io_order=io_order) as own_pool:
+                yield from own_pool.run(track_sets, handler, policy, skips)
+    finally:
+        # A dry run leaves every file alone, the skip list included
+        if skips is not None and not dry_run:
+            skips.save()
+
+def audit(paths: Iterable[str],
+          rate: float,
+          tolerance: float = 0.5,
+          backend: Union[str, GainComputer] = 'auto',
+          jobs: Optional[int] = None,
+          gain_type: str = 'auto',
+          include_hidden: bool = False,
+          seed: Optional[int] = None,
+          timeout_factor: float = 2.0,
+          retries: int = 2,
+          skip_list: Optional[str] = None,
+          min_jobs: Optional[int] = None,
+          max_read_rate: Optional[int] = None,
+          io_priority: str = 'normal',
+          io_order: str = 'walk',
+          decode_jobs: Optional[int] = None,
+          pool: Optional[WorkerPool] = None) -> AuditReport:
+    '''Check the accuracy of the replaygain tags of the music files in paths.
+
+    A stratified random sample of about a fraction rate of the track
+    sets with valid tags is reanalyzed, without modifying any files
+    or using the gain cache, and compared with the stored gain values
+    (see rganalysis.audit). Returns an AuditReport. seed, if given,
+    makes the sample reproducible. Files in skip_list are left out,
+    but it is not modified. The other arguments are as for analyze.
+
+    '''
+    from rganalysis.audit import estimate_drift_rate, stratified_sample, stratum
+    if not 0 < rate <= 1:
+        raise ValueError("The audit rate must be more than 0 and at most 1")
+    if isinstance(backend, GainComputer):
+        gain_backend = backend
+    else:
+        # Cached values would only be compared with themselves
+        gain_backend = make_gain_backend(backend, None, decode_jobs=decode_jobs)
+    skips = SkipList(skip_list) if skip_list is not None else None
+    track_sets = find_track_sets(paths, gain_backend, include_hidden=include_hidden,
+                                 dry_run=True, skip_list=skips)
+    (sample, population, untagged) = stratified_sample(track_sets, rate, random.Random(seed))
+    logger.info("Auditing %s of %s track sets with valid tags", len(sample), sum(population.values()))
+    strata = { ts.filenames[0]: stratum(ts) for ts in sample }
+    handler = AuditHandler(tolerance=tolerance, gain_type=gain_type)
+    policy = RetryPolicy(timeout_factor=timeout_factor, retries=retries)
+    # The skip list is only read: failures while auditing are not
+    # recorded in it
+    if pool is not None:
+        results = list(pool.run(sample, handler, policy))
+    else:
+        with WorkerPool(jobs or default_job_count(), min_jobs=min_jobs,
+                        max_read_rate=max_read_rate, io_priority=io_priority,
+                        io_order=io_order) as own_pool:
+            results = list(own_pool.run(sample, handler, policy))
+    stratified_results = [ (strata[r.tracks[0].filename], r) for r in results ]
+    (drift_rate, drift_rate_error) = estimate_drift_rate(population, stratified_results)
+    return AuditReport(
+        tolerance=tolerance,
+        population=sum(population.values()),
+        untagged=untagged,
+        sampled=len(results),
+        failed=sum(1 for r in results if r.status == FAILED),
+        drift_rate=drift_rate,
+        drift_rate_error=drift_rate_error,
+        strata={ h: (population[h],
+                     sum(1 for (s, r) in stratified_results if s == h),
+                     sum(1 for (s, r) in stratified_results if s == h and r.status == DRIFTED))
+                 for h in population },
+        drifted=sorted((r for r in results if r.status == DRIFTED), key=lambda r: r.directory))
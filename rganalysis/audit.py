@@ -0,0 +1,102 @@
+'''Checking the accuracy of existing ReplayGain tags by sampling.
+
+RGTrackSet.has_valid_rgdata only checks that tags are present and
+consistent. An audit re-analyzes a random sample of the albums that
+have valid tags, without modifying any files, and compares the
+results with the stored gain values. The fraction of drifted albums
+in the sample is extrapolated to the whole collection.
+
+The sample is stratified by file type, since tags that drift usually
+come from the same encoder or tagging tool: within each type, every
+album is selected independently with probability rate (and at least
+one album of each type is selected), and the estimate of the drift
+rate weights each type by its share of the collection.
+
+'''
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import math
+import random
+
+from collections import Counter
+
+from rganalysis import RGTrackSet
+from rganalysis.results import AlbumResult, DRIFTED, FAILED
+
+# Two-sided 95% quantile of the normal distribution
+Z_95 = 1.959964
+
+def stratum(track_set: RGTrackSet) -> str:
+    '''Return the stratum of track_set for sampling: its file type.'''
+    return track_set.track_set_key()[1]
+
+def stratified_sample(track_sets: Iterable[RGTrackSet], rate: float,
+                      rng: Optional[random.Random] = None) -> Tuple[List[RGTrackSet], Dict[str, int], int]:
+    '''Select a stratified random sample of the track sets with valid tags.
+
+    Returns the sample, the number of track sets with valid tags in
+    each stratum, and the number of track sets without valid tags,
+    which are not sampled. Only the sample is kept in memory, so this
+    works on collections of any size.
+
+    '''
+    rng = rng or random.Random()
+    sample = {}                 # type: Dict[str, List[RGTrackSet]]
+    # The track set with the lowest draw of each stratum, in case
+    # none is selected
+    fallback = {}               # type: Dict[str, Tuple[float, RGTrackSet]]
+    population = Counter()      # type: Dict[str, int]
+    untagged = 0
+    for ts in track_sets:
+        if not ts.has_valid_rgdata():
+            untagged += 1
+            continue
+        h = stratum(ts)
+        population[h] += 1
+        u = rng.random()
+        if u < rate:
+            sample.setdefault(h, []).append(ts)
+        elif h not in sample and (h not in fallback or u < fallback[h][0]):
+            fallback[h] = (u, ts)
+    for h in population:
+        if h not in sample:
+            sample[h] = [ fallback[h][1] ]
+    return ([ ts for h in sorted(sample) for ts in sample[h] ], dict(population), untagged)
+
+def estimate_drift_rate(population: Dict[str, int],
+                        results: Iterable[Tuple[str, AlbumResult]]) -> Tuple[float, float]:
+    '''Estimate the fraction of drifted track sets in the population.
+
+    results holds the stratum and result of each sampled track set;
+    failed ones are left out, as are strata in which every track set
+    failed. Returns the estimate and the half-width of its approximate
+    95% confidence interval.
+
+    '''
+    sampled = Counter()         # type: Dict[str, int]
+    drifted = Counter()         # type: Dict[str, int]
+    for (h, result) in results:
+        if result.status == FAILED:
+            continue
+        sampled[h] += 1
+        if result.status == DRIFTED:
+            drifted[h] += 1
+    total = sum(size for (h, size) in population.items() if sampled[h])
+    if total == 0:
+        return (0.0, 0.0)
+    (rate, variance) = (0.0, 0.0)
+    for (h, size) in population.items():
+        n = sampled[h]
+        if n == 0:
+            continue
+        weight = size / total
+        p = drifted[h] / n
+        rate += weight * p
+        if n > 1:
+            variance += weight ** 2 * (1 - n / size) * p * (1 - p) / (n - 1)
+        else:
+            # The spread cannot be estimated from one track set, so
+            # assume the worst case
+            variance += weight ** 2 * (1 - n / size) * 0.25
+    return (rate, Z_95 * math.sqrt(variance))
@@ -1,4 +1,4 @@
-from typing import Dict, Iterable
+from typing import Dict, Iterable, List, Optional, Tuple
 
 from abc import ABCMeta, abstractmethod
 from importlib import import_module
@@ -8,6 +8,17 @@ from rganalysis.common import logger
 class BackendUnavailableException(Exception):
     pass
 
+class TruePeakUnsupportedException(Exception):
+    pass
+
+# Reference levels of the gain values that backends compute: RG1_REFERENCE
+# for the original ReplayGain loudness model, RG2_REFERENCE for ITU-R
+# BS.1770 loudness relative to -18 LUFS (ReplayGain 2.0). The two
+# models weigh the audio differently, so their gains for the same track
+# differ by an amount that depends on the music.
+RG1_REFERENCE = "89 dB"
+RG2_REFERENCE = "-18 LUFS"
+
 class GainComputer(metaclass=ABCMeta):
     '''Abstract base class for gain-computing backends.
 
@@ -28,8 +39,17 @@ class GainComputer(metaclass=ABCMeta):
 
     '''
 
+    # True for backends that only estimate gain, whose results should
+    # later be replaced by a full analysis
+    provisional = False
+
+    # Reference level of the computed gains (RG1_REFERENCE or
+    # RG2_REFERENCE), or None if unknown
+    reference = None            # type: Optional[str]
+
     @abstractmethod
-    def compute_gain(self, fnames: Iterable[str], album: bool = True) -> Dict[str, Dict[str, float]]:
+    def compute_gain(self, fnames: Iterable[str], album: bool = True,
+                     true_peak: bool = False) -> Dict[str, Dict[str, float]]:
         '''Compute gain for files.
 
         Should return a nested dict, where the outer keys are file
@@ -44,6 +64,13 @@ class GainComputer(metaclass=ABCMeta):
         but they will be ignored. (In particular, it's ok for a
         backend to ignore album=False and compute album gain anyway.)
 
+        If true_peak is True, the tags should also include
+        "replaygain_track_true_peak" (and "replaygain_album_true_peak"
+        if album is True), holding the true (inter-sample) peak,
+        measured in the same pass as the other values. Backends that
+        cannot measure true peak should raise
+        TruePeakUnsupportedException.
+
         This is an abstract method that must be implemented by any
         subclass.
 
@@ -53,6 +80,31 @@ class GainComputer(metaclass=ABCMeta):
     def supports_file(self, fname: str) -> bool:
         raise NotImplementedError("This method should be overridden in a subclass")
 
+    def is_provisional(self, fnames: Iterable[str]) -> bool:
+        '''Return True if any of fnames has provisional (estimated) tags.
+
+        Track sets with provisional tags are reanalyzed even if their
+        tags are valid. Only backends that keep track of estimates
+        (see rganalysis.cache) return True.
+
+        '''
+        return False
+
+    def tags_saved(self, rginfo: Dict[str, Dict[str, float]]) -> None:
+        '''Called with the result of compute_gain once it has been saved to the files.'''
+        pass
+
+    def result_source(self, fnames: List[str], true_peak: bool = False) -> Optional[str]:
+        '''Return the name of the backend that computes the gain of fnames, if not this one.
+
+        Backends that hand files to other backends (like the routing
+        backend) return that backend's name, so that the gain cache
+        (see rganalysis.cache) keeps results apart by the backend
+        that actually computed them. Others return None.
+
+        '''
+        return None
+
 backends = {}                   # type: Dict[str, GainComputer]
 
 def register_backend(name: str, obj: GainComputer) -> None:
@@ -85,9 +137,41 @@ def get_backend(name: str) -> GainComputer:
         except KeyError:
             raise BackendUnavailableException("Module {modname} was imported, but did not register a backend named {name}".format(**locals()))
 
+_auto_backend = None            # type: Optional[Tuple[str, GainComputer]]
+
+def select_backend(name: str = 'auto') -> Tuple[str, GainComputer]:
+    '''Return the name and GainComputer instance for NAME.
+
+    If NAME is "auto", the first usable backend in known_backends is
+    returned. The routing backend (see rganalysis.backends.route) is
+    never chosen automatically, since the reference level of its gains
+    depends on the backends installed. Raises
+    BackendUnavailableException if the requested backend (or, for
+    "auto", every known backend) is unavailable.
+
+    Probing for a backend imports its dependencies, so this is only
+    done the first time a backend is needed, and the result of
+    probing for "auto" is remembered.
+
+    '''
+    global _auto_backend
+    if name != 'auto':
+        return (name, get_backend(name))
+    if _auto_backend is None:
+        for bname in known_backends:
+            try:
+                _auto_backend = (bname, get_backend(bname))
+                break
+            except BackendUnavailableException:
+                pass
+        else:
+            raise BackendUnavailableException("Could not find any usable backends.")
+    return _auto_backend
+
 class NullGainComputer(GainComputer):
     '''The null gain computer supports no files.'''
-    def compute_gain(self, fnames: Iterable[str], album: bool = True) -> Dict[str, Dict[str, float]]:
+    def compute_gain(self, fnames: Iterable[str], album: bool = True,
+                     true_peak: bool = False) -> Dict[str, Dict[str, float]]:
         try:
             next(iter(fnames))
             raise Exception("Unimplemented")
@@ -102,4 +186,4 @@ class NullGainComputer(GainComputer):
 register_backend('null', NullGainComputer())
 
 # Used to select a backend for  '--backend=auto'
-known_backends = ('audiotools', 'bs1770gain')
+known_backends = ('audiotools', 'bs1770gain', 'native', 'pipe')
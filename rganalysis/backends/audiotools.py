@@ -1,7 +1,9 @@
-from typing import Dict, Iterable
+from typing import Any, Callable, Dict, Iterable
+
+from functools import partial
 
 from rganalysis.common import logger
-from rganalysis.backends import GainComputer, register_backend, BackendUnavailableException
+from rganalysis.backends import GainComputer, register_backend, BackendUnavailableException, TruePeakUnsupportedException, RG1_REFERENCE
 
 try:
     import audiotools
@@ -9,12 +11,46 @@ try:
 except ImportError as ex:
     raise BackendUnavailableException("Unable to use the audiotools backend: Could not load audiotools module. ")
 
+class TruePeakPCMReader(object):
+    '''Wraps an audiotools PCMReader, metering true peak as it is read.'''
+    def __init__(self, pcmreader: Any, meter: Any) -> None:
+        self.pcmreader = pcmreader
+        self.meter = meter
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.pcmreader, name)
+
+    def read(self, pcm_frames: int) -> Any:
+        from rganalysis.dsp import pcm_to_float
+        framelist = self.pcmreader.read(pcm_frames)
+        if framelist.frames:
+            self.meter.update(pcm_to_float(framelist.to_bytes(False, True),
+                                           framelist.bits_per_sample, framelist.channels))
+        return framelist
+
+def _metered_to_pcm(to_pcm: Callable, meter: Any) -> TruePeakPCMReader:
+    return TruePeakPCMReader(to_pcm(), meter)
+
 class AudiotoolsGainComputer(GainComputer):
-    def compute_gain(self, fnames: Iterable[str], album: bool = True) -> Dict[str, Dict[str, float]]:
+    reference = RG1_REFERENCE
+
+    def compute_gain(self, fnames: Iterable[str], album: bool = True,
+                     true_peak: bool = False) -> Dict[str, Dict[str, float]]:
         fnames = list(fnames)
         audio_files = audiotools.open_files(fnames)
         if len(audio_files) != len(fnames):
             raise Exception("Could not load some files")
+        meters = {}             # type: Dict[str, Any]
+        if true_peak:
+            try:
+                from rganalysis.dsp import TruePeakMeter
+            except ImportError:
+                raise TruePeakUnsupportedException("True peak measurement with the audiotools backend requires numpy.")
+            for af in audio_files:
+                # calculate_replay_gain decodes each file exactly once
+                # through to_pcm, so the meter sees the same decode pass
+                meter = meters[af.filename] = TruePeakMeter()
+                af.to_pcm = partial(_metered_to_pcm, af.to_pcm, meter)
         rginfo = {}
         tag_order = (
             "replaygain_track_gain",
@@ -24,6 +60,11 @@ class AudiotoolsGainComputer(GainComputer):
         )
         for rg in audiotools.calculate_replay_gain(audio_files):
             rginfo[rg[0].filename] = dict(zip(tag_order, rg[1:]))
+        if true_peak:
+            album_true_peak = max(m.peak for m in meters.values())
+            for (fname, meter) in meters.items():
+                rginfo[fname]["replaygain_track_true_peak"] = meter.peak
+                rginfo[fname]["replaygain_album_true_peak"] = album_true_peak
         return rginfo
 
     def supports_file(self, fname: str) -> bool:
@@ -10,7 +10,7 @@ from subprocess import Popen, PIPE, check_output, CalledProcessError
 from xml.sax.saxutils import quoteattr
 
 from rganalysis.common import logger
-from rganalysis.backends import GainComputer, register_backend, BackendUnavailableException
+from rganalysis.backends import GainComputer, register_backend, BackendUnavailableException, RG2_REFERENCE
 
 try:
     from lxml import etree
@@ -22,12 +22,18 @@ if not bs1770gain_path:
     raise BackendUnavailableException("Unable to use the bs1770gain backend: could not find bs1770gain executable in $PATH. To use this backend, ensure bs1770gain is in your $PATH or set BS1770GAIN_PATH environment variable to the path of the bs1770gain executable.")
 
 class Bs1770gainGainComputer(GainComputer):
-    def compute_gain(self, fnames: Iterable[str], album: bool = True) -> Dict[str, Dict[str, float]]:
+    reference = RG2_REFERENCE
+
+    def compute_gain(self, fnames: Iterable[str], album: bool = True,
+                     true_peak: bool = False) -> Dict[str, Dict[str, float]]:
         fnames = list(fnames)
         basenames_to_fnames = { os.path.basename(f): f for f in fnames }
         if len(basenames_to_fnames) != len(fnames):
             raise ValueError("The bs1770gain backend cannot handle multiple files with the same basename.")
-        cmd = [bs1770gain_path, '--replaygain', '--integrated', '--samplepeak', '--xml', ] + fnames
+        # bs1770gain measures true peak itself (with 4x oversampling)
+        # in the same pass
+        peak_args = ['--samplepeak', '--truepeak'] if true_peak else ['--samplepeak']
+        cmd = [bs1770gain_path, '--replaygain', '--integrated', ] + peak_args + ['--xml', ] + fnames
         logger.debug("Running command: %s", repr(cmd))
         p = Popen(cmd, stdout=PIPE)
         xml_text = p.communicate()[0].decode(sys.getdefaultencoding())
@@ -38,6 +44,8 @@ class Bs1770gainGainComputer(GainComputer):
         ainfo = tree.xpath("/bs1770gain/album/summary")[0]
         album_gain = float(ainfo.xpath("./integrated/@lu")[0])
         album_peak = float(ainfo.xpath("./sample-peak/@factor")[0])
+        if true_peak:
+            album_true_peak = float(ainfo.xpath("./true-peak/@factor")[0])
         tracks = tree.xpath("/bs1770gain/album/track")
         rginfo = {}
         for tinfo in tracks:
@@ -50,6 +58,11 @@ class Bs1770gainGainComputer(GainComputer):
                 "replaygain_album_gain": album_gain,
                 "replaygain_album_peak": album_peak,
             }
+            if true_peak:
+                rginfo[basenames_to_fnames[track_name]].update({
+                    "replaygain_track_true_peak": float(tinfo.xpath("./true-peak/@factor")[0]),
+                    "replaygain_album_true_peak": album_true_peak,
+                })
         return rginfo
 
     def supports_file(self, fname: str) -> bool:
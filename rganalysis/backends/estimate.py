@@ -0,0 +1,146 @@
+'''Fast, approximate gain estimates from excerpts of each track.
+
+Rather than decoding every sample, the estimate backend decodes
+evenly spaced excerpts (by default 10 seconds out of every 60),
+seeking past the rest, and measures their loudness as described in
+ITU-R BS.1770 (see rganalysis.dsp). This gives usable gain values for
+a large collection in a fraction of the time of a full analysis.
+
+Along with each gain, it returns the half-width of an approximate 95%
+confidence interval for it, in dB, as "replaygain_track_gain_error"
+and "replaygain_album_gain_error". The excerpts are treated as a
+random sample of all the excerpt-length windows of the audio: the
+interval follows from the spread of the excerpts' gated loudness,
+with a finite population correction for the fraction of the audio
+that was decoded (so it is 0 when everything was decoded). For the
+album, the excerpts of all tracks are pooled.
+
+Since the peak is only measured over the excerpts, it may be lower
+than the actual peak.
+
+Results are provisional: the uncertainty of the gain is saved in
+the replaygain_track_gain_error and replaygain_album_gain_error tags,
+which mark the tags as estimates, and a later run without estimates
+reanalyzes them even though they have valid tags. The gain cache
+also records which files were given estimated tags.
+
+This backend is not registered, as it needs the excerpt parameters.
+Requires numpy and scipy, and ffmpeg for formats other than WAV.
+
+'''
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import math
+
+from rganalysis.backends import GainComputer, BackendUnavailableException, RG2_REFERENCE
+
+try:
+    import numpy as np
+    import scipy.signal
+except ImportError:
+    raise BackendUnavailableException("Unable to use the estimate backend: numpy and scipy are required.")
+
+from rganalysis.dsp import LoudnessMeter, TruePeakMeter, gated_blocks, integrated_loudness, loudness_to_gain
+from rganalysis.pcm import can_decode, excerpt_ranges, open_pcm
+
+# Two-sided 95% quantile of the normal distribution
+Z_95 = 1.959964
+
+def confidence_interval(segment_blocks: List[np.ndarray], sampled_fraction: float) -> Optional[float]:
+    '''Return the 95% confidence half-width in dB of the loudness of segments.
+
+    segment_blocks holds the block powers of each excerpt, and
+    sampled_fraction is the fraction of all the audio that the
+    excerpts cover. Returns None if there are too few excerpts to
+    estimate the spread.
+
+    '''
+    if sampled_fraction >= 1:
+        return 0.0
+    if not segment_blocks:
+        return None
+    mask = gated_blocks(np.concatenate(segment_blocks))
+    powers = []
+    pos = 0
+    for blocks in segment_blocks:
+        seg_mask = mask[pos:pos + len(blocks)]
+        pos += len(blocks)
+        powers.append(float(blocks[seg_mask].mean()) if seg_mask.any() else 0.0)
+    n = len(powers)
+    mean = sum(powers) / n if n else 0.0
+    if n < 2 or mean <= 0:
+        return None
+    stderr = float(np.std(powers, ddof=1)) / math.sqrt(n) * math.sqrt(1 - sampled_fraction)
+    return Z_95 * 10 / math.log(10) * stderr / mean
+
+class EstimateGainComputer(GainComputer):
+    '''Estimates gain from excerpt_seconds of audio out of every interval_seconds.'''
+
+    provisional = True
+    reference = RG2_REFERENCE
+
+    def __init__(self, excerpt_seconds: float = 10.0, interval_seconds: float = 60.0) -> None:
+        if not 0 < excerpt_seconds <= interval_seconds:
+            raise ValueError("Excerpts must be at least 0 seconds and no longer than the interval between them")
+        self.excerpt_seconds = excerpt_seconds
+        self.interval_seconds = interval_seconds
+
+    def __repr__(self) -> str:
+        return "EstimateGainComputer({!r}, {!r})".format(self.excerpt_seconds, self.interval_seconds)
+
+    def measure(self, fname: str, true_peak: bool = False) -> Tuple[LoudnessMeter, Optional[TruePeakMeter], int, int]:
+        '''Measure the excerpts of fname.
+
+        Returns the loudness meter, with one segment per excerpt, the
+        true peak meter (if true_peak is True), the number of frames
+        decoded and the total number of frames.
+
+        '''
+        source = open_pcm(fname)
+        try:
+            meter = LoudnessMeter(source.sample_rate, source.channels)
+            tp_meter = TruePeakMeter() if true_peak else None
+            decoded = 0
+            for (start, count) in excerpt_ranges(source.frames, source.sample_rate,
+                                                 self.excerpt_seconds, self.interval_seconds):
+                samples = source.read(start, count)
+                meter.update(samples)
+                meter.reset()
+                if tp_meter is not None:
+                    tp_meter.update(samples)
+                decoded += len(samples)
+            return (meter, tp_meter, decoded, max(source.frames, decoded, 1))
+        finally:
+            source.close()
+
+    def compute_gain(self, fnames: Iterable[str], album: bool = True,
+                     true_peak: bool = False) -> Dict[str, Dict[str, float]]:
+        fnames = list(fnames)
+        rginfo = {}
+        measurements = { f: self.measure(f, true_peak) for f in fnames }
+        for (fname, (meter, tp_meter, decoded, frames)) in measurements.items():
+            rginfo[fname] = {
+                "replaygain_track_gain": loudness_to_gain(integrated_loudness(meter.blocks)),
+                "replaygain_track_peak": meter.peak,
+                "replaygain_track_gain_error": confidence_interval(meter.segment_blocks, decoded / frames),
+            }
+            if tp_meter is not None:
+                rginfo[fname]["replaygain_track_true_peak"] = tp_meter.peak
+        if album and fnames:
+            all_segments = [ b for (meter, _, _, _) in measurements.values() for b in meter.segment_blocks ]
+            decoded = sum(m[2] for m in measurements.values())
+            frames = sum(m[3] for m in measurements.values())
+            album_tags = {
+                "replaygain_album_gain": loudness_to_gain(integrated_loudness(np.concatenate(all_segments) if all_segments else np.zeros(0))),
+                "replaygain_album_peak": max(m[0].peak for m in measurements.values()),
+                "replaygain_album_gain_error": confidence_interval(all_segments, decoded / frames),
+            }
+            if true_peak:
+                album_tags["replaygain_album_true_peak"] = max(m[1].peak for m in measurements.values())
+            for tags in rginfo.values():
+                tags.update(album_tags)
+        return rginfo
+
+    def supports_file(self, fname: str) -> bool:
+        return can_decode(fname)
@@ -0,0 +1,56 @@
+'''Gain computation in Python for uncompressed files, without a decoder.
+
+WAV, Wave64 and AIFF files are memory-mapped (see
+rganalysis.pcm.MappedPCMSource) and their samples are measured
+directly from the mapped pages as described in ITU-R BS.1770 (see
+rganalysis.dsp), block by block, so no audio passes through a
+decoder, a pipe or an intermediate buffer holding the whole file.
+Gain values follow ReplayGain 2.0 (-18 LUFS reference), like the
+bs1770gain backend.
+
+Requires numpy and scipy. Compressed formats are not supported.
+
+'''
+
+from typing import Dict, Iterable
+
+from rganalysis.backends import GainComputer, register_backend, BackendUnavailableException, RG2_REFERENCE
+
+try:
+    import numpy as np
+    import scipy.signal
+except ImportError:
+    raise BackendUnavailableException("Unable to use the native backend: numpy and scipy are required.")
+
+from rganalysis.dsp import LoudnessMeter, TruePeakMeter, replaygain_info
+from rganalysis.pcm import MappedPCMSource, uncompressed_layout
+
+class NativeGainComputer(GainComputer):
+    reference = RG2_REFERENCE
+
+    def compute_gain(self, fnames: Iterable[str], album: bool = True,
+                     true_peak: bool = False) -> Dict[str, Dict[str, float]]:
+        fnames = list(fnames)
+        meters = {}
+        tp_meters = {}
+        for fname in fnames:
+            source = MappedPCMSource(fname)
+            try:
+                meter = meters[fname] = LoudnessMeter(source.sample_rate, source.channels)
+                if true_peak:
+                    tp_meters[fname] = TruePeakMeter()
+                for block in source.blocks():
+                    meter.update(block)
+                    if true_peak:
+                        tp_meters[fname].update(block)
+            finally:
+                source.close()
+        return replaygain_info(meters, tp_meters if true_peak else None, album)
+
+    def supports_file(self, fname: str) -> bool:
+        try:
+            return uncompressed_layout(fname) is not None
+        except OSError:
+            return False
+
+register_backend('native', NativeGainComputer())
@@ -0,0 +1,242 @@
+'''Gain computation in Python on raw PCM from external decoders.
+
+For each track, the pipe backend runs a decoder program (e.g. "flac
+-d", ffmpeg or sox) that writes the decoded audio as raw PCM to its
+standard output, reads it in large fixed-size chunks and measures it
+as described in ITU-R BS.1770 (see rganalysis.dsp), as the native
+backend does for uncompressed files. Unlike bs1770gain, the analysis
+happens in this process, so the measurements are the same as those
+of the native backend whatever the format. The decoders of several
+tracks of an album run at the same time, each read by its own
+thread.
+
+Alternatively, with decode_jobs (--decode-jobs), the decoders are
+read, and their output converted to floating point, by that many
+decoder processes, which pass the samples to the analysis through
+shared memory (see rganalysis.transport). The analyzing process then
+only measures the blocks as they arrive, for all tracks of the album
+at once, so decoding and analysis use separate cores and each can
+be given as many as it needs.
+
+The decoder for each file name extension is the first available one
+in DEFAULT_DECODERS, and can be configured by setting
+RGANALYSIS_DECODERS to the name of a JSON file that maps extensions
+(or "*", for any other extension) to a decoder:
+
+    {".flac": {"command": ["flac", "-dcs", "--force-raw-format",
+                           "--endian=little", "--sign=signed", "{file}"],
+               "format": "s{bits}le"}}
+
+In the command, "{file}" is replaced by the file name, and "{rate}",
+"{channels}" and "{bits}" by the file's sample rate, number of
+channels and bits per sample, as read by mutagen. The decoder must
+write interleaved samples at that rate and number of channels, in
+the given format: "s" (signed), "u" (unsigned) or "f" (floating
+point), the bits per sample, and "le" or "be", which may also
+contain "{bits}".
+
+Requires numpy and scipy.
+
+'''
+
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import json
+import os
+import re
+import tempfile
+
+from multiprocessing.pool import ThreadPool
+from shutil import which
+from subprocess import DEVNULL, PIPE, CalledProcessError, Popen
+
+from rganalysis import MusicFile
+from rganalysis.common import logger
+from rganalysis.backends import GainComputer, register_backend, BackendUnavailableException, RG2_REFERENCE
+
+try:
+    import numpy as np
+    import scipy.signal
+except ImportError:
+    raise BackendUnavailableException("Unable to use the pipe backend: numpy and scipy are required.")
+
+from rganalysis.dsp import LoudnessMeter, TruePeakMeter, pcm_to_float, replaygain_info
+
+Decoder = NamedTuple('Decoder', [
+    ('command', List[str]),
+    ('format', str),
+])
+Decoder.__doc__ = '''A decoder command and the format of the PCM it writes.'''
+
+# Decoders by extension, in order of preference. The first one whose
+# program is installed is used for each extension.
+DEFAULT_DECODERS = (
+    ('.flac', Decoder(['flac', '-dcs', '--force-raw-format', '--endian=little', '--sign=signed', '{file}'], 's{bits}le')),
+    ('*', Decoder(['ffmpeg', '-nostdin', '-v', 'error', '-i', '{file}', '-f', 'f32le', '-acodec', 'pcm_f32le',
+                   '-ac', '{channels}', '-ar', '{rate}', '-'], 'f32le')),
+    ('*', Decoder(['sox', '{file}', '-t', 'raw', '-e', 'floating-point', '-b', '32', '-L', '-'], 'f32le')),
+)
+
+# Size of each read from a decoder, in bytes
+READ_SIZE = 1 << 20
+
+_sample_format = re.compile(r'^([suf])(8|16|24|32|64)(le|be)?$')
+
+def parse_sample_format(fmt: str) -> Tuple[int, bool, bool, bool]:
+    '''Parse a format like "s16le" into (bits, signed, is_float, big_endian).'''
+    m = _sample_format.match(fmt.lower())
+    if not m:
+        raise ValueError("Unknown sample format: {!r}".format(fmt))
+    (kind, bits, endian) = m.groups()
+    return (int(bits), kind != 'u', kind == 'f', endian == 'be')
+
+def load_decoders(path: Optional[str] = None) -> Dict[str, Decoder]:
+    '''Return the decoder for each extension.
+
+    These are the available DEFAULT_DECODERS, overridden by those in
+    the JSON file at path, or at $RGANALYSIS_DECODERS if path is
+    None.
+
+    '''
+    decoders = {}               # type: Dict[str, Decoder]
+    for (ext, decoder) in DEFAULT_DECODERS:
+        if ext not in decoders and which(decoder.command[0]):
+            decoders[ext] = decoder
+    path = path or os.getenv("RGANALYSIS_DECODERS")
+    if path:
+        with open(path) as f:
+            for (ext, config) in json.load(f).items():
+                decoder = Decoder(list(config["command"]), config["format"])
+                if not which(decoder.command[0]):
+                    logger.warning("Decoder %s for %s files is not installed", repr(decoder.command[0]), ext)
+                decoders[ext.lower()] = decoder
+    return decoders
+
+class PipeGainComputer(GainComputer):
+    '''Measures the PCM that external decoders write to a pipe.
+
+    decoders maps extensions (and "*") to Decoders, and up to jobs
+    decoders run at the same time. If decode_jobs is given, the
+    decoders' output is read by that many processes instead of by
+    threads of this process (see rganalysis.transport).
+
+    '''
+    reference = RG2_REFERENCE
+
+    def __init__(self, decoders: Dict[str, Decoder], jobs: int = 4, read_size: int = READ_SIZE,
+                 decode_jobs: Optional[int] = None) -> None:
+        self.decoders = decoders
+        self.jobs = jobs
+        self.read_size = read_size
+        self.decode_jobs = decode_jobs
+
+    def __repr__(self) -> str:
+        return "PipeGainComputer({!r}, jobs={!r}, decode_jobs={!r})".format(sorted(self.decoders), self.jobs, self.decode_jobs)
+
+    def decoder_for(self, fname: str) -> Optional[Decoder]:
+        return self.decoders.get(os.path.splitext(fname)[1].lower(), self.decoders.get('*'))
+
+    def file_params(self, fname: str) -> Dict[str, Any]:
+        '''Return the parameters of fname for the decoder command.'''
+        info = MusicFile(fname).info
+        return {
+            'file': fname,
+            'rate': int(getattr(info, 'sample_rate', 0) or 44100),
+            'channels': int(getattr(info, 'channels', 0) or 2),
+            'bits': int(getattr(info, 'bits_per_sample', 0) or 16),
+        }
+
+    def decode(self, fname: str, params: Optional[Dict[str, Any]] = None) -> Iterator[Tuple[int, np.ndarray]]:
+        '''Run the decoder for fname, and yield (sample rate, samples) for each block it writes.
+
+        params are those of file_params, which are read again if not
+        given. Raises CalledProcessError if the decoder fails.
+
+        '''
+        decoder = self.decoder_for(fname)
+        if decoder is None:
+            raise ValueError("No decoder for {!r}".format(fname))
+        params = params or self.file_params(fname)
+        cmd = [ arg.format(**params) for arg in decoder.command ]
+        (bits, signed, is_float, big_endian) = parse_sample_format(decoder.format.format(**params))
+        (rate, channels) = (params['rate'], params['channels'])
+        frame_size = channels * bits // 8
+        read_size = max(frame_size, self.read_size - self.read_size % frame_size)
+        logger.debug("Running command: %s", repr(cmd))
+        # Errors go to a file rather than a pipe, which could fill up
+        # and block the decoder while only stdout is being read
+        with tempfile.TemporaryFile() as stderr:
+            p = Popen(cmd, stdin=DEVNULL, stdout=PIPE, stderr=stderr)
+            try:
+                while True:
+                    data = p.stdout.read(read_size)
+                    if not data:
+                        break
+                    if len(data) % frame_size:
+                        data = data[:len(data) - len(data) % frame_size]
+                    yield (rate, pcm_to_float(data, bits, channels, signed=signed,
+                                              big_endian=big_endian, is_float=is_float))
+            except BaseException:
+                p.kill()
+                raise
+            finally:
+                p.stdout.close()
+                p.wait()
+            if p.returncode != 0:
+                stderr.seek(0)
+                raise CalledProcessError(p.returncode, cmd, None, stderr.read())
+
+    def measure(self, fname: str, true_peak: bool = False) -> Tuple[LoudnessMeter, Optional[TruePeakMeter]]:
+        '''Decode fname and return its LoudnessMeter (and TruePeakMeter, if true_peak).'''
+        params = self.file_params(fname)
+        meter = LoudnessMeter(params['rate'], params['channels'])
+        tp_meter = TruePeakMeter() if true_peak else None
+        for (_, samples) in self.decode(fname, params):
+            meter.update(samples)
+            if tp_meter is not None:
+                tp_meter.update(samples)
+        return (meter, tp_meter)
+
+    def measure_in_processes(self, fnames: List[str], true_peak: bool = False
+                             ) -> List[Tuple[LoudnessMeter, Optional[TruePeakMeter]]]:
+        '''Like measure for each of fnames, but decoded by decode_jobs processes.
+
+        The blocks of all files are measured in this process as they
+        arrive, straight from shared memory.
+
+        '''
+        from rganalysis.transport import decode_in_processes
+        meters = {}             # type: Dict[str, LoudnessMeter]
+        for fname in fnames:
+            params = self.file_params(fname)
+            meters[fname] = LoudnessMeter(params['rate'], params['channels'])
+        tp_meters = { f: TruePeakMeter() if true_peak else None for f in fnames }
+        for (fname, block) in decode_in_processes(fnames, self.decode, self.decode_jobs or 1):
+            if block is not None:
+                meters[fname].update(block[1])
+                tp_meter = tp_meters[fname]
+                if tp_meter is not None:
+                    tp_meter.update(block[1])
+        return [ (meters[f], tp_meters[f]) for f in fnames ]
+
+    def compute_gain(self, fnames: Iterable[str], album: bool = True,
+                     true_peak: bool = False) -> Dict[str, Dict[str, float]]:
+        fnames = list(fnames)
+        if self.decode_jobs:
+            measured = self.measure_in_processes(fnames, true_peak)
+        elif len(fnames) <= 1 or self.jobs <= 1:
+            measured = [ self.measure(f, true_peak) for f in fnames ]
+        else:
+            with ThreadPool(min(self.jobs, len(fnames))) as pool:
+                measured = pool.map(lambda f: self.measure(f, true_peak), fnames)
+        meters = { f: m for (f, (m, _)) in zip(fnames, measured) }
+        tp_meters = { f: tp for (f, (_, tp)) in zip(fnames, measured) } if true_peak else None
+        return replaygain_info(meters, tp_meters, album) # type: ignore
+
+    def supports_file(self, fname: str) -> bool:
+        return self.decoder_for(fname) is not None
+
+_decoders = load_decoders()
+if not _decoders:
+    raise BackendUnavailableException("Unable to use the pipe backend: no decoder is installed. Install ffmpeg, sox or flac, or configure decoders with $RGANALYSIS_DECODERS.")
+register_backend('pipe', PipeGainComputer(_decoders, jobs=min(4, os.cpu_count() or 1)))
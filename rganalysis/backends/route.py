@@ -0,0 +1,281 @@
+'''A backend that sends each track set to the fastest backend for its format.
+
+Backends differ a lot in speed from one file format to another (e.g.
+the native backend reads WAV files without decoding them, while
+bs1770gain goes through ffmpeg for everything). The routing backend
+looks up each track set's format (its file name extension) in a
+calibration table and uses the fastest available backend that
+supports all of its files. A whole track set always goes to the same
+backend, so that its track and album gains are consistent.
+
+Gains computed with different loudness models cannot be mixed in one
+library, so only backends with the same reference level (see
+GainComputer.reference) are used: those of the largest group of
+available backends, preferring the group of the first of
+known_backends in a tie. Since which group that is depends on the
+backends installed, routing is only used when asked for with
+"--backend=route", never by "--backend=auto".
+
+The calibration table is built by calibrate, which times every
+available backend on a short synthetic sample in each format (see
+"rganalysis --calibrate-backends"), and kept as JSON in the cache
+directory. Without a table, backends are tried in the order of
+known_backends. The other backends are only probed, and the table
+only read, once the routing backend is first used.
+
+'''
+
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import json
+import math
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import wave
+
+from array import array
+
+from rganalysis.common import logger, default_calibration_path
+from rganalysis.backends import (
+    GainComputer, register_backend, get_backend, known_backends,
+    BackendUnavailableException, TruePeakUnsupportedException
+)
+
+# Formats that calibrate tries, as (extension, ffmpeg arguments)
+CALIBRATION_FORMATS = (
+    ('.wav', None),
+    ('.flac', ['-c:a', 'flac']),
+    ('.mp3', ['-c:a', 'libmp3lame', '-b:a', '192k']),
+    ('.m4a', ['-c:a', 'aac', '-b:a', '192k']),
+    ('.ogg', ['-c:a', 'libvorbis', '-q:a', '5']),
+    ('.opus', ['-c:a', 'libopus', '-b:a', '128k']),
+)
+
+# Length of the synthetic sample, in seconds
+CALIBRATION_SECONDS = 30
+# Timed runs of each backend on each sample, after an untimed one that
+# warms up the page cache and the backend's imports and decoders
+CALIBRATION_REPEATS = 3
+
+def file_format(fname: str) -> str:
+    return os.path.splitext(fname)[1].lower()
+
+def load_calibration(path: Optional[str] = None) -> Dict[str, Dict[str, float]]:
+    '''Return the calibration table at path, or an empty one.
+
+    The table maps each format to a dict of backend names and the
+    seconds each backend took per second of audio.
+
+    '''
+    path = path or default_calibration_path()
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        logger.warning("Ignoring unreadable backend calibration table %s", repr(path))
+        return {}
+
+def available_backends() -> Dict[str, GainComputer]:
+    '''Return the usable backends in known_backends, by name.'''
+    result = {}
+    for name in known_backends:
+        try:
+            result[name] = get_backend(name)
+        except BackendUnavailableException as ex:
+            logger.debug("Backend %s is unavailable: %s", name, ex)
+    return result
+
+def write_synthetic_wav(fname: str, seconds: float = CALIBRATION_SECONDS, rate: int = 44100) -> None:
+    '''Write a stereo 16-bit WAV file of a swept tone with some noise.'''
+    # A simple linear congruential generator is enough for noise and
+    # keeps the sample the same on every run
+    seed = 12345
+    samples = array('h')
+    for i in range(int(seconds * rate)):
+        seed = (seed * 1103515245 + 12345) & 0x7fffffff
+        t = i / rate
+        tone = math.sin(2 * math.pi * (220 + 40 * t) * t)
+        noise = seed / 0x7fffffff - 0.5
+        value = int(8000 * tone + 2000 * noise)
+        samples.append(value)
+        samples.append(value)
+    with wave.open(fname, 'wb') as w:
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(samples.tobytes())
+
+def calibrate(path: Optional[str] = None) -> Dict[str, Dict[str, float]]:
+    '''Time every available backend on each format, and save the table to path.
+
+    Formats other than WAV are made with ffmpeg, and are skipped if
+    it is not installed or cannot encode them. A backend that does
+    not support a format, or fails on it, is left out for it. Each
+    timing is the fastest of CALIBRATION_REPEATS runs, after a first
+    untimed run.
+
+    '''
+    path = path or default_calibration_path()
+    backends = available_backends()
+    if not backends:
+        raise BackendUnavailableException("Could not find any usable backends.")
+    ffmpeg = shutil.which('ffmpeg')
+    table = {}                  # type: Dict[str, Dict[str, float]]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        wav = os.path.join(tmpdir, 'sample.wav')
+        write_synthetic_wav(wav)
+        for (ext, encode_args) in CALIBRATION_FORMATS:
+            sample = wav if encode_args is None else os.path.join(tmpdir, 'sample' + ext)
+            if encode_args is not None:
+                if ffmpeg is None:
+                    continue
+                try:
+                    subprocess.run([ffmpeg, '-v', 'quiet', '-y', '-i', wav] + encode_args + [sample],
+                                   check=True, stdin=subprocess.DEVNULL)
+                except subprocess.CalledProcessError:
+                    logger.debug("ffmpeg could not encode the %s sample", ext)
+                    continue
+            for (name, backend) in backends.items():
+                if not backend.supports_file(sample):
+                    continue
+                try:
+                    backend.compute_gain([sample])
+                    elapsed = math.inf
+                    for _ in range(CALIBRATION_REPEATS):
+                        start = time.perf_counter()
+                        backend.compute_gain([sample])
+                        elapsed = min(elapsed, time.perf_counter() - start)
+                except Exception as ex:
+                    logger.debug("Backend %s failed on the %s sample: %s", name, ext, ex)
+                    continue
+                table.setdefault(ext, {})[name] = elapsed / CALIBRATION_SECONDS
+                logger.debug("Backend %s analyzed the %s sample at %.0fx realtime", name, ext, CALIBRATION_SECONDS / elapsed)
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(table, f, indent=2, sort_keys=True)
+    return table
+
+def same_reference(backends: Dict[str, GainComputer]) -> Dict[str, GainComputer]:
+    '''Return the largest group of backends whose gains have the same reference level.
+
+    In a tie, the group of the backend that comes first in
+    known_backends is returned.
+
+    '''
+    order = { name: i for (i, name) in enumerate(known_backends) }
+    groups = {}                 # type: Dict[Optional[str], Dict[str, GainComputer]]
+    for name in sorted(backends, key=lambda name: order.get(name, len(order))):
+        groups.setdefault(backends[name].reference, {})[name] = backends[name]
+    # max returns the first of the largest groups, in order of insertion
+    return max(groups.values(), key=len)
+
+class RoutingGainComputer(GainComputer):
+    '''Sends each call of compute_gain to the fastest capable backend.
+
+    backends maps names to GainComputers, of which only those with
+    the same reference level are used (see same_reference), or is
+    None to use the available_backends when they are first needed.
+    table is a calibration table as returned by load_calibration, or
+    None to load the default one when it is first needed. Backends
+    without a timing for a format come after those with one, in the
+    order of known_backends.
+
+    '''
+    def __init__(self, backends: Optional[Dict[str, GainComputer]] = None,
+                 table: Optional[Dict[str, Dict[str, float]]] = None) -> None:
+        self._backends = None   # type: Optional[Dict[str, GainComputer]]
+        if backends is not None:
+            self._set_backends(backends)
+        self._table = table
+        # The ranking of the backends for each format, which only
+        # depends on the table, and the names of the backends that
+        # cannot measure true peak
+        self._ranked = {}       # type: Dict[str, List[Tuple[str, GainComputer]]]
+        self._no_true_peak = set() # type: Set[str]
+
+    def __repr__(self) -> str:
+        if self._backends is None:
+            return "RoutingGainComputer()"
+        return "RoutingGainComputer({!r})".format(sorted(self._backends))
+
+    def _set_backends(self, backends: Dict[str, GainComputer]) -> None:
+        if not backends:
+            raise BackendUnavailableException("Unable to use the route backend: no other backend is usable.")
+        self._backends = same_reference(backends)
+        for name in sorted(set(backends) - set(self._backends)):
+            logger.info("Not routing to the %s backend, whose gains are relative to %s rather than %s",
+                        name, backends[name].reference, self.reference)
+
+    @property
+    def backends(self) -> Dict[str, GainComputer]:
+        if self._backends is None:
+            self._set_backends(available_backends())
+        assert self._backends is not None
+        return self._backends
+
+    @property
+    def reference(self) -> Optional[str]: # type: ignore
+        return next(iter(self.backends.values())).reference
+
+    @property
+    def table(self) -> Dict[str, Dict[str, float]]:
+        if self._table is None:
+            self._table = load_calibration()
+        return self._table
+
+    def ranked_backends(self, fmt: str) -> List[Tuple[str, GainComputer]]:
+        '''Return the backends in order of speed for format fmt.'''
+        if fmt not in self._ranked:
+            timings = self.table.get(fmt, {})
+            order = { name: i for (i, name) in enumerate(known_backends) }
+            self._ranked[fmt] = sorted(self.backends.items(),
+                                       key=lambda item: (timings.get(item[0], math.inf),
+                                                         order.get(item[0], len(order))))
+        return self._ranked[fmt]
+
+    def capable_backends(self, fnames: List[str], true_peak: bool = False) -> List[Tuple[str, GainComputer]]:
+        '''Return the backends that support all of fnames, fastest first.
+
+        With true_peak, the backends known to be unable to measure
+        true peak are left out.
+
+        '''
+        fmt = file_format(fnames[0]) if fnames else ''
+        return [ (name, backend) for (name, backend) in self.ranked_backends(fmt)
+                 if not (true_peak and name in self._no_true_peak)
+                 and all(backend.supports_file(f) for f in fnames) ]
+
+    def result_source(self, fnames: List[str], true_peak: bool = False) -> Optional[str]:
+        candidates = self.capable_backends(fnames, true_peak)
+        return candidates[0][0] if candidates else None
+
+    def compute_gain(self, fnames: Iterable[str], album: bool = True,
+                     true_peak: bool = False) -> Dict[str, Dict[str, float]]:
+        fnames = list(fnames)
+        if not fnames:
+            return {}
+        candidates = self.capable_backends(fnames, true_peak)
+        if not candidates:
+            raise BackendUnavailableException("No backend supports all of these files: {!r}".format(fnames))
+        for (name, backend) in candidates:
+            logger.debug("Using the %s backend for %s files", name, file_format(fnames[0]) or "[no extension]")
+            try:
+                return backend.compute_gain(fnames, album=album, true_peak=true_peak)
+            except TruePeakUnsupportedException:
+                # Only the next backend is tried, so all tracks are
+                # still analyzed by the same backend
+                logger.debug("The %s backend cannot measure true peak", name)
+                self._no_true_peak.add(name)
+        raise TruePeakUnsupportedException("No backend can measure the true peak of these files: {!r}".format(fnames))
+
+    def supports_file(self, fname: str) -> bool:
+        return any(backend.supports_file(fname) for backend in self.backends.values())
+
+register_backend('route', RoutingGainComputer())
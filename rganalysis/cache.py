@@ -0,0 +1,256 @@
+'''Persistent cache of gain results, keyed by audio fingerprint.
+
+Copies of the same track (on compilations, "best of" discs, etc.)
+have the same audio fingerprint (see rganalysis.fingerprint), so
+their track gain and peak only need to be computed once. Results are
+kept in an SQLite database, so they are shared between the worker
+processes of a run and reused by later runs.
+
+Album gain depends on every track in the album, so it is cached
+under the combination of all the album's track fingerprints and is
+still computed once per distinct track set.
+
+The cache is also the record of which files were given provisional
+tags by a fast estimate (see rganalysis.backends.estimate), so that a
+later full analysis replaces them.
+
+'''
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import hashlib
+import os
+import sqlite3
+
+from rganalysis.common import logger, default_cache_path
+from rganalysis.backends import GainComputer
+from rganalysis.fingerprint import FINGERPRINT_VERSION, audio_fingerprint
+
+class GainCache(object):
+    '''An SQLite-backed store of gain results.
+
+    The database connection is opened lazily and re-opened after a
+    fork, so a GainCache can be created in the parent process and
+    used from the worker processes.
+
+    '''
+
+    schema = (
+        '''CREATE TABLE IF NOT EXISTS fingerprint (
+               path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER,
+               fingerprint TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS track_gain (
+               backend TEXT, fingerprint TEXT, gain REAL, peak REAL,
+               true_peak REAL,
+               PRIMARY KEY (backend, fingerprint))''',
+        '''CREATE TABLE IF NOT EXISTS album_gain (
+               backend TEXT, album_key TEXT, gain REAL, peak REAL,
+               true_peak REAL,
+               PRIMARY KEY (backend, album_key))''',
+        '''CREATE TABLE IF NOT EXISTS provisional (
+               path TEXT PRIMARY KEY, gain_error REAL, album_gain_error REAL)''',
+    )
+    # Columns added since the first version of the schema
+    added_columns = (
+        ('track_gain', 'true_peak REAL'),
+        ('album_gain', 'true_peak REAL'),
+        ('fingerprint', 'version INTEGER'),
+    )
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._conn = None       # type: Optional[sqlite3.Connection]
+        self._conn_pid = None   # type: Optional[int]
+
+    def __repr__(self) -> str:
+        return "GainCache({!r})".format(self.path)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state['_conn'] = state['_conn_pid'] = None
+        return state
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None or self._conn_pid != os.getpid():
+            dirname = os.path.dirname(self.path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            for stmt in self.schema:
+                conn.execute(stmt)
+            for (table, column) in self.added_columns:
+                try:
+                    conn.execute('ALTER TABLE {} ADD COLUMN {}'.format(table, column))
+                except sqlite3.OperationalError:
+                    # Column already exists
+                    pass
+            (self._conn, self._conn_pid) = (conn, os.getpid())
+        return self._conn
+
+    def fingerprint(self, fname: str) -> str:
+        '''Return the audio fingerprint of fname.
+
+        Fingerprints are remembered by path, size and modification
+        time, so unchanged files are only hashed once (unless the way
+        fingerprints are computed has changed since, see
+        FINGERPRINT_VERSION).
+
+        '''
+        st = os.stat(fname)
+        row = self.conn.execute(
+            'SELECT fingerprint FROM fingerprint WHERE path = ? AND size = ? AND mtime = ? AND version = ?',
+            (fname, st.st_size, st.st_mtime_ns, FINGERPRINT_VERSION)).fetchone()
+        if row:
+            return row[0]
+        fp = audio_fingerprint(fname)
+        self.conn.execute('INSERT OR REPLACE INTO fingerprint (path, size, mtime, fingerprint, version) VALUES (?, ?, ?, ?, ?)',
+                          (fname, st.st_size, st.st_mtime_ns, fp, FINGERPRINT_VERSION))
+        return fp
+
+    @staticmethod
+    def album_key(fingerprints: Iterable[str]) -> str:
+        return hashlib.sha1('\n'.join(sorted(fingerprints)).encode()).hexdigest()
+
+    def get_track(self, backend: str, fingerprint: str) -> Optional[Tuple[float, float, Optional[float]]]:
+        '''Return (gain, peak, true peak), or None if not cached.
+
+        The true peak is None if it was not measured.'''
+        return self.conn.execute(
+            'SELECT gain, peak, true_peak FROM track_gain WHERE backend = ? AND fingerprint = ?',
+            (backend, fingerprint)).fetchone()
+
+    def put_track(self, backend: str, fingerprint: str, gain: float, peak: float,
+                  true_peak: Optional[float] = None) -> None:
+        self.conn.execute('INSERT OR REPLACE INTO track_gain (backend, fingerprint, gain, peak, true_peak) VALUES (?, ?, ?, ?, ?)',
+                          (backend, fingerprint, gain, peak, true_peak))
+
+    def get_album(self, backend: str, fingerprints: Iterable[str]) -> Optional[Tuple[float, float, Optional[float]]]:
+        '''Like get_track, for the album made of the given tracks.'''
+        return self.conn.execute(
+            'SELECT gain, peak, true_peak FROM album_gain WHERE backend = ? AND album_key = ?',
+            (backend, self.album_key(fingerprints))).fetchone()
+
+    def put_album(self, backend: str, fingerprints: Iterable[str], gain: float, peak: float,
+                  true_peak: Optional[float] = None) -> None:
+        self.conn.execute('INSERT OR REPLACE INTO album_gain (backend, album_key, gain, peak, true_peak) VALUES (?, ?, ?, ?, ?)',
+                          (backend, self.album_key(fingerprints), gain, peak, true_peak))
+
+    def mark_provisional(self, rginfo: Dict[str, Dict[str, float]]) -> None:
+        '''Record that the files in rginfo were given estimated tags.'''
+        self.conn.executemany('INSERT OR REPLACE INTO provisional VALUES (?, ?, ?)',
+                              [ (fname, tags.get("replaygain_track_gain_error"), tags.get("replaygain_album_gain_error"))
+                                for (fname, tags) in rginfo.items() ])
+
+    def clear_provisional(self, fnames: Iterable[str]) -> None:
+        '''Record that fnames were given tags from a full analysis.'''
+        self.conn.executemany('DELETE FROM provisional WHERE path = ?', [ (f,) for f in fnames ])
+
+    def is_provisional(self, fname: str) -> bool:
+        return self.conn.execute('SELECT 1 FROM provisional WHERE path = ?', (fname,)).fetchone() is not None
+
+class CachingGainComputer(GainComputer):
+    '''A GainComputer that consults a GainCache before another backend.
+
+    Track gain for a file whose audio has been analyzed before (in
+    this run or an earlier one) is taken from the cache. When album
+    gain is requested, the wrapped backend is only skipped if this
+    exact set of tracks has been analyzed before, since album gain
+    cannot be derived from the track gains alone.
+
+    Results are cached under the name of the backend that computed
+    them, which for a backend that hands files to others (see
+    GainComputer.result_source) is not backend_name.
+
+    If the wrapped backend is provisional, its estimates are not
+    cached (they are cheap, and must not be mistaken for full results
+    later), but once they are saved, the files are recorded as having
+    provisional tags. Saving full results clears that record.
+
+    '''
+    def __init__(self, backend: GainComputer, backend_name: str, cache: GainCache) -> None:
+        self.backend = backend
+        self.backend_name = backend_name
+        self.cache = cache
+
+    def __repr__(self) -> str:
+        return "CachingGainComputer({!r}, {!r}, {!r})".format(self.backend, self.backend_name, self.cache)
+
+    def _source(self, fnames: List[str], true_peak: bool) -> str:
+        return self.backend.result_source(fnames, true_peak) or self.backend_name
+
+    def _store(self, source: str, fingerprints: Dict[str, str], rginfo: Dict[str, Dict[str, float]],
+               album: bool) -> None:
+        for (fname, tags) in rginfo.items():
+            self.cache.put_track(source, fingerprints[fname],
+                                 tags["replaygain_track_gain"], tags["replaygain_track_peak"],
+                                 tags.get("replaygain_track_true_peak"))
+        if album and rginfo:
+            tags = next(iter(rginfo.values()))
+            self.cache.put_album(source, fingerprints.values(),
+                                 tags["replaygain_album_gain"], tags["replaygain_album_peak"],
+                                 tags.get("replaygain_album_true_peak"))
+
+    def compute_gain(self, fnames: Iterable[str], album: bool = True,
+                     true_peak: bool = False) -> Dict[str, Dict[str, float]]:
+        fnames = list(fnames)
+        if self.backend.provisional:
+            return self.backend.compute_gain(fnames, album=album, true_peak=true_peak)
+        fingerprints = { f: self.cache.fingerprint(f) for f in fnames }
+        source = self._source(fnames, true_peak)
+        cached = { f: self.cache.get_track(source, fingerprints[f]) for f in fnames }
+        album_cached = self.cache.get_album(source, fingerprints.values()) if album else None
+        if true_peak:
+            # Values cached without true peak are no use
+            cached = { f: row if row is None or row[2] is not None else None for (f, row) in cached.items() }
+            if album_cached is not None and album_cached[2] is None:
+                album_cached = None
+        misses = [ f for f in fnames if cached[f] is None ]
+        if misses or (album and album_cached is None):
+            to_compute = fnames if album else misses
+            logger.debug("Computing gain for %s of %s files (%s cached)",
+                         len(to_compute), len(fnames), len(fnames) - len(misses))
+            rginfo = self.backend.compute_gain(to_compute, album=album, true_peak=true_peak)
+            # Asked again, in case another backend had to be used
+            self._store(self._source(fnames, true_peak), fingerprints, rginfo, album)
+        else:
+            logger.debug("Using cached gain for all %s files", len(fnames))
+            rginfo = {}
+        for f in fnames:
+            if f not in rginfo:
+                (gain, peak, track_true_peak) = cached[f] # type: ignore
+                rginfo[f] = {
+                    "replaygain_track_gain": gain,
+                    "replaygain_track_peak": peak,
+                }
+                if true_peak:
+                    rginfo[f]["replaygain_track_true_peak"] = track_true_peak
+                if album_cached is not None:
+                    rginfo[f]["replaygain_album_gain"] = album_cached[0]
+                    rginfo[f]["replaygain_album_peak"] = album_cached[1]
+                    if true_peak:
+                        rginfo[f]["replaygain_album_true_peak"] = album_cached[2]
+        return rginfo
+
+    def supports_file(self, fname: str) -> bool:
+        return self.backend.supports_file(fname)
+
+    @property
+    def provisional(self) -> bool:       # type: ignore
+        return self.backend.provisional
+
+    @property
+    def reference(self) -> Optional[str]: # type: ignore
+        return self.backend.reference
+
+    def is_provisional(self, fnames: Iterable[str]) -> bool:
+        if self.backend.provisional:
+            # Estimates are not redone on top of estimates
+            return False
+        return any(self.cache.is_provisional(f) for f in fnames)
+
+    def tags_saved(self, rginfo: Dict[str, Dict[str, float]]) -> None:
+        if self.backend.provisional:
+            self.cache.mark_provisional(rginfo)
+        else:
+            self.cache.clear_provisional(rginfo.keys())
@@ -1,8 +1,8 @@
 # Common objects are put in this file to avoid circular imports
 
 import logging
-
-from parse import parse
+import os
+import re
 
 # Set up logging
 logFormatter = logging.Formatter('%(asctime)s %(levelname)s: %(message)s')
@@ -13,16 +13,42 @@ logger.addHandler(logging.StreamHandler())
 for handler in logger.handlers:
     handler.setFormatter(logFormatter)
 
+def default_job_count() -> int:
+    return os.cpu_count() or 1
+
+def cache_dir() -> str:
+    '''Return the directory for files that rganalysis keeps between runs.'''
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'rganalysis')
+
+def default_cache_path() -> str:
+    '''Return the default location of the gain cache database.'''
+    return os.path.join(cache_dir(), 'gain-cache.sqlite')
+
+def default_skip_list_path() -> str:
+    '''Return the default location of the list of quarantined files.'''
+    return os.path.join(cache_dir(), 'skip-list.json')
+
+def default_calibration_path() -> str:
+    '''Return the default location of the backend calibration table.'''
+    return os.path.join(cache_dir(), 'backend-speed.json')
+
 def format_gain(gain: float) -> str:
     return '{:.2f} dB'.format(gain)
 
 def format_peak(peak: float) -> str:
     return '{:.6f}'.format(peak)
 
+# The format written by format_gain, which is by far the most common
+_gain_db = re.compile(r'[-+]?\d*\.\d+ dB')
+
 def parse_gain(gain: str) -> float:
+    if _gain_db.fullmatch(gain):
+        return float(gain[:-3])
     try:
         return float(gain)
     except ValueError:
+        from parse import parse
         p = parse('{value:f} dB', gain)
         if p:
             return p.named['value']
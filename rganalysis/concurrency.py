@@ -0,0 +1,196 @@
+'''Adaptive concurrency and I/O limits for the worker pool.
+
+Whether analysis is limited by decoding (CPU) or by reading files
+(I/O) depends on the storage and the file formats, so the best number
+of parallel jobs is not known in advance. A ConcurrencyController
+starts few workers and adjusts the number of active ones within
+[min_jobs, max_jobs], watching how much audio is analyzed per second
+along with the system's I/O wait and disk read rate. It backs off
+when the disks are saturated or adding workers stopped helping.
+
+A ByteRateLimiter caps the average rate at which albums are started,
+measured in bytes of input files per second, and set_io_priority
+lowers the CPU and I/O priority of worker processes, so that other
+work on the same machine is not starved.
+
+System statistics and I/O priorities need the psutil module. Without
+it, the controller adapts on throughput alone and only the CPU
+priority is lowered.
+
+'''
+
+from typing import Any, Iterator, Optional, Tuple
+
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+from rganalysis.common import logger
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+def set_io_priority(priority: str) -> None:
+    '''Lower the CPU and I/O priority of the current process.
+
+    priority is one of "normal" (do nothing), "low" or "idle".
+    Meant to be called at the start of a worker process.
+
+    '''
+    if priority == 'normal':
+        return
+    try:
+        os.nice(10 if priority == 'low' else 19)
+    except (AttributeError, OSError):
+        pass
+    if psutil is None:
+        return
+    try:
+        p = psutil.Process()
+        if priority == 'idle' and hasattr(psutil, 'IOPRIO_CLASS_IDLE'):
+            p.ionice(psutil.IOPRIO_CLASS_IDLE)
+        elif hasattr(psutil, 'IOPRIO_CLASS_BE'):
+            p.ionice(psutil.IOPRIO_CLASS_BE, 7)
+        elif hasattr(psutil, 'IOPRIO_VERYLOW'):
+            # Windows
+            p.ionice(psutil.IOPRIO_VERYLOW)
+    except (psutil.Error, OSError, ValueError) as ex:
+        logger.debug("Could not set I/O priority: %s", ex)
+
+class ByteRateLimiter(object):
+    '''A token bucket limiting the average rate of bytes read.
+
+    consume(n) blocks until n more bytes may be read without the
+    average rate exceeding bytes_per_sec. Since the reading itself
+    happens in the worker processes, the limit is applied when an
+    album is started, for the total size of its files.
+
+    '''
+    def __init__(self, bytes_per_sec: int, burst_seconds: float = 1.0) -> None:
+        self.rate = bytes_per_sec
+        self.capacity = bytes_per_sec * burst_seconds
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes: int) -> None:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= nbytes
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            logger.debug("Waiting %.1f seconds to stay under the read rate limit", delay)
+            time.sleep(delay)
+
+class SystemSampler(object):
+    '''Measures I/O wait and disk read rate between calls to sample.'''
+    def __init__(self) -> None:
+        self.last = self._read()
+
+    @staticmethod
+    def _read() -> Optional[Tuple[float, Any, int]]:
+        if psutil is None:
+            return None
+        cpu = psutil.cpu_times()
+        disk = psutil.disk_io_counters()
+        return (time.monotonic(), cpu, disk.read_bytes if disk else 0)
+
+    def sample(self) -> Tuple[Optional[float], Optional[float]]:
+        '''Return (iowait fraction, disk read bytes/sec) since the last sample.'''
+        current = self._read()
+        (last, self.last) = (self.last, current)
+        if current is None or last is None:
+            return (None, None)
+        (t0, cpu0, read0) = last
+        (t1, cpu1, read1) = current
+        total = sum(cpu1) - sum(cpu0)
+        iowait = None
+        if hasattr(cpu1, 'iowait') and total > 0:
+            iowait = (cpu1.iowait - cpu0.iowait) / total
+        read_rate = (read1 - read0) / (t1 - t0) if t1 > t0 else None
+        return (iowait, read_rate)
+
+class ConcurrencyController(object):
+    '''Limits the number of track sets analyzed at once, adapting the limit.
+
+    Worker threads call slot() around each track set. Every interval
+    seconds, the controller compares the throughput (seconds of audio
+    analyzed per second) with the previous interval and moves the
+    limit by one job: it keeps going in the same direction while that
+    helps, turns around when throughput drops, and always steps down
+    while I/O wait exceeds max_iowait or the disks read faster than
+    max_read_rate.
+
+    '''
+    def __init__(self, min_jobs: int, max_jobs: int, interval: float = 10.0,
+                 max_iowait: float = 0.25, max_read_rate: Optional[int] = None) -> None:
+        self.min_jobs = max(1, min_jobs)
+        self.max_jobs = max(self.min_jobs, max_jobs)
+        self.limit = self.min_jobs
+        self.interval = interval
+        self.max_iowait = max_iowait
+        self.max_read_rate = max_read_rate
+        self.active = 0
+        self.cond = threading.Condition()
+        self.sampler = SystemSampler()
+        self.direction = 1
+        self.last_throughput = None # type: Optional[float]
+        self.window_start = time.monotonic()
+        self.window_audio = 0.0
+
+    def __repr__(self) -> str:
+        return "ConcurrencyController(min_jobs={!r}, max_jobs={!r})".format(self.min_jobs, self.max_jobs)
+
+    @contextmanager
+    def slot(self, length_seconds: float) -> Iterator[None]:
+        '''Wait for a free slot, and hold it while analyzing length_seconds of audio.'''
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.active -= 1
+                self.window_audio += length_seconds
+                self._maybe_adjust()
+                self.cond.notify_all()
+
+    def _maybe_adjust(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self.window_start
+        if elapsed < self.interval:
+            return
+        throughput = self.window_audio / elapsed
+        (iowait, read_rate) = self.sampler.sample()
+        (self.window_start, self.window_audio) = (now, 0.0)
+        last = self.last_throughput
+        self.last_throughput = throughput
+        if (iowait is not None and iowait > self.max_iowait) or \
+           (read_rate is not None and self.max_read_rate and read_rate > self.max_read_rate):
+            self.direction = -1
+            step = -1
+        elif last is None:
+            step = self.direction
+        elif throughput > last * 1.05:
+            step = self.direction
+        elif throughput < last * 0.95:
+            self.direction = -self.direction
+            step = self.direction
+        else:
+            step = 0
+        new_limit = min(self.max_jobs, max(self.min_jobs, self.limit + step))
+        if new_limit != self.limit:
+            logger.debug("Changing number of parallel jobs from %s to %s (throughput %.1fx realtime, iowait %s, read rate %s)",
+                         self.limit, new_limit, throughput, iowait, read_rate)
+            self.limit = new_limit
+        elif step and new_limit in (self.min_jobs, self.max_jobs):
+            # Bounced off a bound, so try the other direction next time
+            self.direction = -step
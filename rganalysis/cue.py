@@ -0,0 +1,535 @@
+'''Albums stored as a single file with a CUE sheet.
+
+Many lossless rips are a single FLAC or WAV image of a whole disc,
+with the track boundaries given by a CUE sheet, either in a sidecar
+.cue file next to the image or embedded in a CUESHEET tag. Without
+the sheet, the image would be analyzed as a single track.
+
+A CueTrackSet is a track set made from one such image. Its tracks are
+the ranges between consecutive "INDEX 01" points of the sheet (so
+the pregap of each track belongs to the track before it, as most
+players and splitters do). The image is decoded once, block by
+block, and each block is split at the track boundaries and fed to a
+LoudnessMeter per track (see rganalysis.dsp), which gives the track
+gains and, from their blocks together, the album gain.
+
+The results are written back to the sheet as the REM lines that
+players which support CUE sheets read:
+
+    REM REPLAYGAIN_ALBUM_GAIN -6.54 dB
+    REM REPLAYGAIN_ALBUM_PEAK 0.988312
+      TRACK 01 AUDIO
+        REM REPLAYGAIN_TRACK_GAIN -5.21 dB
+        REM REPLAYGAIN_TRACK_PEAK 0.912043
+
+An embedded sheet is preferred to a sidecar file, since it stays with
+the audio. The image's own tags are left alone. Analysis requires
+numpy and scipy, and ffmpeg for formats other than WAV, Wave64 and
+AIFF.
+
+Whatever the backend, the gains are ReplayGain 2.0 gains (-18 LUFS
+reference), so images are only split by their sheets when the backend
+uses the same reference (see use_cue_sheets). Otherwise, or without
+numpy and scipy, each image is analyzed as a single track by the
+backend, as if it had no sheet.
+
+Since the image is not analyzed by the backend, it is always measured
+in full, even with --fast-estimate, so its values are never
+provisional. With a gain cache (see rganalysis.cache), the values of
+each track are cached under the image's audio fingerprint and the
+track's position in it (see measure_image_cached).
+
+'''
+
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple, Union, cast
+
+import bisect
+import os
+import re
+
+from rganalysis import RGTrack, RGTrackDryRun, RGTrackSet, rg_tags
+from rganalysis.backends import GainComputer, NullGainComputer, RG2_REFERENCE
+from rganalysis.common import logger, format_gain, format_peak, parse_gain, parse_peak
+from rganalysis.profiling import stage
+from rganalysis.results import AlbumResult, TrackResult, CONSISTENT, DRIFTED
+
+# CUE sheet times are in minutes, seconds and frames of 1/75 second
+CUE_FRAMES_PER_SECOND = 75
+
+CueTrack = NamedTuple('CueTrack', [
+    ('number', int),
+    ('start', int),
+    ('line', int),
+])
+CueTrack.__doc__ = '''A track of a CUE sheet.
+
+start is the position of its "INDEX 01" in CUE frames of 1/75
+second, and line the index of its TRACK line in the sheet.'''
+
+# ReplayGain values of a CUE sheet, by track number, with the album's
+# under None
+CueValues = Dict[Optional[int], Dict[str, float]]
+
+_command = re.compile(r'^(\s*)(\S+)\s*(.*?)\s*$')
+_index = re.compile(r'^0*1\s+(\d+):(\d+):(\d+)$')
+_rg_rem = re.compile(r'^\s*REM\s+(REPLAYGAIN_\w+)\s+(.*?)\s*$', re.IGNORECASE)
+
+def cue_time_to_frames(start: int, sample_rate: int) -> int:
+    '''Convert a position in CUE frames to sample frames.'''
+    return start * sample_rate // CUE_FRAMES_PER_SECOND
+
+def cue_track_name(fname: str, number: int) -> str:
+    '''Return the name of a track of the image fname, as used in results.'''
+    return "{}#{:02d}".format(fname, number)
+
+def split_cue_track_name(name: str) -> Optional[Tuple[str, int]]:
+    '''Return the image and track number of a name returned by cue_track_name.
+
+    Returns None if name is not such a name, but an ordinary file.
+
+    '''
+    (fname, sep, number) = name.rpartition('#')
+    if sep and number.isdigit() and not os.path.exists(name) and os.path.exists(fname):
+        return (fname, int(number))
+    return None
+
+class CueSheet(object):
+    '''A parsed CUE sheet, which can be rewritten with new ReplayGain values.
+
+    Only what is needed to find the tracks of a single-file image is
+    parsed: FILE, TRACK and "INDEX 01" lines, and "REM REPLAYGAIN_*"
+    lines. Everything else is kept as it is.
+
+    '''
+    encoding = 'utf-8'
+
+    def __init__(self, text: str) -> None:
+        self.newline = '\r\n' if '\r\n' in text else '\n'
+        self.lines = text.splitlines()
+        self.files = []         # type: List[str]
+        self.tracks = []        # type: List[CueTrack]
+        # Album REM lines go before the first FILE line
+        self.first_file = len(self.lines)
+        track = None            # type: Optional[Tuple[int, int]]
+        for (i, line) in enumerate(self.lines):
+            m = _command.match(line)
+            if not m:
+                continue
+            (command, args) = (m.group(2).upper(), m.group(3))
+            if command == 'FILE':
+                self.first_file = min(self.first_file, i)
+                # FILE "name" TYPE, where the quotes are optional
+                if args.startswith('"') and '"' in args[1:]:
+                    self.files.append(args[1:args.index('"', 1)])
+                else:
+                    self.files.append(args.split()[0] if args else '')
+            elif command == 'TRACK':
+                number = re.match(r'\d+', args)
+                track = (int(number.group()), i) if number else None
+            elif command == 'INDEX' and track is not None:
+                index = _index.match(args)
+                if index:
+                    (mm, ss, ff) = (int(g) for g in index.groups())
+                    self.tracks.append(CueTrack(track[0], (mm * 60 + ss) * CUE_FRAMES_PER_SECOND + ff, track[1]))
+                    track = None
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'CueSheet':
+        '''Parse a CUE sheet file, which may be in UTF-8 (with or without a BOM) or Latin-1.'''
+        try:
+            (text, encoding) = (data.decode('utf-8-sig'), 'utf-8-sig' if data.startswith(b'\xef\xbb\xbf') else 'utf-8')
+        except UnicodeDecodeError:
+            (text, encoding) = (data.decode('latin-1'), 'latin-1')
+        sheet = cls(text)
+        sheet.encoding = encoding
+        return sheet
+
+    def is_single_file_album(self) -> bool:
+        '''Return True if the sheet describes several tracks of a single file.'''
+        starts = [ t.start for t in self.tracks ]
+        return len(self.files) == 1 and len(self.tracks) >= 2 and starts == sorted(set(starts))
+
+    def replaygain(self) -> CueValues:
+        '''Return the ReplayGain values in the sheet's REM lines.'''
+        values = { None: {} }   # type: CueValues
+        number = None           # type: Optional[int]
+        track_lines = { t.line: t.number for t in self.tracks }
+        for (i, line) in enumerate(self.lines):
+            if i in track_lines:
+                number = track_lines[i]
+                values[number] = {}
+                continue
+            m = _rg_rem.match(line)
+            if m:
+                tag = m.group(1).lower()
+                try:
+                    value = parse_gain(m.group(2)) if tag.endswith('_gain') else parse_peak(m.group(2))
+                except ValueError:
+                    continue
+                values[None if tag.startswith('replaygain_album_') else number].setdefault(tag, value)
+        return values
+
+    def with_replaygain(self, values: CueValues) -> str:
+        '''Return the text of the sheet with its ReplayGain REM lines replaced by values.'''
+        def rem_lines(indent: str, tags: Dict[str, float]) -> List[str]:
+            return [ '{}REM {} {}'.format(indent, tag.upper(), format_gain(tags[tag]) if tag.endswith('_gain') else format_peak(tags[tag]))
+                     for tag in rg_tags if tag in tags ]
+        track_lines = { t.line: t.number for t in self.tracks }
+        out = []                # type: List[str]
+        for (i, line) in enumerate(self.lines):
+            if i == self.first_file:
+                out.extend(rem_lines('', values.get(None, {})))
+            if _rg_rem.match(line):
+                continue
+            out.append(line)
+            if i in track_lines:
+                indent = _command.match(line).group(1) # type: ignore
+                out.extend(rem_lines(indent + '  ', values.get(track_lines[i], {})))
+        return self.newline.join(out) + self.newline
+
+def find_cue_sheet(track: RGTrack, sidecars: bool = True) -> Optional[Tuple[CueSheet, Optional[str]]]:
+    '''Return the CUE sheet of a single-file album, and where it is.
+
+    The second item is the path of the sidecar file, or None if the
+    sheet is embedded in the file's CUESHEET tag. Sidecar files are
+    named like the image with its extension replaced by or followed
+    by ".cue", and are only looked for if sidecars is True. Returns
+    None if there is no sheet, or it does not describe several
+    tracks of a single file.
+
+    '''
+    candidates = []             # type: List[Tuple[CueSheet, Optional[str]]]
+    try:
+        embedded = track.track.get('cuesheet')
+    except (KeyError, ValueError):
+        embedded = None
+    if embedded:
+        candidates.append((CueSheet(embedded[0]), None))
+    if sidecars:
+        for path in (os.path.splitext(track.filename)[0] + '.cue', track.filename + '.cue'):
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    candidates.append((CueSheet.from_bytes(f.read()), path))
+    for (sheet, path) in candidates:
+        if sheet.is_single_file_album():
+            return (sheet, path)
+        logger.debug("Ignoring CUE sheet %s, which does not describe several tracks of one file",
+                     repr(path or track.filename))
+    return None
+
+_cue_sheets_ignored = False
+_estimates_ignored = False
+
+def use_cue_sheets(gain_backend: GainComputer) -> bool:
+    '''Return True if images should be split by their CUE sheets for gain_backend.
+
+    This needs numpy and scipy, which measure_image uses whatever the
+    backend, and a backend whose gains have the same reference level
+    as measure_image's (or an unknown one). The reason for ignoring
+    CUE sheets is logged the first time.
+
+    '''
+    global _cue_sheets_ignored
+    if gain_backend.reference not in (None, RG2_REFERENCE):
+        reason = "the backend's gains are relative to {}, not {}".format(gain_backend.reference, RG2_REFERENCE)
+    else:
+        try:
+            import scipy.signal
+            import rganalysis.dsp
+            import rganalysis.pcm
+            return True
+        except ImportError:
+            reason = "analyzing them requires numpy and scipy"
+    if not _cue_sheets_ignored:
+        logger.warning("Ignoring CUE sheets, and analyzing single-file albums as single tracks: %s", reason)
+        _cue_sheets_ignored = True
+    return False
+
+# Name under which measure_image's results are cached, whatever the backend
+CACHE_SOURCE = "cue"
+
+def measure_image_cached(gain_backend: GainComputer, fname: str, tracks: List[CueTrack],
+                         true_peak: bool = False) -> Tuple[List[Dict[str, float]], Dict[str, float]]:
+    '''Like measure_image, but use the gain cache if gain_backend has one.
+
+    Each track is cached under the fingerprint of the image and its
+    start and end, so editing the sheet's track boundaries only
+    invalidates the tracks that moved.
+
+    '''
+    from rganalysis.cache import CachingGainComputer
+    if not isinstance(gain_backend, CachingGainComputer):
+        return measure_image(fname, tracks, true_peak)
+    cache = gain_backend.cache
+    image = cache.fingerprint(fname)
+    ends = [ str(t.start) for t in tracks[1:] ] + [ "end" ]
+    keys = [ "{}:{}-{}".format(image, t.start, end) for (t, end) in zip(tracks, ends) ]
+    cached = [ cache.get_track(CACHE_SOURCE, k) for k in keys ]
+    album_cached = cache.get_album(CACHE_SOURCE, keys)
+    rows = cached + [ album_cached ]
+    if all(row is not None and (not true_peak or row[2] is not None) for row in rows):
+        logger.debug("Using cached gain for all %s tracks of %s", len(tracks), repr(fname))
+        def values(row: Tuple[float, float, Optional[float]], level: str) -> Dict[str, float]:
+            result = { "replaygain_{}_gain".format(level): row[0], "replaygain_{}_peak".format(level): row[1] }
+            if true_peak:
+                result["replaygain_{}_true_peak".format(level)] = cast(float, row[2])
+            return result
+        return ([ values(cast(Tuple[float, float, Optional[float]], row), "track") for row in cached ],
+                values(cast(Tuple[float, float, Optional[float]], album_cached), "album"))
+    (results, album) = measure_image(fname, tracks, true_peak)
+    for (key, v) in zip(keys, results):
+        cache.put_track(CACHE_SOURCE, key, v["replaygain_track_gain"], v["replaygain_track_peak"],
+                        v.get("replaygain_track_true_peak"))
+    cache.put_album(CACHE_SOURCE, keys, album["replaygain_album_gain"], album["replaygain_album_peak"],
+                    album.get("replaygain_album_true_peak"))
+    return (results, album)
+
+def measure_image(fname: str, tracks: List[CueTrack], true_peak: bool = False
+                  ) -> Tuple[List[Dict[str, float]], Dict[str, float]]:
+    '''Decode the image fname once and measure each track and the album.
+
+    Returns the ReplayGain values of each track in tracks, and of the
+    album, as dicts like those of GainComputer.compute_gain (without
+    the album values in the track dicts). Audio before the first
+    track is not measured.
+
+    '''
+    from rganalysis.dsp import LoudnessMeter, TruePeakMeter, album_loudness, loudness_to_gain, track_loudness
+    from rganalysis.pcm import open_pcm
+    source = open_pcm(fname)
+    try:
+        starts = [ cue_time_to_frames(t.start, source.sample_rate) for t in tracks ]
+        meters = [ LoudnessMeter(source.sample_rate, source.channels) for _ in tracks ]
+        tp_meters = [ TruePeakMeter() for _ in tracks ] if true_peak else []
+        pos = 0
+        for block in source.blocks():
+            offset = 0
+            while offset < len(block):
+                # The track at pos, and where it ends
+                i = bisect.bisect_right(starts, pos) - 1
+                end = starts[i + 1] if i + 1 < len(starts) else pos + len(block)
+                piece = block[offset:offset + (end - pos)]
+                if i >= 0:
+                    meters[i].update(piece)
+                    if true_peak:
+                        tp_meters[i].update(piece)
+                (offset, pos) = (offset + len(piece), pos + len(piece))
+    finally:
+        source.close()
+    loudness = track_loudness(meters)
+    results = []
+    for (i, meter) in enumerate(meters):
+        values = { "replaygain_track_gain": loudness_to_gain(float(loudness[i])),
+                   "replaygain_track_peak": meter.peak }
+        if true_peak:
+            values["replaygain_track_true_peak"] = tp_meters[i].peak
+        results.append(values)
+    album = { "replaygain_album_gain": loudness_to_gain(album_loudness(meters)),
+              "replaygain_album_peak": max(m.peak for m in meters) }
+    if true_peak:
+        album["replaygain_album_true_peak"] = max(m.peak for m in tp_meters)
+    return (results, album)
+
+class CueTrackSet(RGTrackSet):
+    '''A track set made from a single-file image and its CUE sheet.
+
+    It behaves like any other track set, except that its track
+    results are named by cue_track_name, gain_backend is not used
+    for analysis (the image is measured directly, see
+    measure_image_cached), and the gain values are read from and
+    written to the sheet rather than the image's tags. filenames
+    holds only the image.
+
+    '''
+    def __init__(self, track: RGTrack, sheet: CueSheet, sheet_path: Optional[str],
+                 gain_backend: GainComputer, gain_type: str = "auto") -> None:
+        super(CueTrackSet, self).__init__([track], gain_backend=gain_backend, gain_type=gain_type)
+        self.image = track
+        self.sheet = sheet
+        self.sheet_path = sheet_path
+        self.values = sheet.replaygain()
+        self.num_tracks = len(sheet.tracks)
+
+    def __repr__(self) -> str:
+        return "CueTrackSet(%s, %s, gain_type=%s)" % (repr(self.image), repr(self.sheet_path), repr(self.gain_type))
+
+    def track_set_key_string(self) -> str:
+        return "{} (CUE sheet with {} tracks)".format(super(CueTrackSet, self).track_set_key_string(), self.num_tracks)
+
+    def is_multitrack_album(self) -> bool:
+        return True
+
+    def _track_values(self) -> List[Dict[str, float]]:
+        return [ self.values.get(t.number, {}) for t in self.sheet.tracks ]
+
+    @property
+    def gain(self) -> Optional[float]:
+        return self.values[None].get("replaygain_album_gain")
+
+    @property
+    def peak(self) -> Optional[float]:
+        return self.values[None].get("replaygain_album_peak")
+
+    def has_track_rgdata(self) -> bool:
+        return all("replaygain_track_gain" in v and "replaygain_track_peak" in v for v in self._track_values())
+
+    def has_valid_rgdata(self) -> bool:
+        if not self.has_track_rgdata():
+            return False
+        if self.want_album_gain():
+            return self.gain is not None and self.peak is not None
+        else:
+            return self.gain is None and self.peak is None
+
+    def has_provisional_tags(self) -> bool:
+        # The sheet never holds estimates, but the image may have
+        # been estimated as a single track before
+        return not self.gain_backend.provisional and self.gain_backend.is_provisional(self.filenames)
+
+    def has_true_peak_data(self) -> bool:
+        album = self.want_album_gain()
+        return all("replaygain_track_true_peak" in v for v in self._track_values()) and \
+            (not album or "replaygain_album_true_peak" in self.values[None])
+
+    def do_gain(self, force: bool = False, gain_type: Union[None, str] = None,
+                dry_run: bool = False, verbose: bool = False,
+                true_peak: str = "off") -> bool:
+        '''Analyze all tracks of the image and write the gain values to its CUE sheet.
+
+        The arguments and the return value are as for
+        RGTrackSet.do_gain. The image is measured in full even if
+        gain_backend is provisional (i.e. with --fast-estimate).
+        '''
+        global _estimates_ignored
+        if gain_type is not None:
+            self.gain_type = gain_type
+        if true_peak not in ("off", "replace", "separate"):
+            raise TypeError('true_peak must be either "off", "replace", or "separate"')
+        album = self.want_album_gain()
+        if self.has_valid_rgdata() and (true_peak != "separate" or self.has_true_peak_data()):
+            if self.has_provisional_tags():
+                logger.info("Reanalyzing track set %s, which has provisional tags from a fast estimate", repr(self.track_set_key_string()))
+            elif force:
+                logger.info("Forcing reanalysis of previously-analyzed track set %s", repr(self.track_set_key_string()))
+            else:
+                logger.info("Skipping previously-analyzed track set %s", repr(self.track_set_key_string()))
+                return False
+        else:
+            logger.info('Analyzing track set %s', repr(self.track_set_key_string()))
+        if self.gain_backend.provisional and not _estimates_ignored:
+            logger.info("Images with CUE sheets are measured in full, not estimated from excerpts")
+            _estimates_ignored = True
+        with stage('analyze'):
+            (tracks, album_values) = measure_image_cached(self.gain_backend, self.image.filename,
+                                                          self.sheet.tracks, true_peak != "off")
+        peak_tag = "true_peak" if true_peak == "replace" else "peak"
+        def select(values: Dict[str, float], level: str) -> Dict[str, float]:
+            selected = { "replaygain_{}_gain".format(level): values["replaygain_{}_gain".format(level)],
+                         "replaygain_{}_peak".format(level): values["replaygain_{}_{}".format(level, peak_tag)] }
+            if true_peak == "separate":
+                selected["replaygain_{}_true_peak".format(level)] = values["replaygain_{}_true_peak".format(level)]
+            return selected
+        self.values = { t.number: select(v, "track") for (t, v) in zip(self.sheet.tracks, tracks) }
+        self.values[None] = select(album_values, "album") if album else {}
+        with stage('write'):
+            self.save()
+        # The values are not estimates, so they must not be recorded
+        # as provisional
+        if not dry_run and not self.gain_backend.provisional:
+            self.gain_backend.tags_saved({ self.image.filename: self.values[None] })
+        return True
+
+    def audit_gain(self, tolerance: float = 0.5, gain_type: Union[None, str] = None) -> AlbumResult:
+        '''Measure the image and compare the result with its CUE sheet, as RGTrackSet.audit_gain does.'''
+        if gain_type is not None:
+            self.gain_type = gain_type
+        album = self.want_album_gain()
+        logger.info('Auditing track set %s', repr(self.track_set_key_string()))
+        (tracks, album_values) = measure_image(self.image.filename, self.sheet.tracks)
+        diffs = [ abs(v["replaygain_track_gain"] - stored["replaygain_track_gain"])
+                  for (v, stored) in zip(tracks, self._track_values()) ]
+        if album:
+            diffs.append(abs(album_values["replaygain_album_gain"] - self.gain))
+        drift = max(diffs)
+        if drift > tolerance:
+            logger.warning("Gain of track set %s differs from its tags by up to %.2f dB", repr(self.track_set_key_string()), drift)
+        return self.result(DRIFTED if drift > tolerance else CONSISTENT)._replace(
+            album_gain=album_values["replaygain_album_gain"] if album else None,
+            album_peak=album_values["replaygain_album_peak"] if album else None,
+            tracks=[ TrackResult(cue_track_name(self.image.filename, t.number), v["replaygain_track_gain"],
+                                 v["replaygain_track_peak"], None, None)
+                     for (t, v) in zip(self.sheet.tracks, tracks) ],
+            drift=drift)
+
+    def result(self, status: str, error: Optional[str] = None,
+               quarantined: Sequence[str] = ()) -> AlbumResult:
+        album = self.want_album_gain()
+        return AlbumResult(
+            key=self.track_set_key_string(),
+            directory=self.directory,
+            status=status,
+            gain_type="album" if album else "track",
+            album_gain=self.gain if album else None,
+            album_peak=self.peak if album else None,
+            tracks=[ TrackResult(cue_track_name(self.image.filename, t.number), v.get("replaygain_track_gain"),
+                                 v.get("replaygain_track_peak"), None, v.get("replaygain_track_true_peak"))
+                     for (t, v) in zip(self.sheet.tracks, self._track_values()) ],
+            error=error,
+            quarantined=list(quarantined),
+            provisional=False,
+            album_gain_error=None,
+            drift=None,
+            album_true_peak=self.values[None].get("replaygain_album_true_peak") if album else None)
+
+    def report(self) -> None:
+        for (t, v) in zip(self.sheet.tracks, self._track_values()):
+            logger.info("Set track gain tags for track %s of %s:\n\tTrack Gain: %s\n\tTrack Peak: %s", t.number,
+                        self.image.filename, v.get("replaygain_track_gain"), v.get("replaygain_track_peak"))
+        if self.want_album_gain():
+            logger.info("Set album gain tags for %s:\n\tAlbum Gain: %s\n\tAlbum Peak: %s",
+                        self.track_set_key_string(), self.gain, self.peak)
+        else:
+            logger.info("Did not set album gain tags for %s.", self.track_set_key_string())
+
+    def save(self) -> None:
+        '''Write the gain values to the CUE sheet.'''
+        self.report()
+        if isinstance(self.image, RGTrackDryRun):
+            return
+        text = self.sheet.with_replaygain(self.values)
+        if self.sheet_path is None:
+            logger.debug("Writing embedded CUE sheet of %s", repr(self.image.filename))
+            self.image.track['cuesheet'] = text
+            self.image.track.save()
+        else:
+            logger.debug("Writing CUE sheet %s", repr(self.sheet_path))
+            tmp = self.sheet_path + '.tmp'
+            with open(tmp, 'w', encoding=self.sheet.encoding, newline='') as f:
+                f.write(text)
+            os.replace(tmp, self.sheet_path)
+        # The line numbers of the tracks have changed
+        (encoding, self.sheet) = (self.sheet.encoding, CueSheet(text))
+        self.sheet.encoding = encoding
+
+def apply_result(result: AlbumResult, dry_run: bool = False) -> None:
+    '''Write the gain values of a CueTrackSet's result (e.g. exported by
+    rganalysis.export) to the image's CUE sheet.'''
+    image = cast(Tuple[str, int], split_cue_track_name(result.tracks[0].filename))[0]
+    track = RGTrackDryRun(image) if dry_run else RGTrack(image)
+    cue = find_cue_sheet(track)
+    if cue is None:
+        raise ValueError("{!r} no longer has a CUE sheet".format(image))
+    track_set = CueTrackSet(track, cue[0], cue[1], gain_backend=NullGainComputer())
+    values = {}                 # type: CueValues
+    for t in result.tracks:
+        number = cast(Tuple[str, int], split_cue_track_name(t.filename))[1]
+        values[number] = { "replaygain_track_gain": t.gain, "replaygain_track_peak": t.peak }
+        if t.true_peak is not None:
+            values[number]["replaygain_track_true_peak"] = t.true_peak
+    values[None] = {}
+    if result.gain_type == "album":
+        values[None] = { "replaygain_album_gain": result.album_gain, "replaygain_album_peak": result.album_peak }
+        if result.album_true_peak is not None:
+            values[None]["replaygain_album_true_peak"] = result.album_true_peak
+    track_set.values = values
+    track_set.save()
@@ -0,0 +1,331 @@
+'''Signal processing on decoded PCM audio, using NumPy.
+
+Samples are passed around as float32 arrays of shape (frames,
+channels), scaled to the range [-1, 1].
+
+'''
+
+from typing import Any, Dict, List, Optional, Sequence
+
+import math
+
+import numpy as np
+
+from numpy.lib.stride_tricks import sliding_window_view
+
+try:
+    from scipy.signal import sosfilt
+except ImportError:
+    sosfilt = None
+
+# ReplayGain 2.0 reference level, in LUFS
+REFERENCE_LOUDNESS = -18.0
+# Loudness reported for silence, the absolute gating threshold of
+# BS.1770
+SILENCE_LOUDNESS = -70.0
+
+def pcm_to_float(data: Any, bits_per_sample: int, channels: int,
+                 signed: bool = True, big_endian: bool = False,
+                 is_float: bool = False) -> np.ndarray:
+    '''Convert interleaved PCM samples to a (frames, channels) float array.
+
+    data may be bytes or any other object supporting the buffer
+    protocol, such as a contiguous view of a memory-mapped file. It
+    holds integer samples, or floating point samples if is_float is
+    True.
+
+    '''
+    width = (bits_per_sample + 7) // 8
+    endian = '>' if big_endian else '<'
+    if is_float:
+        samples = np.frombuffer(data, dtype='{}f{}'.format(endian, width)).astype(np.float32)
+    elif width == 3:
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+        if big_endian:
+            raw = raw[:, ::-1]
+        # Place the 3 bytes in the top of a 32-bit integer to sign-extend
+        as_int = (raw[:, 0].astype(np.int32) << 8) | (raw[:, 1].astype(np.int32) << 16) | \
+                 (raw[:, 2].astype(np.int32) << 24)
+        samples = as_int.astype(np.float32) / float(1 << 31)
+    else:
+        kind = 'i' if signed else 'u'
+        samples = np.frombuffer(data, dtype='{}{}{}'.format(endian, kind, width)).astype(np.float32)
+        if not signed:
+            samples -= float(1 << (8 * width - 1))
+        samples /= float(1 << (8 * width - 1))
+    return samples.reshape(-1, channels)
+
+def _polyphase_filter(oversample: int, taps_per_phase: int) -> np.ndarray:
+    '''Return the interpolation filter as a (taps_per_phase, oversample) matrix.
+
+    Column p holds the coefficients that compute the output at
+    fractional position p/oversample between two input samples, so
+    phase 0 reproduces the input samples themselves.
+
+    '''
+    n = oversample * taps_per_phase
+    # Tap positions in input samples, with an input sample at 0
+    t = (np.arange(n) - taps_per_phase // 2 * oversample) / oversample
+    # Windowed sinc lowpass at the original Nyquist frequency, with a
+    # Kaiser window centered on 0
+    beta = 8.0
+    window = np.i0(beta * np.sqrt(np.clip(1 - (t / (taps_per_phase / 2)) ** 2, 0, None))) / np.i0(beta)
+    h = np.sinc(t) * window
+    h = h.reshape(taps_per_phase, oversample)
+    # Normalize each phase to unity gain at DC
+    h /= h.sum(axis=0, keepdims=True)
+    return h.astype(np.float32)
+
+class TruePeakMeter(object):
+    '''Measures the true (inter-sample) peak of a stream of samples.
+
+    The signal is oversampled by a factor of 4 with a polyphase FIR
+    interpolator, as recommended by ITU-R BS.1770, and the peak is
+    the largest absolute value of the oversampled signal (or of the
+    original samples, if that is larger). Each block passed to update
+    is filtered as a single batched matrix product of every window of
+    input samples, for all channels, with the matrix of all filter
+    phases.
+
+    '''
+    def __init__(self, oversample: int = 4, taps_per_phase: int = 12) -> None:
+        # Reversed, so that it can be applied to windows of samples in
+        # their natural order
+        self.filter = _polyphase_filter(oversample, taps_per_phase)[::-1].copy()
+        self.history = None     # type: Optional[np.ndarray]
+        self.peak = 0.0
+
+    def update(self, samples: np.ndarray) -> None:
+        '''Add a block of samples of shape (frames, channels).'''
+        if len(samples) == 0:
+            return
+        taps = self.filter.shape[0]
+        # Channels first, with the last taps-1 samples of the previous
+        # block in front
+        x = np.asarray(samples, dtype=np.float32).T
+        if self.history is None:
+            self.history = np.zeros((x.shape[0], taps - 1), dtype=np.float32)
+        x = np.concatenate([self.history, x], axis=1)
+        self.history = x[:, -(taps - 1):].copy()
+        # (channels, frames, taps) @ (taps, oversample)
+        out = sliding_window_view(x, taps, axis=1) @ self.filter
+        self.peak = max(self.peak, float(np.abs(out).max()), float(np.abs(samples).max()))
+
+def k_weighting(sample_rate: int) -> np.ndarray:
+    '''Return the BS.1770 K-weighting filter for sample_rate.
+
+    The result is in second-order sections, for scipy.signal.sosfilt:
+    a high shelf followed by a high pass, with their analog
+    parameters matched at any sample rate as in libebur128.
+
+    '''
+    # Shelving filter
+    (f0, gain, q) = (1681.974450955533, 3.999843853973347, 0.7071752369554196)
+    k = math.tan(math.pi * f0 / sample_rate)
+    vh = 10 ** (gain / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = [(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0,
+             1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+    # High pass filter
+    (f0, q) = (38.13547087602444, 0.5003270373238773)
+    k = math.tan(math.pi * f0 / sample_rate)
+    a0 = 1 + k / q + k * k
+    highpass = [1.0, -2.0, 1.0,
+                1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+    return np.array([shelf, highpass])
+
+def channel_weights(channels: int) -> np.ndarray:
+    '''Return the BS.1770 weight of each channel.
+
+    Surround channels of 5 and 5.1 channel audio count 1.41 times as
+    much as the front channels, and the LFE channel is ignored.
+
+    '''
+    if channels == 5:
+        return np.array([1.0, 1.0, 1.0, 1.41, 1.41])
+    elif channels == 6:
+        return np.array([1.0, 1.0, 1.0, 0.0, 1.41, 1.41])
+    else:
+        return np.ones(channels)
+
+def block_loudness(power: np.ndarray) -> np.ndarray:
+    '''Convert mean square block power to loudness in LUFS.'''
+    with np.errstate(divide='ignore'):
+        return -0.691 + 10 * np.log10(power)
+
+def gated_blocks(blocks: np.ndarray) -> np.ndarray:
+    '''Return the boolean mask of the blocks that pass the BS.1770 gates.
+
+    Blocks quieter than -70 LUFS are dropped, then blocks more than
+    10 LU below the loudness of the remaining ones.
+
+    '''
+    blocks = np.asarray(blocks, dtype=np.float64)
+    loudness = block_loudness(blocks)
+    mask = loudness > SILENCE_LOUDNESS
+    if mask.any():
+        relative = block_loudness(blocks[mask].mean()) - 10
+        mask &= loudness > relative
+    return mask
+
+def integrated_loudness_batch(blocks: np.ndarray, counts: Sequence[int]) -> np.ndarray:
+    '''Return the gated loudness in LUFS of several tracks at once.
+
+    blocks is a (blocks, tracks) array of block powers, of which the
+    first counts[i] in column i are valid. The gates are applied to
+    all columns together, with the same result as integrated_loudness
+    on each column.
+
+    '''
+    blocks = np.asarray(blocks, dtype=np.float64)
+    valid = np.arange(blocks.shape[0])[:, None] < np.asarray(counts)[None, :]
+    loudness = block_loudness(np.where(valid, blocks, 0.0))
+    mask = valid & (loudness > SILENCE_LOUDNESS)
+    def gated_mean(mask: np.ndarray) -> np.ndarray:
+        n = mask.sum(axis=0)
+        total = np.where(mask, blocks, 0.0).sum(axis=0)
+        return np.where(n > 0, total / np.maximum(n, 1), 0.0)
+    relative = block_loudness(gated_mean(mask)) - 10
+    mask &= loudness > relative[None, :]
+    result = block_loudness(gated_mean(mask))
+    return np.where(mask.any(axis=0), result, SILENCE_LOUDNESS)
+
+def integrated_loudness(blocks: np.ndarray) -> float:
+    '''Return the gated loudness in LUFS of an array of block powers.'''
+    blocks = np.asarray(blocks, dtype=np.float64)
+    mask = gated_blocks(blocks)
+    if not mask.any():
+        return SILENCE_LOUDNESS
+    return float(block_loudness(blocks[mask].mean()))
+
+def loudness_to_gain(loudness: float) -> float:
+    '''Return the ReplayGain 2.0 gain for a loudness in LUFS.'''
+    return REFERENCE_LOUDNESS - loudness
+
+class LoudnessMeter(object):
+    '''Measures the loudness of audio as described in ITU-R BS.1770.
+
+    Samples are K-weighted, and the weighted mean square of all
+    channels is computed over 400 ms blocks overlapping by 75%. The
+    block powers are kept in blocks, to be gated by
+    integrated_loudness; the powers of the blocks of several tracks
+    together give the loudness of the album. The sample peak is kept
+    in peak.
+
+    Audio that is not contiguous (e.g. excerpts of a track) should
+    be separated by calls to reset, which starts a new segment:
+    blocks never span two segments. The blocks of each segment are
+    in segment_blocks.
+
+    Requires scipy, for the K-weighting filter.
+
+    '''
+    def __init__(self, sample_rate: int, channels: int) -> None:
+        if sosfilt is None:
+            raise ImportError("Loudness measurement requires scipy")
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.sos = k_weighting(sample_rate)
+        self.weights = channel_weights(channels)
+        # Blocks are made of 4 steps of 100 ms each
+        self.step = int(round(sample_rate * 0.1))
+        self.peak = 0.0
+        self.segment_blocks = []  # type: List[np.ndarray]
+        self._start_segment()
+
+    def _start_segment(self) -> None:
+        self.zi = np.zeros((self.sos.shape[0], 2, self.channels))
+        self.pending = np.zeros((0, self.channels))
+        self.steps = []         # type: List[np.ndarray]
+
+    def _current_blocks(self) -> Optional[np.ndarray]:
+        if self.steps:
+            steps = np.concatenate(self.steps)
+            if len(steps) >= 4:
+                # Each block is the mean of 4 consecutive steps
+                return (steps[:-3] + steps[1:-2] + steps[2:-1] + steps[3:]) / 4
+        return None
+
+    def reset(self) -> None:
+        '''Start a new segment of audio.'''
+        blocks = self._current_blocks()
+        if blocks is not None:
+            self.segment_blocks.append(blocks)
+        self._start_segment()
+
+    def update(self, samples: np.ndarray) -> None:
+        '''Add a block of samples of shape (frames, channels).'''
+        if len(samples) == 0:
+            return
+        self.peak = max(self.peak, float(samples.max()), -float(samples.min()))
+        self._add(samples)
+
+    def _add(self, samples: np.ndarray) -> None:
+        (weighted, self.zi) = sosfilt(self.sos, samples, axis=0, zi=self.zi)
+        x = np.concatenate([self.pending, weighted])
+        usable = len(x) - len(x) % self.step
+        (x, self.pending) = (x[:usable], x[usable:])
+        if usable:
+            # Mean square of each 100 ms step, summed over channels
+            # (einsum is much faster than a strided mean here)
+            steps = x.reshape(-1, self.step, self.channels)
+            squares = np.einsum('nsc,nsc->nc', steps, steps) / self.step
+            self.steps.append(squares @ self.weights)
+
+    @property
+    def blocks(self) -> np.ndarray:
+        '''The powers of all complete blocks so far.'''
+        current = self._current_blocks()
+        blocks = self.segment_blocks + ([current] if current is not None else [])
+        return np.concatenate(blocks) if blocks else np.zeros(0)
+
+    def loudness(self) -> float:
+        '''Return the integrated loudness so far, in LUFS.'''
+        return integrated_loudness(self.blocks)
+
+def track_loudness(meters: Sequence[LoudnessMeter]) -> np.ndarray:
+    '''Return the integrated loudness of each meter's audio, in LUFS.
+
+    The block powers of all meters are gated together as one 2-D
+    array, instead of one meter at a time.
+
+    '''
+    blocks = [ m.blocks for m in meters ]
+    counts = [ len(b) for b in blocks ]
+    stacked = np.zeros((max(counts, default=0), len(blocks)))
+    for (i, b) in enumerate(blocks):
+        stacked[:len(b), i] = b
+    return integrated_loudness_batch(stacked, counts)
+
+def album_loudness(meters: Sequence[LoudnessMeter]) -> float:
+    '''Return the integrated loudness of several meters' audio together.'''
+    return integrated_loudness(np.concatenate([m.blocks for m in meters]))
+
+def replaygain_info(meters: Dict[str, LoudnessMeter], tp_meters: Optional[Dict[str, TruePeakMeter]] = None,
+                    album: bool = True) -> Dict[str, Dict[str, float]]:
+    '''Return the ReplayGain values of measured files, as GainComputer.compute_gain does.
+
+    meters maps each file name to the LoudnessMeter that measured it,
+    and tp_meters, if true peaks were measured, to its TruePeakMeter.
+
+    '''
+    rginfo = {}
+    loudness = track_loudness(list(meters.values()))
+    for (i, (fname, meter)) in enumerate(meters.items()):
+        rginfo[fname] = {
+            "replaygain_track_gain": loudness_to_gain(float(loudness[i])),
+            "replaygain_track_peak": meter.peak,
+        }
+        if tp_meters is not None:
+            rginfo[fname]["replaygain_track_true_peak"] = tp_meters[fname].peak
+    if album and meters:
+        album_tags = {
+            "replaygain_album_gain": loudness_to_gain(album_loudness(list(meters.values()))),
+            "replaygain_album_peak": max(m.peak for m in meters.values()),
+        }
+        if tp_meters is not None:
+            album_tags["replaygain_album_true_peak"] = max(m.peak for m in tp_meters.values())
+        for tags in rginfo.values():
+            tags.update(album_tags)
+    return rginfo
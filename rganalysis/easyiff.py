@@ -0,0 +1,57 @@
+'''EasyID3 tags for WAV and AIFF files.
+
+mutagen reads the ID3 chunk of WAV and AIFF files, but has no "easy"
+variant of these formats, so opening them with easy=True gives raw
+ID3 frames, on which tags like "replaygain_track_gain" can be neither
+read nor written. EasyWAVE and EasyAIFF wrap the ID3 chunk in
+EasyIFFID3, so that ReplayGain values go to the same TXXX frames as
+for MP3 files (see rganalysis.MusicFile).
+
+'''
+
+from typing import Any, Optional
+
+from mutagen.aiff import AIFF
+from mutagen.easyid3 import EasyID3
+from mutagen.id3 import ID3
+from mutagen.wave import WAVE
+
+class EasyIFFID3(EasyID3):
+    '''The EasyID3 interface to the ID3 chunk of a WAV or AIFF file.'''
+    def __init__(self, id3: ID3) -> None:
+        super(EasyIFFID3, self).__init__()
+        # EasyID3 has no way to wrap an existing ID3 instance, which
+        # here knows how to write itself to a RIFF or IFF file
+        self._EasyID3__id3 = id3
+
+    def save(self, filething: Any = None, v1: Optional[int] = None, **kwargs: Any) -> None:
+        # The ID3 chunk has no ID3v1 tag, so v1 is not accepted
+        self._EasyID3__id3.save(filething, **kwargs)
+
+class EasyWAVE(WAVE):
+    '''Like mutagen.wave.WAVE, but with EasyIFFID3 tags.'''
+    def load(self, *args: Any, **kwargs: Any) -> None:
+        super(EasyWAVE, self).load(*args, **kwargs)
+        if self.tags is not None:
+            self.tags = EasyIFFID3(self.tags)
+
+    def add_tags(self) -> None:
+        super(EasyWAVE, self).add_tags()
+        self.tags = EasyIFFID3(self.tags)
+
+class EasyAIFF(AIFF):
+    '''Like mutagen.aiff.AIFF, but with EasyIFFID3 tags.'''
+    def load(self, *args: Any, **kwargs: Any) -> None:
+        super(EasyAIFF, self).load(*args, **kwargs)
+        if self.tags is not None:
+            self.tags = EasyIFFID3(self.tags)
+
+    def add_tags(self) -> None:
+        super(EasyAIFF, self).add_tags()
+        self.tags = EasyIFFID3(self.tags)
+
+# Easy variants of the types that mutagen.File returns
+easy_types = {
+    WAVE: EasyWAVE,
+    AIFF: EasyAIFF,
+}
@@ -0,0 +1,416 @@
+'''Execution engine for analyzing track sets in parallel.'''
+
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+
+from functools import partial
+from itertools import chain
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import Connection
+from multiprocessing.pool import ThreadPool
+
+from rganalysis import RGTrackSet, profiling
+from rganalysis.backends import GainComputer
+from rganalysis.common import logger, default_job_count
+from rganalysis.concurrency import ByteRateLimiter, ConcurrencyController, set_io_priority
+from rganalysis.quarantine import SkipList
+from rganalysis.results import AlbumResult, ANALYZED, SKIPPED, FAILED
+
+class PickleableMethodCaller(object):
+    '''Pickleable method caller for multiprocessing.Pool.imap'''
+    def __init__(self, method_name: str, *args , **kwargs) -> None:
+        self.method_name = method_name
+        self.args = args
+        self.kwargs = kwargs
+    def __call__(self, obj: Any) -> Any:
+        try:
+            return getattr(obj, self.method_name)(*self.args, **self.kwargs)
+        except KeyboardInterrupt:
+            sys.exit(1)
+
+class TrackSetHandler(PickleableMethodCaller):
+    '''Pickleable callable for multiprocessing.Pool.imap'''
+    def __init__(self, force: bool = False, gain_type: str = "auto",
+                 dry_run: bool = False, verbose: bool = False,
+                 true_peak: str = "off") -> None:
+        super(TrackSetHandler, self).__init__(
+            "do_gain",
+            force = force,
+            gain_type = gain_type,
+            verbose = verbose,
+            dry_run = dry_run,
+            true_peak = true_peak,
+        )
+    def __call__(self, track_set: RGTrackSet) -> AlbumResult:
+        try:
+            analyzed = super(TrackSetHandler, self).__call__(track_set)
+            return track_set.result(ANALYZED if analyzed else SKIPPED)
+        except Exception:
+            logger.error("Failed to analyze %s. Skipping this track set. The exception was:\n\n%s\n",
+                         track_set.track_set_key_string(), traceback.format_exc())
+            return track_set.result(FAILED, error=traceback.format_exc())
+
+class AuditHandler(PickleableMethodCaller):
+    '''Pickleable callable that audits a track set (see rganalysis.audit)'''
+    def __init__(self, tolerance: float = 0.5, gain_type: str = "auto") -> None:
+        super(AuditHandler, self).__init__(
+            "audit_gain",
+            tolerance = tolerance,
+            gain_type = gain_type,
+        )
+    def __call__(self, track_set: RGTrackSet) -> AlbumResult:
+        try:
+            return super(AuditHandler, self).__call__(track_set)
+        except Exception:
+            logger.error("Failed to audit %s. Skipping this track set. The exception was:\n\n%s\n",
+                         track_set.track_set_key_string(), traceback.format_exc())
+            return track_set.result(FAILED, error=traceback.format_exc())
+
+class RetryPolicy(object):
+    '''Deadlines and retries for analyzing a track set in a subprocess.
+
+    A track set is given base_timeout seconds plus timeout_factor
+    seconds per second of audio. When it takes longer (or the worker
+    crashes), the worker is killed and the track set is retried up to
+    retries more times, waiting backoff seconds before the first retry
+    and twice as long before each further one. If all attempts fail,
+    each track is tried on its own to find the files responsible, and
+    those are added to the skip list.
+
+    A timeout_factor of 0 disables the deadline.
+
+    '''
+    def __init__(self, timeout_factor: float = 2.0, base_timeout: float = 60.0,
+                 retries: int = 2, backoff: float = 5.0) -> None:
+        if retries < 0:
+            raise ValueError("retries must not be negative")
+        self.timeout_factor = timeout_factor
+        self.base_timeout = base_timeout
+        self.retries = retries
+        self.backoff = backoff
+
+    def __repr__(self) -> str:
+        return "RetryPolicy(timeout_factor={!r}, base_timeout={!r}, retries={!r}, backoff={!r})".format(
+            self.timeout_factor, self.base_timeout, self.retries, self.backoff)
+
+    def timeout(self, length_seconds: float) -> Optional[float]:
+        '''Return the deadline for length_seconds of audio, or None.'''
+        if self.timeout_factor <= 0:
+            return None
+        return self.base_timeout + self.timeout_factor * length_seconds
+
+def _send_result(func: Callable, args: Tuple, conn: Connection, io_priority: str,
+                 profile: Optional[profiling.ProfileOptions]) -> None:
+    try:
+        try:
+            set_io_priority(io_priority)
+            profiling.start_worker_session(profile)
+            result = func(*args)
+        finally:
+            # Write the profile of failed analyses too, before the
+            # parent sees the result
+            profiling.stop_session()
+        conn.send(result)
+    finally:
+        conn.close()
+
+def call_in_subprocess(func: Callable, args: Tuple, timeout: Optional[float] = None,
+                       io_priority: str = 'normal') -> Tuple[Any, Optional[int], bool]:
+    '''Call func(*args) in a subprocess.
+
+    Returns a tuple of the result, the exit code of the subprocess,
+    and whether it timed out. The result is None if the subprocess
+    died or did not finish within timeout seconds, in which case it
+    is killed. io_priority is passed to set_io_priority in the
+    subprocess.
+
+    '''
+    (recv_conn, send_conn) = Pipe(duplex=False)
+    p = Process(target=_send_result, args=(func, args, send_conn, io_priority, profiling.current_options()))
+    result = None
+    timed_out = False
+    try:
+        p.start()
+        # Only the child should hold the sending end, so that recv
+        # fails instead of blocking if the child dies
+        send_conn.close()
+        try:
+            if recv_conn.poll(timeout):
+                result = recv_conn.recv()
+            else:
+                timed_out = True
+        except EOFError:
+            pass
+        if p.is_alive():
+            p.join(5 if result is not None else 0)
+    finally:
+        recv_conn.close()
+        if p.is_alive():
+            logger.debug("Killing subprocess")
+            p.terminate()
+            p.join(5)
+            if p.is_alive():
+                p.kill()
+                p.join()
+    return (result, p.exitcode, timed_out)
+
+def _probe_file(gain_backend: GainComputer, fname: str) -> bool:
+    gain_backend.compute_gain([fname], album=False)
+    return True
+
+def isolate_bad_files(track_set: RGTrackSet, policy: RetryPolicy, io_priority: str = 'normal') -> List[str]:
+    '''Return the files of track_set that cannot be analyzed on their own.'''
+    bad_files = []
+    for fname in track_set.filenames:
+        timeout = policy.timeout(track_set.RGTracks[fname].length_seconds)
+        (ok, exitcode, timed_out) = call_in_subprocess(_probe_file, (track_set.gain_backend, fname),
+                                                       timeout, io_priority)
+        if not ok:
+            logger.debug("Analysis of %s on its own failed with exit code %s", repr(fname), exitcode)
+            bad_files.append(fname)
+    return bad_files
+
+def run_in_subprocess(handler: TrackSetHandler, track_set: RGTrackSet,
+                      policy: Optional[RetryPolicy] = None,
+                      skip_list: Optional[SkipList] = None,
+                      io_priority: str = 'normal') -> AlbumResult:
+    '''Run handler on track_set in a subprocess and return its result.
+
+    If policy is given, it determines the deadline for the subprocess
+    and how failures are retried. Failures of the files found to be
+    responsible for repeated failures are recorded in skip_list, if
+    given, which quarantines them once they have failed in enough
+    runs. io_priority is passed to set_io_priority in the subprocess.
+
+    '''
+    policy = policy or RetryPolicy(timeout_factor=0, retries=0)
+    timeout = policy.timeout(track_set.length_seconds)
+    key = track_set.track_set_key_string()
+    for attempt in range(policy.retries + 1):
+        if attempt > 0:
+            delay = policy.backoff * 2 ** (attempt - 1)
+            logger.warning("Retrying %s in %s seconds (attempt %s of %s)", key, delay, attempt + 1, policy.retries + 1)
+            time.sleep(delay)
+        (result, exitcode, timed_out) = call_in_subprocess(handler, (track_set,), timeout, io_priority)
+        if result is not None:
+            if skip_list is not None:
+                skip_list.clear(track_set.filenames)
+            return result
+        if timed_out:
+            logger.error("Analysis of %s did not finish within %.0f seconds", key, timeout)
+        else:
+            logger.error("Subprocess exited with code %s for %s", exitcode, key)
+    error = "Analysis failed {} times".format(policy.retries + 1)
+    quarantined = []            # type: List[str]
+    if policy.retries > 0 and skip_list is not None:
+        for fname in isolate_bad_files(track_set, policy, io_priority):
+            if skip_list.add(fname, error):
+                logger.error("Adding %s to the skip list", repr(fname))
+                quarantined.append(fname)
+            else:
+                logger.error("Recording a failure of %s, which will be skipped if it fails again in a later run", repr(fname))
+    return track_set.result(FAILED, error=error, quarantined=quarantined)
+
+def _handle_all(handler: TrackSetHandler, track_sets: List[RGTrackSet]) -> List[AlbumResult]:
+    return [ handler(ts) for ts in track_sets ]
+
+def coalesce(track_sets: Iterable[RGTrackSet], max_seconds: float) -> Iterator[List[RGTrackSet]]:
+    '''Group consecutive track sets into batches of at most max_seconds of audio.
+
+    Track sets longer than max_seconds get a batch of their own. With
+    a max_seconds of 0, every track set does.
+
+    '''
+    batch = []                  # type: List[RGTrackSet]
+    total = 0.0
+    for ts in track_sets:
+        length = ts.length_seconds
+        if batch and total + length > max_seconds:
+            yield batch
+            (batch, total) = ([], 0.0)
+        batch.append(ts)
+        total += length
+    if batch:
+        yield batch
+
+def run_batch_in_subprocess(handler: TrackSetHandler, track_sets: List[RGTrackSet],
+                            policy: Optional[RetryPolicy] = None,
+                            skip_list: Optional[SkipList] = None,
+                            io_priority: str = 'normal') -> List[AlbumResult]:
+    '''Run handler on several track sets in a single subprocess.
+
+    This saves starting a subprocess for each of many small track
+    sets. If the subprocess fails, each track set is run again on its
+    own with run_in_subprocess, so that retries and the skip list
+    work as for any other track set.
+
+    '''
+    if len(track_sets) == 1:
+        return [ run_in_subprocess(handler, track_sets[0], policy, skip_list, io_priority) ]
+    policy = policy or RetryPolicy(timeout_factor=0, retries=0)
+    timeout = policy.timeout(sum(ts.length_seconds for ts in track_sets))
+    (results, exitcode, timed_out) = call_in_subprocess(_handle_all, (handler, track_sets), timeout, io_priority)
+    if results is not None:
+        if skip_list is not None:
+            skip_list.clear(f for ts in track_sets for f in ts.filenames)
+        return results
+    logger.warning("Analysis of a batch of %s track sets failed (%s), analyzing them separately",
+                   len(track_sets), "timed out" if timed_out else "exit code {}".format(exitcode))
+    return [ run_in_subprocess(handler, ts, policy, skip_list, io_priority) for ts in track_sets ]
+
+class WorkerPool(object):
+    '''A reusable pool of workers for analyzing track sets.
+
+    With more than one job, each track set is analyzed in a
+    subprocess started from one of the pool's threads. (A process
+    pool doesn't work, so instead we use a Process instance within
+    each thread.) Since the subprocesses are forked from the current
+    process, they start with all of its modules already loaded, so
+    keeping a WorkerPool around lets a long-running program analyze
+    many albums without paying any startup cost per call.
+
+    If min_jobs is given, jobs is the maximum number of track sets
+    analyzed at once, and a ConcurrencyController varies the actual
+    number between min_jobs and jobs. If max_read_rate is given,
+    albums are started no faster than that many bytes of input per
+    second (see ByteRateLimiter). io_priority is passed to
+    set_io_priority in each worker process.
+
+    Consecutive track sets with less than batch_seconds of audio
+    together are analyzed in the same subprocess (see coalesce), so
+    that collections of many short albums or singles don't spend most
+    of their time starting subprocesses. A batch_seconds of 0 gives
+    each track set its own subprocess.
+
+    io_order is "walk" (the default) to analyze the track sets in the
+    order they are given, each going to the next free worker, or
+    "locality" to sort them by the position of their files on disk
+    and give each worker a contiguous share of them (see
+    rganalysis.locality), which avoids seeking on spinning disks.
+    "locality" needs all track sets up front.
+
+    '''
+    def __init__(self, jobs: int = 1, min_jobs: Optional[int] = None,
+                 max_read_rate: Optional[int] = None, io_priority: str = 'normal',
+                 batch_seconds: float = 60.0, io_order: str = 'walk') -> None:
+        if io_order not in ('walk', 'locality'):
+            raise ValueError('io_order must be either "walk" or "locality"')
+        self.jobs = jobs
+        self.io_priority = io_priority
+        self.batch_seconds = batch_seconds
+        self.io_order = io_order
+        self.controller = None  # type: Optional[ConcurrencyController]
+        if min_jobs is not None and jobs > 1:
+            self.controller = ConcurrencyController(min_jobs, jobs, max_read_rate=max_read_rate)
+        self.limiter = ByteRateLimiter(max_read_rate) if max_read_rate else None # type: Optional[ByteRateLimiter]
+        self.pool = ThreadPool(jobs) if jobs > 1 else None # type: Optional[ThreadPool]
+
+    def __enter__(self) -> 'WorkerPool':
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, tb: Any) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def run(self, track_sets: Iterable[RGTrackSet], handler: TrackSetHandler,
+            policy: Optional[RetryPolicy] = None,
+            skip_list: Optional[SkipList] = None) -> Iterator[AlbumResult]:
+        '''Apply handler to each track set, yielding results as they complete.
+
+        With more than one job, the results are yielded in order of
+        completion, not in the order of track_sets. policy and
+        skip_list are passed to run_in_subprocess. With a single job,
+        track sets are only analyzed in a subprocess if policy sets a
+        deadline, since otherwise nothing could interrupt a hung
+        analysis.
+
+        '''
+        wrapped_handler = partial(self._run_batch, handler, policy, skip_list)
+        if self.io_order == 'locality':
+            from rganalysis.locality import order_by_locality
+            track_sets = order_by_locality(track_sets)
+        batches = coalesce(track_sets, self.batch_seconds)
+        if self.pool is None:
+            # Sequential
+            if (policy is not None and policy.timeout_factor > 0) or \
+               self.limiter is not None or self.io_priority != 'normal':
+                return chain.from_iterable(map(wrapped_handler, batches))
+            return map(handler, track_sets)
+        elif self.io_order == 'locality':
+            return self._run_shares(wrapped_handler, list(batches))
+        else:
+            # Parallel
+            return chain.from_iterable(self.pool.imap_unordered(wrapped_handler, batches)) # type: ignore # https://github.com/python/typeshed/issues/683
+
+    def _run_shares(self, func: Callable[[List[RGTrackSet]], List[AlbumResult]],
+                    batches: List[List[RGTrackSet]]) -> Iterator[AlbumResult]:
+        '''Run func on contiguous shares of batches, one share per worker thread.
+
+        If func raises an exception, the other shares stop after their
+        current batch, and the exception is raised once they have.
+
+        '''
+        from rganalysis.locality import split_evenly
+        shares = split_evenly(batches, self.jobs, lambda batch: sum(ts.length_seconds for ts in batch))
+        done = queue.Queue()    # type: queue.Queue
+        cancelled = threading.Event()
+        def run_share(share: List[List[RGTrackSet]]) -> None:
+            try:
+                for batch in share:
+                    if cancelled.is_set():
+                        break
+                    done.put(func(batch))
+            except BaseException as ex:
+                done.put(ex)
+            finally:
+                done.put(None)
+        assert self.pool is not None
+        for share in shares:
+            self.pool.apply_async(run_share, (share,))
+        remaining = len(shares)
+        error = None            # type: Optional[BaseException]
+        try:
+            while remaining:
+                item = done.get()
+                if item is None:
+                    remaining -= 1
+                elif isinstance(item, BaseException):
+                    if error is None:
+                        error = item
+                        cancelled.set()
+                elif error is None:
+                    yield from item
+        finally:
+            # Also stop the shares if the results are no longer wanted
+            cancelled.set()
+        if error is not None:
+            raise error
+
+    def _run_batch(self, handler: TrackSetHandler, policy: Optional[RetryPolicy],
+                   skip_list: Optional[SkipList], track_sets: List[RGTrackSet]) -> List[AlbumResult]:
+        if self.limiter is not None:
+            self.limiter.consume(sum(os.path.getsize(f) for ts in track_sets for f in ts.filenames))
+        if self.controller is None:
+            return run_batch_in_subprocess(handler, track_sets, policy, skip_list, self.io_priority)
+        with self.controller.slot(sum(ts.length_seconds for ts in track_sets)):
+            return run_batch_in_subprocess(handler, track_sets, policy, skip_list, self.io_priority)
+
+    def close(self) -> None:
+        if self.pool is not None:
+            logger.debug("Closing worker pool")
+            self.pool.close()
+            self.pool = None
+
+    def terminate(self) -> None:
+        if self.pool is not None:
+            logger.debug("Terminating worker pool")
+            self.pool.terminate()
+            self.pool = None
@@ -0,0 +1,209 @@
+'''Exporting analysis results to a file, and applying them later.
+
+Analysis and tagging don't have to happen on the same machine: with
+an exported results file, the music can be analyzed where it is only
+readable (e.g. on a compute cluster with a read-only mount) and
+tagged later where it is writable, without decoding anything again.
+
+A results file is either JSON Lines, one track set per line, or an
+SQLite database if its name ends in ".db", ".sqlite" or ".sqlite3".
+Each track is stored with the size and modification time its file
+had when the result was exported. Files that have changed since are
+refused when the results are applied, along with the rest of their
+track set, since its album gain would no longer be right.
+
+'''
+
+from typing import Any, Iterator, List, Optional, Tuple
+
+import json
+import os
+import sqlite3
+import traceback
+
+from multiprocessing.pool import ThreadPool
+
+from rganalysis.common import logger
+from rganalysis.results import AlbumResult, TrackResult, APPLIED, FAILED, STALE
+
+# File size and modification time in nanoseconds
+FileIdentity = Tuple[int, int]
+
+def is_sqlite_path(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in ('.db', '.sqlite', '.sqlite3')
+
+def file_identity(fname: str) -> FileIdentity:
+    '''Return the identity of fname, or of the image if it names a track of a CUE sheet.'''
+    from rganalysis.cue import split_cue_track_name
+    cue_track = split_cue_track_name(fname)
+    st = os.stat(cue_track[0] if cue_track else fname)
+    return (st.st_size, st.st_mtime_ns)
+
+class ResultWriter(object):
+    '''Writes AlbumResults to a results file.
+
+    Use as a context manager, or call close when done. An existing
+    file is replaced.
+
+    '''
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.count = 0
+        if os.path.exists(path):
+            os.remove(path)
+        self.conn = None        # type: Optional[sqlite3.Connection]
+        self.file = None        # type: Any
+        if is_sqlite_path(path):
+            self.conn = sqlite3.connect(path)
+            self.conn.execute(
+                '''CREATE TABLE album (
+                       id INTEGER PRIMARY KEY, key TEXT, directory TEXT, gain_type TEXT,
+                       gain REAL, peak REAL, true_peak REAL, provisional INTEGER, gain_error REAL)''')
+            self.conn.execute(
+                '''CREATE TABLE track (
+                       album_id INTEGER REFERENCES album(id), path TEXT, size INTEGER, mtime INTEGER,
+                       gain REAL, peak REAL, true_peak REAL, gain_error REAL)''')
+        else:
+            self.file = open(path, 'w')
+
+    def __enter__(self) -> 'ResultWriter':
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, tb: Any) -> None:
+        self.close()
+
+    def write(self, result: AlbumResult) -> None:
+        '''Write the gain values of result and the identity of its files.'''
+        identities = [ file_identity(t.filename) for t in result.tracks ]
+        if self.conn is not None:
+            album_id = self.conn.execute(
+                'INSERT INTO album (key, directory, gain_type, gain, peak, true_peak, provisional, gain_error) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (result.key, result.directory, result.gain_type,
+                 result.album_gain, result.album_peak, result.album_true_peak,
+                 result.provisional, result.album_gain_error)).lastrowid
+            self.conn.executemany(
+                'INSERT INTO track VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [ (album_id, t.filename, size, mtime, t.gain, t.peak, t.true_peak, t.gain_error)
+                  for (t, (size, mtime)) in zip(result.tracks, identities) ])
+        else:
+            record = {
+                "key": result.key,
+                "directory": result.directory,
+                "gain_type": result.gain_type,
+                "gain": result.album_gain,
+                "peak": result.album_peak,
+                "true_peak": result.album_true_peak,
+                "provisional": result.provisional,
+                "gain_error": result.album_gain_error,
+                "tracks": [ {
+                    "path": t.filename, "size": size, "mtime": mtime,
+                    "gain": t.gain, "peak": t.peak, "true_peak": t.true_peak,
+                    "gain_error": t.gain_error,
+                } for (t, (size, mtime)) in zip(result.tracks, identities) ],
+            }
+            self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.count += 1
+
+    def close(self) -> None:
+        if self.conn is not None:
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def _make_result(key: str, directory: str, gain_type: str, gain: Optional[float],
+                 peak: Optional[float], true_peak: Optional[float], provisional: bool,
+                 gain_error: Optional[float], tracks: List[TrackResult]) -> AlbumResult:
+    return AlbumResult(key=key, directory=directory, status=APPLIED, gain_type=gain_type,
+                       album_gain=gain, album_peak=peak, tracks=tracks, error=None,
+                       quarantined=[], provisional=bool(provisional), album_gain_error=gain_error,
+                       drift=None, album_true_peak=true_peak)
+
+def read_results(path: str) -> Iterator[Tuple[AlbumResult, List[FileIdentity]]]:
+    '''Yield each exported AlbumResult with the identities of its files.'''
+    if is_sqlite_path(path):
+        conn = sqlite3.connect(path)
+        try:
+            for row in conn.execute(
+                    'SELECT id, key, directory, gain_type, gain, peak, true_peak, provisional, gain_error FROM album ORDER BY id').fetchall():
+                tracks = conn.execute(
+                    'SELECT path, gain, peak, gain_error, true_peak, size, mtime FROM track WHERE album_id = ?', (row[0],)).fetchall()
+                yield (_make_result(*row[1:], tracks=[ TrackResult(*t[:5]) for t in tracks ]),
+                       [ (t[5], t[6]) for t in tracks ])
+        finally:
+            conn.close()
+    else:
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                tracks = record["tracks"]
+                yield (_make_result(record["key"], record["directory"], record["gain_type"],
+                                    record["gain"], record["peak"], record["true_peak"],
+                                    record.get("provisional", False), record.get("gain_error"),
+                                    [ TrackResult(t["path"], t["gain"], t["peak"], t.get("gain_error"), t["true_peak"])
+                                      for t in tracks ]),
+                       [ (t["size"], t["mtime"]) for t in tracks ])
+
+def apply_result(result: AlbumResult, identities: List[FileIdentity], dry_run: bool = False) -> AlbumResult:
+    '''Write the gain values of an exported result to its files.
+
+    Nothing is written if any of the files has changed since the
+    result was exported; the returned result then has status "stale".
+    '''
+    from rganalysis import RGTrack
+    from rganalysis.cue import split_cue_track_name, apply_result as apply_cue_result
+    try:
+        for (t, identity) in zip(result.tracks, identities):
+            try:
+                current = file_identity(t.filename)
+            except OSError:
+                current = None
+            if current != tuple(identity):
+                logger.warning("Not applying results for %s: %s changed since it was analyzed",
+                               result.key, repr(t.filename))
+                return result._replace(status=STALE, error="{!r} changed since it was analyzed".format(t.filename))
+        if result.tracks and split_cue_track_name(result.tracks[0].filename):
+            apply_cue_result(result, dry_run)
+            logger.debug("Applied results for %s", result.key)
+            return result
+        album = result.gain_type == "album"
+        for t in result.tracks:
+            track = RGTrack(t.filename)
+            (track.gain, track.peak) = (t.gain, t.peak)
+            (track.album_gain, track.album_peak) = (result.album_gain, result.album_peak) if album else (None, None)
+            track.true_peak = t.true_peak
+            track.album_true_peak = result.album_true_peak if album else None
+            # Estimates stay marked as provisional (see RGTrack.is_provisional)
+            if result.provisional:
+                track.gain_error = 0.0 if t.gain_error is None else t.gain_error
+                track.album_gain_error = (0.0 if result.album_gain_error is None else result.album_gain_error) \
+                    if album else None
+            else:
+                (track.gain_error, track.album_gain_error) = (None, None)
+            if not dry_run:
+                track.save()
+        logger.debug("Applied results for %s", result.key)
+        return result
+    except Exception:
+        logger.error("Failed to apply results for %s:\n\n%s\n", result.key, traceback.format_exc())
+        return result._replace(status=FAILED, error=traceback.format_exc())
+
+def apply_results(path: str, jobs: int = 1, dry_run: bool = False) -> Iterator[AlbumResult]:
+    '''Apply all results in the results file at path, with jobs threads.
+
+    Results are yielded in order of completion, with status
+    "applied", "stale" or "failed". Nothing is analyzed, so this is
+    limited by how fast the files' tags can be rewritten.
+
+    '''
+    def apply(item: Tuple[AlbumResult, List[FileIdentity]]) -> AlbumResult:
+        return apply_result(item[0], item[1], dry_run)
+    if jobs <= 1:
+        yield from map(apply, read_results(path))
+        return
+    with ThreadPool(jobs) as pool:
+        yield from pool.imap_unordered(apply, read_results(path))
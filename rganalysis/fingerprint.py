@@ -0,0 +1,201 @@
+'''Content fingerprints of the audio payload of music files.
+
+A fingerprint identifies the audio data of a file independently of
+its tags, so that two copies of the same track (for example, the
+same rip appearing on an album and on a compilation) have the same
+fingerprint even if their tags differ. Fingerprints are computed by
+hashing only the bytes that hold audio frames, skipping any tag
+blocks that the container format allows.
+
+For WAV and AIFF files, the format chunk is hashed along with the
+audio data, since the same sample bytes at a different sample rate
+or number of channels are different audio.
+
+Formats that are not recognized are hashed after stripping any
+leading ID3v2 and trailing ID3v1/APEv2 tags, which covers MP3,
+Musepack, WavPack and Monkey's Audio. This is always safe: at worst,
+a retagged copy gets a different fingerprint and is analyzed again.
+
+'''
+
+from typing import BinaryIO, Iterable, Tuple
+
+import hashlib
+import os
+import struct
+
+# Read files in chunks of this many bytes when hashing
+BLOCK_SIZE = 1 << 20
+
+# Changes whenever the fingerprint of some file changes, so that
+# fingerprints stored by an earlier version are not reused
+FINGERPRINT_VERSION = 2
+
+Range = Tuple[int, int]
+
+def _synchsafe(data: bytes) -> int:
+    '''Decode a 4-byte ID3v2 synchsafe integer.'''
+    value = 0
+    for b in data:
+        value = (value << 7) | (b & 0x7f)
+    return value
+
+def _skip_id3v2(f: BinaryIO, start: int = 0) -> int:
+    '''Return the offset of the first byte after any ID3v2 tags at start.'''
+    while True:
+        f.seek(start)
+        header = f.read(10)
+        if len(header) < 10 or header[:3] != b'ID3':
+            return start
+        size = _synchsafe(header[6:10])
+        has_footer = header[5] & 0x10
+        start += 10 + size + (10 if has_footer else 0)
+
+def _trailing_tags_start(f: BinaryIO, start: int, end: int) -> int:
+    '''Return the end of the audio data, excluding trailing ID3v1/APEv2 tags.'''
+    while True:
+        if end - start >= 128:
+            f.seek(end - 128)
+            if f.read(3) == b'TAG':
+                end -= 128
+                continue
+        if end - start >= 32:
+            f.seek(end - 32)
+            footer = f.read(32)
+            if footer[:8] == b'APETAGEX':
+                (tag_size, _, flags) = struct.unpack('<III', footer[12:24])
+                has_header = flags & 0x80000000
+                end -= tag_size + (32 if has_header else 0)
+                continue
+        return end
+
+def _tagged_stream_ranges(f: BinaryIO, size: int) -> Iterable[Range]:
+    '''Audio range of a raw stream with optional ID3/APEv2 tags (e.g. MP3).'''
+    start = _skip_id3v2(f)
+    yield (start, _trailing_tags_start(f, start, size))
+
+def _flac_ranges(f: BinaryIO, size: int) -> Iterable[Range]:
+    '''Audio range of a FLAC file.
+
+    The STREAMINFO block of most FLAC files holds an MD5 checksum of
+    the decoded audio, which is used instead when present (see
+    audio_fingerprint), so this is only needed for files without
+    one.
+
+    '''
+    pos = _skip_id3v2(f) + 4
+    last = False
+    while not last:
+        f.seek(pos)
+        header = f.read(4)
+        if len(header) < 4:
+            break
+        last = bool(header[0] & 0x80)
+        pos += 4 + int.from_bytes(header[1:4], 'big')
+    yield (pos, _trailing_tags_start(f, pos, size))
+
+def _flac_md5(f: BinaryIO) -> bytes:
+    '''Return the decoded-audio MD5 stored in STREAMINFO, or b''.'''
+    start = _skip_id3v2(f)
+    f.seek(start)
+    header = f.read(8)
+    if header[:4] != b'fLaC' or header[4] & 0x7f != 0:
+        return b''
+    # STREAMINFO: 18 bytes of stream parameters followed by the MD5
+    f.seek(start + 8 + 18)
+    md5 = f.read(16)
+    return md5 if md5.strip(b'\0') else b''
+
+def _mp4_ranges(f: BinaryIO, size: int) -> Iterable[Range]:
+    '''Contents of all top-level "mdat" atoms of an MP4 file.'''
+    pos = 0
+    while pos + 8 <= size:
+        f.seek(pos)
+        (atom_size, atom_type) = struct.unpack('>I4s', f.read(8))
+        header_size = 8
+        if atom_size == 1:
+            atom_size = struct.unpack('>Q', f.read(8))[0]
+            header_size = 16
+        elif atom_size == 0:
+            atom_size = size - pos
+        if atom_size < header_size:
+            break
+        if atom_type == b'mdat':
+            yield (pos + header_size, min(pos + atom_size, size))
+        pos += atom_size
+
+def _ogg_ranges(f: BinaryIO, size: int) -> Iterable[Range]:
+    '''Payloads of the Ogg pages that hold audio packets.
+
+    Header pages (granule position 0) are skipped, as are pages on
+    which no packet ends (granule position -1), since those are
+    typically continuations of a large comment packet. Page headers
+    are never hashed, because page sequence numbers and checksums
+    change when the comment packet grows or shrinks.
+
+    '''
+    pos = 0
+    while pos + 27 <= size:
+        f.seek(pos)
+        header = f.read(27)
+        if header[:4] != b'OggS':
+            break
+        granule = struct.unpack('<q', header[6:14])[0]
+        nsegs = header[26]
+        payload_size = sum(f.read(nsegs))
+        payload_start = pos + 27 + nsegs
+        if granule not in (0, -1):
+            yield (payload_start, payload_start + payload_size)
+        pos = payload_start + payload_size
+
+def _riff_ranges(f: BinaryIO, size: int, endian: str, chunk_ids: Tuple[bytes, ...]) -> Iterable[Range]:
+    '''Contents of the format and audio data chunks of a RIFF or IFF file.'''
+    pos = 12
+    while pos + 8 <= size:
+        f.seek(pos)
+        (chunk_id, chunk_size) = struct.unpack(endian + '4sI', f.read(8))
+        if chunk_id in chunk_ids:
+            yield (pos + 8, min(pos + 8 + chunk_size, size))
+        pos += 8 + chunk_size + (chunk_size & 1)
+
+def audio_ranges(f: BinaryIO, size: int) -> Iterable[Range]:
+    '''Return the byte ranges of f that hold audio data.'''
+    f.seek(0)
+    magic = f.read(12)
+    if magic[:4] == b'RIFF' and magic[8:12] == b'WAVE':
+        return _riff_ranges(f, size, '<', (b'fmt ', b'data'))
+    if magic[:4] == b'FORM' and magic[8:12] in (b'AIFF', b'AIFC'):
+        return _riff_ranges(f, size, '>', (b'COMM', b'SSND'))
+    if magic[:4] == b'OggS':
+        return _ogg_ranges(f, size)
+    if magic[4:8] == b'ftyp':
+        return _mp4_ranges(f, size)
+    f.seek(_skip_id3v2(f))
+    if f.read(4) == b'fLaC':
+        return _flac_ranges(f, size)
+    return _tagged_stream_ranges(f, size)
+
+def audio_fingerprint(fname: str) -> str:
+    '''Return a fingerprint of the audio payload of fname.
+
+    Files with identical audio data have identical fingerprints,
+    regardless of their tags. The fingerprint is a short string
+    prefixed by the method used to compute it.
+
+    '''
+    size = os.path.getsize(fname)
+    with open(fname, 'rb') as f:
+        md5 = _flac_md5(f)
+        if md5:
+            return 'flac-md5:' + md5.hex()
+        h = hashlib.sha1()
+        for (start, end) in list(audio_ranges(f, size)):
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                block = f.read(min(BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                h.update(block)
+                remaining -= len(block)
+        return 'sha1:' + h.hexdigest()
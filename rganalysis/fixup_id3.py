@@ -6,7 +6,7 @@ import mutagen.id3 as id3
 
 from rganalysis.common import format_gain, format_peak
 
-def fixup_ID3(fname: Union[str, MusicFileType]) -> None:
+def fixup_ID3(fname: Union[str, MusicFileType], dry_run: bool = False) -> bool:
     '''Convert RVA2 tags to TXXX:replaygain_* tags.
 
     Argument should be an MusicFile (instance of mutagen.FileType) or
@@ -20,7 +20,9 @@ def fixup_ID3(fname: Union[str, MusicFileType]) -> None:
     re-opened as the non-easy equivalent, since EasyMP3 maps the
     replaygain tags to RVA2, preventing the editing of the TXXX tags.
 
-    This function modifies the file on disk.
+    This function modifies the file on disk, unless dry_run is True
+    or the TXXX tags already match the RVA2 tags. Returns True if the
+    tags were (or would have been) changed.
 
     '''
     # Make sure we have the non-easy variant.
@@ -29,8 +31,20 @@ def fixup_ID3(fname: Union[str, MusicFileType]) -> None:
     track = MusicFile(fname, easy=False)
     # Only operate on ID3
     if not isinstance(track, id3.ID3FileType):
-        return
+        return False
+    if not fixup_ID3_tags(track):
+        return False
+    if not dry_run:
+        track.save()
+    return True
 
+def fixup_ID3_tags(track: MusicFileType) -> bool:
+    '''Add TXXX:replaygain_* tags from the RVA2 tags of an ID3 file.
+
+    Only the tags in memory are changed. Returns True if any tag was
+    added or changed.
+
+    '''
     # Get the RVA2 frames
     try:
         track_rva2 = track['RVA2:track']
@@ -46,22 +60,18 @@ def fixup_ID3(fname: Union[str, MusicFileType]) -> None:
         album_rva2 = None
 
     # Add the other tags based on RVA2 values
+    values = {}
     if track_rva2:
-        track['TXXX:replaygain_track_peak'] = \
-            id3.TXXX(encoding=id3.Encoding.UTF8,
-                     desc='replaygain_track_peak',
-                     text=format_peak(track_rva2.peak))
-        track['TXXX:replaygain_track_gain'] = \
-            id3.TXXX(encoding=id3.Encoding.UTF8,
-                     desc='replaygain_track_gain',
-                     text=format_gain(track_rva2.gain))
+        values['replaygain_track_peak'] = format_peak(track_rva2.peak)
+        values['replaygain_track_gain'] = format_gain(track_rva2.gain)
     if album_rva2:
-        track['TXXX:replaygain_album_peak'] = \
-            id3.TXXX(encoding=id3.Encoding.UTF8,
-                     desc='replaygain_album_peak',
-                     text=format_peak(album_rva2.peak))
-        track['TXXX:replaygain_album_gain'] = \
-            id3.TXXX(encoding=id3.Encoding.UTF8,
-                     desc='replaygain_album_gain',
-                     text=format_gain(album_rva2.gain))
-    track.save()
+        values['replaygain_album_peak'] = format_peak(album_rva2.peak)
+        values['replaygain_album_gain'] = format_gain(album_rva2.gain)
+    changed = False
+    for (desc, text) in values.items():
+        key = 'TXXX:' + desc
+        if track.tags is not None and key in track.tags and list(track.tags[key].text) == [text]:
+            continue
+        track[key] = id3.TXXX(encoding=id3.Encoding.UTF8, desc=desc, text=text)
+        changed = True
+    return changed
@@ -0,0 +1,91 @@
+'''Grouping files by directory when they arrive in any order.
+
+Track sets never span directories, so the tracks of a directory must
+be gathered before its track sets can be made. os.walk lists each
+directory's files together, so when only directories are searched,
+each directory's track sets are made as soon as its files have been
+read (see group_by_directory), and nothing else is kept in memory.
+
+Files given explicitly (e.g. with --files-from) may come in any
+order, so their names are sorted by directory with sort_by_directory
+before any of them is opened. Names are kept in memory until there
+are more than max_files of them; then they are sorted and written to
+a temporary file (a "run"). Once all names have been seen, the runs
+and the names still in memory are merged in directory order. Only
+names are written out, so each file is still opened just once, after
+sorting, and at most about max_files names are in memory at once,
+whatever the order of the input.
+
+'''
+
+from typing import IO, Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import heapq
+import os.path
+import pickle
+import tempfile
+
+from itertools import groupby
+
+from rganalysis.common import logger
+
+# Number of buffered file names with --low-memory
+LOW_MEMORY_FILES = 10000
+
+def _candidate_key(candidate: Tuple[str, bool]) -> Tuple[str, str]:
+    return (os.path.dirname(candidate[0]), candidate[0])
+
+def _write_run(buffered: List[Tuple[str, bool]]) -> IO[bytes]:
+    run = tempfile.TemporaryFile()
+    for candidate in sorted(buffered, key=_candidate_key):
+        pickle.dump(candidate, run)
+    run.seek(0)
+    return run
+
+def _read_run(run: IO[bytes]) -> Iterator[Tuple[str, bool]]:
+    try:
+        while True:
+            try:
+                yield pickle.load(run)
+            except EOFError:
+                return
+    finally:
+        run.close()
+
+def sort_by_directory(candidates: Iterable[Tuple[str, bool]],
+                      max_files: Optional[int] = None) -> Iterator[Tuple[str, bool]]:
+    '''Yield candidates, as from find_candidate_files, sorted by directory.
+
+    If max_files is None, all names are kept in memory.
+
+    '''
+    buffered = []               # type: List[Tuple[str, bool]]
+    runs = []                   # type: List[IO[bytes]]
+    for candidate in candidates:
+        buffered.append(candidate)
+        if max_files is not None and len(buffered) > max_files:
+            logger.debug("Writing %s file names to a temporary file to save memory", len(buffered))
+            runs.append(_write_run(buffered))
+            buffered = []
+    buffered.sort(key=_candidate_key)
+    yield from heapq.merge(buffered, *[ _read_run(run) for run in runs ], key=_candidate_key)
+
+def group_by_directory(tracks: Iterable[Any], ordered: bool = False) -> Iterator[Tuple[str, List[Any]]]:
+    '''Yield (directory, tracks) for each directory of tracks.
+
+    Each track must have a directory attribute. If ordered is True,
+    the tracks of each directory must come consecutively, and each
+    directory is yielded as soon as the first track of the next one
+    arrives. Otherwise, tracks may come in any order, and all of them
+    are read before the directories are yielded in sorted order.
+
+    '''
+    if ordered:
+        for (directory, tracks_in_dir) in groupby(tracks, lambda tr: tr.directory):
+            yield (directory, list(tracks_in_dir))
+        return
+    buffered = {}               # type: Dict[str, List[Any]]
+    for track in tracks:
+        buffered.setdefault(track.directory, []).append(track)
+    for directory in sorted(buffered):
+        yield (directory, buffered[directory])
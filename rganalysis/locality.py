@@ -0,0 +1,97 @@
+'''Ordering track sets by where their files are on disk.
+
+On spinning disks, workers that each read a different album from a
+different part of the disk spend most of their time seeking, and
+adding workers makes it worse. Ordering the track sets by the
+physical position of their files, and giving each worker a
+contiguous share of them (see split_evenly), keeps every worker's
+reads close together and close to its previous ones.
+
+The position of a file is the physical offset of its first extent,
+from the FIEMAP ioctl where the file system supports it (Linux), or
+otherwise its inode number, which most file systems allocate roughly
+in the order of their placement. Files are ordered by device first.
+
+'''
+
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple, TypeVar
+
+import os
+import struct
+import sys
+
+from rganalysis.common import logger
+
+T = TypeVar('T')
+
+# _IOWR('f', 11, struct fiemap)
+FS_IOC_FIEMAP = 0xC020660B
+# struct fiemap header and one struct fiemap_extent
+_FIEMAP_HEADER = struct.Struct('=QQLLLL')
+_FIEMAP_EXTENT = struct.Struct('=QQQQQLLLL')
+
+# Devices whose file systems do not support FIEMAP
+_no_fiemap = set()              # type: Set[int]
+
+def _first_extent(fd: int) -> Optional[int]:
+    '''Return the physical offset of the first extent of fd, or None if it has none.'''
+    import fcntl
+    # Map the whole file, but only ask for one extent
+    request = _FIEMAP_HEADER.pack(0, 2 ** 64 - 1, 0, 0, 1, 0) + bytes(_FIEMAP_EXTENT.size)
+    result = fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+    if not _FIEMAP_HEADER.unpack_from(result)[3]:
+        return None
+    # fe_physical
+    return _FIEMAP_EXTENT.unpack_from(result, _FIEMAP_HEADER.size)[1]
+
+def physical_position(fname: str) -> Tuple[int, int, int]:
+    '''Return a sort key for the physical position of fname.
+
+    The key is (device, 0, first extent offset) where FIEMAP works,
+    and (device, 1, inode number) otherwise.
+
+    '''
+    st = os.stat(fname)
+    if sys.platform.startswith('linux') and st.st_dev not in _no_fiemap:
+        try:
+            fd = os.open(fname, os.O_RDONLY)
+            try:
+                extent = _first_extent(fd)
+            finally:
+                os.close(fd)
+            if extent is not None:
+                return (st.st_dev, 0, extent)
+        except OSError as ex:
+            logger.debug("Using inode numbers for files on device %s: %s", st.st_dev, ex)
+            _no_fiemap.add(st.st_dev)
+    return (st.st_dev, 1, st.st_ino)
+
+def order_by_locality(track_sets: Iterable[T]) -> List[T]:
+    '''Return the track sets sorted by the lowest position of any of their files on disk.
+
+    Files that cannot be examined sort last, in their original order.
+
+    '''
+    positions = {}              # type: Dict[int, Tuple]
+    track_sets = list(track_sets)
+    for (i, ts) in enumerate(track_sets):
+        try:
+            positions[i] = min(physical_position(f) for f in ts.filenames) # type: ignore
+        except (OSError, ValueError):
+            positions[i] = (float('inf'),)
+    order = sorted(range(len(track_sets)), key=lambda i: (positions[i], i))
+    return [ track_sets[i] for i in order ]
+
+def split_evenly(items: Sequence[T], n: int, weight: Callable[[T], float]) -> List[List[T]]:
+    '''Split items into at most n contiguous runs of about equal total weight.'''
+    weights = [ weight(item) for item in items ]
+    total = sum(weights)
+    runs = [[]]                 # type: List[List[T]]
+    done = 0.0
+    for (item, w) in zip(items, weights):
+        # Start the next run once this one has its share
+        if runs[-1] and len(runs) < n and done >= total * len(runs) / n:
+            runs.append([])
+        runs[-1].append(item)
+        done += w
+    return [ run for run in runs if run ]
@@ -1,59 +1,27 @@
 #!/usr/bin/env python
 
-from typing import Sized
+from typing import Sized, Tuple
 
-import multiprocessing
-import plac
-import traceback
 import logging
+import os
+import re
+import sys
 
-from multiprocessing import Process
-from multiprocessing.pool import ThreadPool
+from functools import partial
+
+try:
+    # plac_core is all that is needed to parse arguments, without
+    # the interactive extensions (and tkinter) that plac imports
+    import plac_core as plac
+except ImportError:
+    import plac
 
 from rganalysis import *
-from rganalysis.common import logger
-from rganalysis.backends import get_backend, known_backends, BackendUnavailableException
+from rganalysis.common import logger, default_job_count, default_cache_path, default_skip_list_path
 
 def tqdm_fake(iterable: Iterable, *args, **kwargs) -> Iterable:
     return iterable
 
-def default_job_count() -> int:
-    try:
-        return multiprocessing.cpu_count()
-    except Exception:
-        return 1
-
-class PickleableMethodCaller(object):
-    '''Pickleable method caller for multiprocessing.Pool.imap'''
-    def __init__(self, method_name: str, *args , **kwargs) -> None:
-        self.method_name = method_name
-        self.args = args
-        self.kwargs = kwargs
-    def __call__(self, obj: Any) -> Any:
-        try:
-            return getattr(obj, self.method_name)(*self.args, **self.kwargs)
-        except KeyboardInterrupt:
-            sys.exit(1)
-
-class TrackSetHandler(PickleableMethodCaller):
-    '''Pickleable callable for multiprocessing.Pool.imap'''
-    def __init__(self, force: bool = False, gain_type: str = "auto",
-                 dry_run: bool = False, verbose: bool = False) -> None:
-        super(TrackSetHandler, self).__init__(
-            "do_gain",
-            force = force,
-            gain_type = gain_type,
-            verbose = verbose,
-            dry_run = dry_run,
-        )
-    def __call__(self, track_set: RGTrackSet) -> RGTrackSet:
-        try:
-            super(TrackSetHandler, self).__call__(track_set)
-        except Exception:
-            logger.error("Failed to analyze %s. Skipping this track set. The exception was:\n\n%s\n",
-                         track_set.track_set_key_string(), traceback.format_exc())
-        return track_set
-
 def positive_int(x: Any) -> int:
     i = int(x)
     if i < 1:
@@ -61,6 +29,54 @@ def positive_int(x: Any) -> int:
     else:
         return i
 
+def non_negative_int(x: Any) -> int:
+    i = int(x)
+    if i < 0:
+        raise ValueError()
+    else:
+        return i
+
+def parse_excerpts(spec: str) -> Tuple[float, float]:
+    '''Parse "EXCERPT/INTERVAL", in seconds.'''
+    (excerpt, interval) = (float(x) for x in spec.split('/'))
+    if not 0 < excerpt <= interval:
+        raise ValueError()
+    return (excerpt, interval)
+
+def parse_rate(rate: str) -> float:
+    '''Parse a fraction, given as a number or a percentage.'''
+    value = float(rate[:-1]) / 100 if rate.endswith('%') else float(rate)
+    if not 0 < value <= 1:
+        raise ValueError()
+    return value
+
+def report_audit(report: Any) -> None:
+    '''Log the contents of an AuditReport.'''
+    logger.info("Audited %s of %s track sets with replaygain tags (%s track sets have no valid tags).",
+                report.sampled, report.population, report.untagged)
+    for (stratum, (size, sampled, drifted)) in sorted(report.strata.items()):
+        logger.info("  %s: %s of %s sampled track sets drifted (%s track sets in total)",
+                    re.sub("^.*\\.(Easy)?", "", stratum), drifted, sampled, size)
+    if report.failed:
+        logger.error("Failed to analyze %s track sets.", report.failed)
+    if report.drifted:
+        logger.warning("The following track sets have gain values that differ from their tags by more than %s dB:\n%s",
+                       report.tolerance, "\n".join("{} (by {:.2f} dB)".format(r.key, r.drift) for r in report.drifted))
+    logger.warning("Estimated fraction of track sets with inaccurate tags: %.1f%% +/- %.1f%% (95%% confidence)",
+                   100 * report.drift_rate, 100 * report.drift_rate_error)
+
+def parse_size(size: str) -> int:
+    '''Parse a number of bytes with an optional K, M or G suffix.'''
+    size = size.strip().upper().rstrip('B')
+    factor = 1
+    for (i, suffix) in enumerate('KMG'):
+        if size.endswith(suffix):
+            (size, factor) = (size[:-1], 1024 ** (i + 1))
+    value = int(float(size) * factor)
+    if value < 1:
+        raise ValueError()
+    return value
+
 @plac.annotations(
     # arg=(helptext, kind, abbrev, type, choices, metavar)
     force_reanalyze=(
@@ -74,17 +90,86 @@ def positive_int(x: Any) -> int:
         "option", "g", str, ('album', 'track', 'auto'), '(track|album|auto)'),
     backend=(
         'Gain computing backend to use. Different backends have different prerequisites.',
-        "option", "b", str, None, '(audiotools|bs1770gain|auto)'),
+        "option", "b", str, None, '(audiotools|bs1770gain|native|pipe|route|auto)'),
+    calibrate_backends=(
+        'Time each available backend on a short synthetic sample in several formats (using ffmpeg to encode them, if installed) and save the timings. Afterwards, the "route" backend analyzes each album with the fastest backend for its format.',
+        "flag", "C"),
     dry_run=("Don't modify any files. Only analyze and report gain.",
              "flag", "n"),
+    gain_cache=(
+        'File in which to cache computed gain values by audio content, so that identical copies of a track (e.g. on compilations) are only analyzed once, in this run and in later runs. Use "default" for ~/.cache/rganalysis/gain-cache.sqlite. By default, no cache is used, since it requires reading and hashing every file in addition to decoding it.',
+        "option", "c", str, None, 'FILE'),
+    timeout_factor=(
+        'Give up on analyzing an album if it takes longer than 60 seconds plus this many seconds per second of audio, and retry it. Use 0 to wait indefinitely. The default is 2.',
+        "option", "t", float, None, 'FACTOR'),
+    retries=(
+        'Number of times to retry an album whose analysis timed out or crashed. Files that still fail when analyzed on their own then have the failure recorded in the skip list. The default is 2.',
+        "option", "r", non_negative_int, None, 'N'),
+    skip_list=(
+        'File in which to keep the list of files that failed to be analyzed. Files that failed in two different runs are skipped in later runs until they are modified. The file is not written in dry run mode. Use "none" to disable the skip list.',
+        "option", "S", str, None, 'FILE'),
     music_dir=(
         "Directories in which to search for music files.",
         "positional"),
+    files_from=(
+        'Also search the files and directories listed in FILE, one per line, or in standard input if FILE is "-". This avoids the limit on the length of the command line for very long lists of files.',
+        "option", "F", str, None, 'FILE'),
+    null=(
+        'The list given by --files-from is separated by NUL characters instead of newlines, as output by "find -print0".',
+        "flag", "0"),
     jobs=(
         "Number of albums to analyze in parallel. The default is the number of cores detected on your system.",
         "option", "j", positive_int),
+    min_jobs=(
+        "Adapt the number of albums analyzed in parallel to the system, between this number and the number given by --jobs, based on throughput, I/O wait and disk read rate. By default, the number of parallel jobs is fixed.",
+        "option", "J", positive_int, None, 'N'),
+    max_read_rate=(
+        "Limit the average rate at which music files are read, in bytes per second. A suffix of K, M or G may be used, e.g. 50M. When adapting the number of jobs, also reduce it while the system's disks are reading faster than this.",
+        "option", "R", parse_size, None, 'RATE'),
+    io_priority=(
+        'CPU and I/O priority of the analysis processes, so that other work on the system is not slowed down. I/O priority requires the psutil module.',
+        "option", "P", str, ('normal', 'low', 'idle'), '(normal|low|idle)'),
+    decode_jobs=(
+        'With the pipe backend, read the output of the decoders of each album in this many processes, which pass the decoded audio to the analysis through shared memory, so that decoding and analysis run on separate cores. By default, the decoders are read by the analysis process itself.',
+        "option", "D", positive_int, None, 'N'),
+    io_order=(
+        'Order in which albums are read. If "walk" (the default), they are analyzed in the order in which they are found. If "locality", they are sorted by the position of their files on disk, and each job reads a contiguous share of them, which avoids seeking back and forth on spinning disks. "locality" cannot be used with --low-memory.',
+        "option", "o", str, ('walk', 'locality'), '(walk|locality)'),
+    true_peak=(
+        'Also measure the true (inter-sample) peak of each track and album, which takes longer. If "replace", the true peak is written to the peak tags instead of the sample peak. If "separate", it is written to separate replaygain_track_true_peak and replaygain_album_true_peak tags, and albums without them are reanalyzed. The default is "off". The audiotools backend requires numpy for this.',
+        "option", "T", str, ('off', 'replace', 'separate'), '(off|replace|separate)'),
+    fast_estimate=(
+        'Quickly estimate gain from excerpts of each track instead of analyzing all of it, e.g. "10/60" to analyze 10 seconds out of every 60 seconds. The estimates are reported with a 95%% confidence interval. They are marked as provisional with replaygain_track_gain_error tags, and a later run without this option replaces them with a full analysis. Requires numpy and scipy, and ffmpeg for formats other than WAV.',
+        "option", "E", parse_excerpts, None, 'EXCERPT/INTERVAL'),
+    audit=(
+        'Instead of adding tags, check the accuracy of existing tags: reanalyze a random sample of this fraction of the albums that have tags (e.g. 0.01 or 1%%), sampled separately for each file type, without modifying any files. Albums whose gain differs from their tags are listed, and the fraction of such albums in the whole collection is estimated.',
+        "option", "A", parse_rate, None, 'RATE'),
+    audit_tolerance=(
+        'Largest difference in dB between measured and stored gain that --audit accepts. The default is 0.5.',
+        "option", "a", float, None, 'DB'),
+    export_results=(
+        'Instead of modifying any files, write the analysis results and the size and modification time of each file to FILE, to be applied later with --apply-results (e.g. on a machine where the files are writable). FILE is an SQLite database if its name ends in .db, .sqlite or .sqlite3, and a JSON Lines file otherwise. Only analyzed albums are written, so use --force-reanalyze to include albums that already have tags.',
+        "option", "x", str, None, 'FILE'),
+    apply_results=(
+        'Instead of analyzing anything, write the tags from a file written by --export-results. Albums in which any file has changed since it was analyzed are left alone. No music directories need to be given.',
+        "option", "X", str, None, 'FILE'),
+    fixup_only=(
+        'Instead of analyzing anything, copy ReplayGain values from ID3 RVA2 frames to TXXX frames in all MP3 files (as is done after analysis), in parallel. Files that already have matching TXXX frames are not modified.',
+        "flag", "I"),
+    strip_only=(
+        'Instead of analyzing anything, delete all ReplayGain tags from all files, in parallel. Files without ReplayGain tags are not modified.',
+        "flag", "s"),
+    status=(
+        'Instead of analyzing anything, only read the tags of all files, in parallel and without loading a backend, and report how many albums have no tags, inconsistent album gain tags (taking TRACKGAIN files into account) or only ID3 RVA2 frames. The albums that need work are written to FILE as JSON Lines, one object per album, or to standard output if FILE is "-".',
+        "option", "u", str, None, 'FILE'),
+    profile=(
+        'Profile the analysis with cProfile, in the main process and in every worker process, and write the profiles to DIR, separately for each stage (discover, group, analyze and write). At the end, they are merged into DIR/all.prof and DIR/STAGE.prof, which can be examined with "python -m pstats", and a summary of the slowest functions is written to DIR/summary.txt. Profiling slows down the analysis.',
+        "option", "p", str, None, 'DIR'),
+    profile_memory=(
+        'With --profile, also trace memory allocations with tracemalloc, and add the lines that allocated the most memory to the summary. This slows down the analysis considerably.',
+        "flag", "M"),
     low_memory=(
-        "Use less memory by processing directories one by one rather than pre-computing the complete list of files to be processed. This will disable progress bars, but will allow rganalysis to run on very large music collections without running out of memory.",
+        "Use less memory by not pre-computing the complete list of albums to be processed, and by keeping only a limited number of file names in memory while sorting files given explicitly (e.g. with --files-from) by directory (spilling the rest to temporary files). This will disable progress bars, but will allow rganalysis to run on very large music collections without running out of memory.",
         "flag", "m"),
     quiet=(
         "Do not print informational messages.", "flag", "q"),
@@ -97,7 +182,30 @@ def main(force_reanalyze: bool = False,
          dry_run: bool = False,
          gain_type: str = 'auto',
          backend: str = 'auto',
+         calibrate_backends: bool = False,
          jobs: int = default_job_count(),
+         gain_cache: str = None,
+         timeout_factor: float = 2.0,
+         retries: int = 2,
+         skip_list: str = default_skip_list_path(),
+         min_jobs: int = None,
+         max_read_rate: int = None,
+         io_priority: str = 'normal',
+         decode_jobs: int = None,
+         io_order: str = 'walk',
+         true_peak: str = 'off',
+         fast_estimate: Tuple[float, float] = None,
+         audit: float = None,
+         audit_tolerance: float = 0.5,
+         files_from: str = None,
+         null: bool = False,
+         export_results: str = None,
+         apply_results: str = None,
+         fixup_only: bool = False,
+         strip_only: bool = False,
+         status: str = None,
+         profile: str = None,
+         profile_memory: bool = False,
          low_memory: bool = False,
          quiet: bool = False,
          verbose: bool = False,
@@ -105,6 +213,15 @@ def main(force_reanalyze: bool = False,
          ):
     '''Add replaygain tags to your music files.'''
 
+    # Imported here rather than at the top to keep startup fast
+    from rganalysis.api import make_gain_backend, find_track_sets, audit as audit_tags
+    from rganalysis.engine import RetryPolicy, TrackSetHandler, WorkerPool
+    from rganalysis.export import ResultWriter, apply_results as apply_result_file
+    from rganalysis.grouping import LOW_MEMORY_FILES
+    from rganalysis import profiling
+    from rganalysis.quarantine import SkipList
+    from rganalysis.results import ANALYZED, APPLIED, FAILED, STALE
+
     try:
         from tqdm import tqdm
     except ImportError:
@@ -118,37 +235,96 @@ def main(force_reanalyze: bool = False,
     else:
         logger.setLevel(logging.INFO)
 
-    if backend == 'auto':
-        for bname in known_backends:
-            try:
-                gain_backend = get_backend(bname)
-                logger.info("Selected the %s backend to compute ReplayGain", bname)
-                break
-            except BackendUnavailableException:
-                pass
-        else:
-            raise BackendUnavailableException("Could not find any usable backends.")
-    else:
-        gain_backend = get_backend(backend)
-        logger.info("Using the %s backend to compute ReplayGain", backend)
-
-    track_constructor = RGTrack
     if dry_run:
         logger.warn('This script is running in "dry run" mode, so no files will actually be modified.')
-        track_constructor = RGTrackDryRun
+    if calibrate_backends:
+        from rganalysis.backends.route import calibrate
+        table = calibrate()
+        for (fmt, timings) in sorted(table.items()):
+            logger.info("%s: %s", fmt, ", ".join("{} {:.0f}x realtime".format(name, 1 / seconds)
+                                                  for (name, seconds) in sorted(timings.items(), key=lambda x: x[1])))
+        sys.exit(0)
+    if apply_results is not None:
+        counts = { APPLIED: 0, STALE: 0, FAILED: 0 }
+        for result in tqdm(apply_result_file(apply_results, jobs, dry_run), desc="Applying"):
+            counts[result.status] += 1
+        logger.info("Applied results for %s track sets.", counts[APPLIED])
+        if counts[STALE]:
+            logger.warning("Did not apply results for %s track sets with files that changed since they were analyzed.", counts[STALE])
+        if counts[FAILED]:
+            logger.error("Failed to apply results for %s track sets.", counts[FAILED])
+        sys.exit(1 if counts[STALE] or counts[FAILED] else 0)
+    if export_results is not None:
+        logger.info("Writing results to %s instead of modifying any files.", export_results)
+        dry_run = True
+    if files_from is not None:
+        if files_from == '-':
+            music_dir += tuple(read_file_list(sys.stdin.buffer, null))
+        else:
+            with open(files_from, 'rb') as f:
+                music_dir += tuple(read_file_list(f, null))
     if len(music_dir) == 0:
         logger.error("You did not specify any music directories or files. Exiting.")
         sys.exit(1)
-    music_directories = list(unique(map(fullpath, music_dir)))
-    logger.info("Searching for music files in the following locations:\n%s", "\n".join(music_directories),)
-    all_music_files = get_all_music_files(music_directories,
-                                          ignore_hidden=(not include_hidden))
-    if low_memory:
-        tracks = map(track_constructor, all_music_files)
-        track_sets = RGTrackSet.MakeTrackSets(tracks, gain_backend=gain_backend)
-    else:
-        tracks = map(track_constructor, tqdm(all_music_files, desc="Searching"))
-        track_sets = list(RGTrackSet.MakeTrackSets(tracks, gain_backend=gain_backend))
+    if fixup_only or strip_only:
+        if fixup_only and strip_only:
+            logger.error("--fixup-only and --strip-only cannot be used together. Exiting.")
+            sys.exit(1)
+        from rganalysis.maintenance import maintain, FAILED as MAINTENANCE_FAILED
+        outcomes = maintain(music_dir, 'fixup' if fixup_only else 'strip', jobs, include_hidden, dry_run,
+                            progress=partial(tqdm, desc="Fixing up" if fixup_only else "Stripping"))
+        for (outcome, count) in sorted(outcomes.items()):
+            logger.info("%s: %s files", outcome.capitalize(), count)
+        sys.exit(1 if outcomes[MAINTENANCE_FAILED] else 0)
+    if status is not None:
+        from collections import Counter
+        from rganalysis.status import library_status, write_status, STATUSES, OK, FAILED as STATUS_FAILED
+        statuses = Counter()    # type: Counter
+        out = sys.stdout if status == '-' else open(status, 'w')
+        try:
+            for album_status in tqdm(library_status(music_dir, gain_type, jobs, include_hidden), desc="Reading tags"):
+                statuses[album_status.status] += 1
+                if album_status.status != OK:
+                    write_status([album_status], out)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        for name in STATUSES:
+            if statuses[name] or name != STATUS_FAILED:
+                logger.info("%s: %s track sets", name.capitalize(), statuses[name])
+        if status != '-':
+            logger.info("Wrote the %s track sets that need work to %s.", sum(statuses.values()) - statuses[OK], status)
+        sys.exit(1 if statuses[STATUS_FAILED] else 0)
+    if audit is not None:
+        report = audit_tags(music_dir, audit, tolerance=audit_tolerance, backend=backend,
+                            jobs=jobs, gain_type=gain_type, include_hidden=include_hidden,
+                            timeout_factor=timeout_factor, retries=retries,
+                            skip_list=None if skip_list.lower() == 'none' else fullpath(skip_list),
+                            min_jobs=min_jobs, max_read_rate=max_read_rate, io_priority=io_priority,
+                            io_order=io_order, decode_jobs=decode_jobs)
+        report_audit(report)
+        sys.exit(1 if report.drifted or report.failed else 0)
+    if io_order == 'locality' and low_memory:
+        logger.error("--io-order=locality needs the complete list of albums, so it cannot be used with --low-memory. Exiting.")
+        sys.exit(1)
+    if profile is not None:
+        profile = fullpath(profile)
+        logger.info("Writing profiles to %s", profile)
+        profiling.start_session(profile, profile_memory)
+    elif profile_memory:
+        logger.warning("--profile-memory has no effect without --profile.")
+    if gain_cache is not None and gain_cache.lower() == 'default':
+        gain_cache = default_cache_path()
+    elif gain_cache is not None and gain_cache.lower() == 'none':
+        gain_cache = None
+    gain_backend = make_gain_backend(backend, gain_cache, fast_estimate, decode_jobs)
+    skips = None if skip_list.lower() == 'none' else SkipList(fullpath(skip_list))
+    track_sets = find_track_sets(music_dir, gain_backend,
+                                 include_hidden=include_hidden, dry_run=dry_run,
+                                 skip_list=skips,
+                                 max_files=LOW_MEMORY_FILES if low_memory else None)
+    if not low_memory:
+        track_sets = list(tqdm(track_sets, desc="Searching"))
         if len(track_sets) == 0:
             logger.error("Failed to find any tracks in the directories you specified. Exiting.")
             sys.exit(1)
@@ -157,47 +333,49 @@ def main(force_reanalyze: bool = False,
 
     logger.info("Beginning analysis")
 
-    handler = TrackSetHandler(force=force_reanalyze, gain_type=gain_type, dry_run=dry_run, verbose=verbose)
-    # Wrapper that runs the handler in a subprocess, allowing for
-    # parallel operation
-    def wrapped_handler(track_set: RGTrackSet) -> RGTrackSet:
-        p = Process(target=handler, args=(track_set,)) # type: ignore # https://github.com/python/mypy/issues/797
-        try:
-            p.start()
-            p.join()
-            if p.exitcode != 0:  # type: ignore
-                logger.error("Subprocess exited with code %s for %s", p.exitcode, track_set.track_set_key_string())  # type: ignore
-        finally:
-            if p.is_alive():
-                logger.debug("Killing subprocess")
-                p.terminate()
-        return track_set
-
-    pool = None
+    handler = TrackSetHandler(force=force_reanalyze, gain_type=gain_type, dry_run=dry_run, verbose=verbose,
+                              true_peak=true_peak)
+    policy = RetryPolicy(timeout_factor=timeout_factor, retries=retries)
+    failed = 0
+    provisional = 0
+    writer = ResultWriter(export_results) if export_results is not None else None
     try:
-        if jobs <= 1:
-            # Sequential
-            handled_track_sets = map(handler, track_sets) # type: ignore # https://github.com/python/mypy/issues/797
-        else:
-            # Parallel (Using process pool doesn't work, so instead we
-            # use Process instance within each thread)
-            pool = ThreadPool(jobs)
-            handled_track_sets = pool.imap_unordered(wrapped_handler, track_sets) # type: ignore # https://github.com/python/typeshed/issues/683
-        # Wait for completion
-        iter_len = None if low_memory else len(cast(Sized, track_sets))
-        for ts in tqdm(handled_track_sets, total=iter_len, desc="Analyzing"):
-            pass
-        logger.info("Analysis complete.")
-    except KeyboardInterrupt:
-        if pool is not None:
-            logger.debug("Terminating process pool")
-            pool.terminate()
-            pool = None
-        raise
+        with WorkerPool(jobs, min_jobs=min_jobs, max_read_rate=max_read_rate, io_priority=io_priority,
+                        io_order=io_order) as pool:
+            results = pool.run(track_sets, handler, policy, skips)
+            # Wait for completion
+            iter_len = None if low_memory else len(cast(Sized, track_sets))
+            for result in tqdm(results, total=iter_len, desc="Analyzing"):
+                if result.status == FAILED:
+                    failed += 1
+                elif result.provisional:
+                    provisional += 1
+                if writer is not None and result.status == ANALYZED:
+                    writer.write(result)
     finally:
-        if pool is not None:
-            logger.debug("Closing transcode process pool")
-            pool.close()
-    if dry_run:
+        if skips is not None and not dry_run:
+            skips.save()
+        if writer is not None:
+            writer.close()
+        if profile is not None:
+            profiling.stop_session()
+    logger.info("Analysis complete.")
+    if profile is not None:
+        logger.info("Profile summary (also in %s):\n%s", os.path.join(profile, "summary.txt"), profiling.summarize(profile))
+    if writer is not None:
+        logger.info("Wrote results for %s track sets to %s.", writer.count, export_results)
+    if failed:
+        logger.error("Failed to analyze %s track sets.", failed)
+    if provisional:
+        logger.info("Estimated gain for %s track sets. Run again without --fast-estimate to replace the estimates with a full analysis.", provisional)
+    if skips is not None and skips.added:
+        logger.error("The following files failed to be analyzed in this run and an earlier one, and %s added to the skip list in %s:\n%s",
+                     "would have been" if dry_run else "were", skips.path, "\n".join(skips.added))
+    if skips is not None and set(skips.failed) - set(skips.added):
+        logger.error("The following files failed to be analyzed, and %s skipped if they fail again in a later run:\n%s",
+                     "would be" if dry_run else "will be", "\n".join(f for f in skips.failed if f not in skips.added))
+    if skips is not None and skips.skipped:
+        logger.warning("Skipped the following files, which are on the skip list in %s:\n%s",
+                       skips.path, "\n".join(skips.skipped))
+    if dry_run and writer is None:
         logger.warn('This script ran in "dry run" mode, so no files were actually modified.')
-    pass
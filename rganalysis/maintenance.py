@@ -0,0 +1,112 @@
+'''Bulk tag maintenance without analysis.
+
+The same tag changes that analysis makes as a side effect can be
+applied to whole collections on their own:
+
+- "fixup" copies ReplayGain values from ID3 RVA2 frames to TXXX
+  frames (see rganalysis.fixup_id3), for players that only read one
+  of the two.
+- "strip" deletes all ReplayGain tags, e.g. after moving to a player
+  that computes its own.
+
+Every file is opened once, in one of several worker processes, and
+only saved if it actually needs to change, so running either mode
+again over the same files only reads them.
+
+'''
+
+from typing import Callable, Counter, Iterable, Iterator, Optional, Tuple
+
+import collections
+import traceback
+
+from functools import partial
+from multiprocessing import Pool
+
+from rganalysis import MusicFile, find_candidate_files, rg_tag_keys
+from rganalysis.common import logger
+
+# Per-file outcomes
+FIXED = "fixed"
+STRIPPED = "stripped"
+UNCHANGED = "unchanged"
+NOT_MUSIC = "not music"
+FAILED = "failed"
+
+def fixup_file(fname: str, dry_run: bool = False) -> str:
+    '''Copy RVA2 values to TXXX tags in fname, if it is an ID3 file.'''
+    from mutagen.id3 import ID3FileType
+    from rganalysis.fixup_id3 import fixup_ID3_tags
+    track = MusicFile(fname)
+    if track is None:
+        return NOT_MUSIC
+    if not isinstance(track, ID3FileType) or not fixup_ID3_tags(track):
+        return UNCHANGED
+    if not dry_run:
+        track.save()
+    return FIXED
+
+def strip_file(fname: str, dry_run: bool = False) -> str:
+    '''Delete all ReplayGain tags from fname.'''
+    track = MusicFile(fname)
+    if track is None:
+        return NOT_MUSIC
+    keys = rg_tag_keys(track)
+    if not keys:
+        return UNCHANGED
+    for k in keys:
+        logger.debug("Deleting tag %s from %s", repr(k), repr(fname))
+        del track[k]
+    if not dry_run:
+        track.save()
+    return STRIPPED
+
+actions = {
+    'fixup': fixup_file,
+    'strip': strip_file,
+}
+
+def _run_action(action: str, dry_run: bool, fname: str) -> Tuple[str, str]:
+    try:
+        return (fname, actions[action](fname, dry_run))
+    except Exception:
+        logger.error("Failed to %s %s:\n\n%s\n", action, repr(fname), traceback.format_exc())
+        return (fname, FAILED)
+
+def maintain_files(fnames: Iterable[str], action: str, jobs: int = 1,
+                   dry_run: bool = False) -> Iterator[Tuple[str, str]]:
+    '''Apply action ("fixup" or "strip") to each file, with jobs processes.
+
+    Yields (file name, outcome) in order of completion, where outcome
+    is one of "fixed", "stripped", "unchanged", "not music" or
+    "failed". With dry_run, no file is saved, but the outcomes are
+    the same.
+
+    '''
+    if action not in actions:
+        raise ValueError("Unknown tag maintenance action: {!r}".format(action))
+    func = partial(_run_action, action, dry_run)
+    if jobs <= 1:
+        yield from map(func, fnames)
+        return
+    with Pool(jobs) as pool:
+        # Files are small units of work, so they are sent in chunks
+        yield from pool.imap_unordered(func, fnames, chunksize=64)
+
+def maintain(paths: Iterable[str], action: str, jobs: int = 1, include_hidden: bool = False,
+             dry_run: bool = False,
+             progress: Optional[Callable[[Iterable[Tuple[str, str]]], Iterable[Tuple[str, str]]]] = None) -> Counter[str]:
+    '''Apply action to every file in paths, and return the number of each outcome.
+
+    If given, progress wraps the stream of (file name, outcome) pairs,
+    e.g. to show a progress bar with tqdm.
+
+    '''
+    fnames = ( fname for (fname, _) in find_candidate_files(paths, ignore_hidden=not include_hidden) )
+    outcomes = maintain_files(fnames, action, jobs, dry_run) # type: Iterable[Tuple[str, str]]
+    if progress is not None:
+        outcomes = progress(outcomes)
+    counts = collections.Counter() # type: Counter[str]
+    for (_, outcome) in outcomes:
+        counts[outcome] += 1
+    return counts
@@ -0,0 +1,356 @@
+'''Reading decoded PCM audio from music files.
+
+A PCMSource gives random access to the audio of a file as float
+samples (see rganalysis.dsp), so that parts of a file can be decoded
+without decoding everything before them. Uncompressed WAV, Wave64 and
+AIFF files are memory-mapped and read without any decoding; other
+formats are decoded by ffmpeg, which seeks to the requested position
+before decoding.
+
+'''
+
+from typing import BinaryIO, Iterator, List, NamedTuple, Optional, Tuple
+
+import mmap
+import os
+import struct
+
+from shutil import which
+from subprocess import PIPE, CalledProcessError, Popen, run
+
+import numpy as np
+
+from rganalysis import MusicFile
+from rganalysis.dsp import pcm_to_float
+
+ffmpeg_path = os.getenv("FFMPEG_PATH") or which("ffmpeg")
+
+class PCMSource(object):
+    '''Random access to the decoded audio of a file.
+
+    Subclasses set sample_rate, channels and frames (the length in
+    sample frames, which may be approximate for compressed formats)
+    and implement read.
+
+    '''
+    sample_rate = 0
+    channels = 0
+    frames = 0
+
+    def __init__(self, fname: str) -> None:
+        self.filename = fname
+
+    def __repr__(self) -> str:
+        return "{}({!r})".format(type(self).__name__, self.filename)
+
+    def read(self, start: int, count: Optional[int] = None) -> np.ndarray:
+        '''Return count frames from frame start on, or all of them if count is None.
+
+        The result has shape (frames, channels), and may be shorter
+        than count at the end of the file.
+
+        '''
+        raise NotImplementedError("This method should be overridden in a subclass")
+
+    def blocks(self, block_frames: int = 1 << 16) -> Iterator[np.ndarray]:
+        '''Yield all samples in order as float arrays of up to block_frames frames.'''
+        for start in range(0, self.frames, block_frames):
+            yield self.read(start, block_frames)
+
+    def close(self) -> None:
+        pass
+
+# Sony Wave64 chunk GUIDs
+W64_RIFF = b'riff' + bytes.fromhex('2e91cf11a5d628db04c10000')
+W64_WAVE = b'wave' + bytes.fromhex('f3acd3118cd100c04f8edb8a')
+W64_FMT = b'fmt ' + bytes.fromhex('f3acd3118cd100c04f8edb8a')
+W64_DATA = b'data' + bytes.fromhex('f3acd3118cd100c04f8edb8a')
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xfffe
+
+PCMLayout = NamedTuple('PCMLayout', [
+    ('offset', int),
+    ('frames', int),
+    ('sample_rate', int),
+    ('channels', int),
+    ('width', int),
+    ('is_float', bool),
+    ('signed', bool),
+    ('big_endian', bool),
+])
+PCMLayout.__doc__ = '''Where and how the samples of an uncompressed file are stored.
+
+offset is the byte offset of the first sample, and width the number
+of bytes per sample.'''
+
+def _wav_format(fmt: bytes) -> Optional[Tuple[int, int, int, bool]]:
+    '''Parse a WAV fmt chunk into (sample rate, channels, width, is_float).'''
+    (tag, channels, rate, _, block_align, bits) = struct.unpack('<HHIIHH', fmt[:16])
+    if tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+        # The real format tag starts the subformat GUID
+        tag = struct.unpack('<H', fmt[24:26])[0]
+    if tag not in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT) or channels == 0:
+        return None
+    width = block_align // channels
+    if width not in (1, 2, 3, 4, 8) or (tag == WAVE_FORMAT_IEEE_FLOAT and width not in (4, 8)):
+        return None
+    return (rate, channels, width, tag == WAVE_FORMAT_IEEE_FLOAT)
+
+def _wav_layout(f: BinaryIO, size: int) -> Optional[PCMLayout]:
+    pos = 12
+    fmt = None                  # type: Optional[Tuple[int, int, int, bool]]
+    while pos + 8 <= size:
+        f.seek(pos)
+        (chunk_id, chunk_size) = struct.unpack('<4sI', f.read(8))
+        if chunk_id == b'fmt ':
+            fmt = _wav_format(f.read(chunk_size))
+            if fmt is None:
+                return None
+        elif chunk_id == b'data' and fmt is not None:
+            (rate, channels, width, is_float) = fmt
+            # The size of the data chunk is often wrong in files
+            # written by streaming encoders
+            data_size = min(chunk_size, size - pos - 8)
+            return PCMLayout(pos + 8, data_size // (width * channels), rate, channels,
+                             width, is_float, signed=(width > 1), big_endian=False)
+        pos += 8 + chunk_size + (chunk_size & 1)
+    return None
+
+def _w64_layout(f: BinaryIO, size: int) -> Optional[PCMLayout]:
+    pos = 40
+    fmt = None                  # type: Optional[Tuple[int, int, int, bool]]
+    while pos + 24 <= size:
+        f.seek(pos)
+        (guid, chunk_size) = struct.unpack('<16sQ', f.read(24))
+        if chunk_size < 24:
+            return None
+        if guid == W64_FMT:
+            fmt = _wav_format(f.read(chunk_size - 24))
+            if fmt is None:
+                return None
+        elif guid == W64_DATA and fmt is not None:
+            (rate, channels, width, is_float) = fmt
+            data_size = min(chunk_size - 24, size - pos - 24)
+            return PCMLayout(pos + 24, data_size // (width * channels), rate, channels,
+                             width, is_float, signed=(width > 1), big_endian=False)
+        # Chunks are aligned to 8 bytes
+        pos += (chunk_size + 7) & ~7
+    return None
+
+def _ieee_extended(data: bytes) -> float:
+    '''Decode an 80-bit IEEE 754 extended precision number (the AIFF sample rate).'''
+    exponent = ((data[0] & 0x7f) << 8) | data[1]
+    mantissa = int.from_bytes(data[2:10], 'big')
+    if exponent == 0 and mantissa == 0:
+        return 0.0
+    value = mantissa * 2.0 ** (exponent - 16383 - 63)
+    return -value if data[0] & 0x80 else value
+
+# AIFF-C compression types of uncompressed data: (is_float, big_endian)
+AIFC_TYPES = {
+    b'NONE': (False, True),
+    b'twos': (False, True),
+    b'sowt': (False, False),
+    b'fl32': (True, True),
+    b'FL32': (True, True),
+    b'fl64': (True, True),
+    b'FL64': (True, True),
+}
+
+def _aiff_layout(f: BinaryIO, size: int, aifc: bool) -> Optional[PCMLayout]:
+    pos = 12
+    comm = None                 # type: Optional[Tuple[int, int, int, int, bool, bool]]
+    while pos + 8 <= size:
+        f.seek(pos)
+        (chunk_id, chunk_size) = struct.unpack('>4sI', f.read(8))
+        if chunk_id == b'COMM':
+            data = f.read(chunk_size)
+            (channels, frames, bits) = struct.unpack('>hIh', data[:8])
+            rate = int(_ieee_extended(data[8:18]))
+            (is_float, big_endian) = AIFC_TYPES.get(data[18:22], (None, None)) if aifc else (False, True)
+            if is_float is None or channels <= 0:
+                return None
+            comm = (channels, frames, (bits + 7) // 8, rate, is_float, big_endian)
+        elif chunk_id == b'SSND' and comm is not None:
+            (channels, frames, width, rate, is_float, big_endian) = comm
+            f.seek(pos + 8)
+            (data_offset, _) = struct.unpack('>II', f.read(8))
+            start = pos + 16 + data_offset
+            frames = min(frames, (size - start) // (width * channels))
+            return PCMLayout(start, frames, rate, channels, width, is_float,
+                             signed=True, big_endian=big_endian)
+        pos += 8 + chunk_size + (chunk_size & 1)
+    return None
+
+def uncompressed_layout(fname: str) -> Optional[PCMLayout]:
+    '''Return the PCMLayout of a WAV, Wave64 or AIFF file, or None.
+
+    Returns None for other files, and for compressed or otherwise
+    unsupported sample formats within these containers.
+
+    '''
+    size = os.path.getsize(fname)
+    with open(fname, 'rb') as f:
+        magic = f.read(40)
+        try:
+            if magic[:4] == b'RIFF' and magic[8:12] == b'WAVE':
+                return _wav_layout(f, size)
+            if magic[:16] == W64_RIFF and magic[24:40] == W64_WAVE:
+                return _w64_layout(f, size)
+            if magic[:4] == b'FORM' and magic[8:12] in (b'AIFF', b'AIFC'):
+                return _aiff_layout(f, size, magic[8:12] == b'AIFC')
+        except struct.error:
+            # Truncated header
+            pass
+    return None
+
+class MappedPCMSource(PCMSource):
+    '''Reads uncompressed WAV, Wave64 and AIFF files through a memory map.
+
+    The samples are exposed without copying as a NumPy view of the
+    mapped data: raw returns a (frames, channels) view of any range
+    of frames, in the file's own sample format. Packed 24-bit samples
+    are viewed as (frames, channels, 3) bytes, since NumPy has no
+    24-bit type. read and blocks convert one range at a time to
+    floats, so the whole file is never converted at once, and only
+    the pages that are actually read are loaded from disk.
+
+    '''
+    def __init__(self, fname: str, layout: Optional[PCMLayout] = None) -> None:
+        super(MappedPCMSource, self).__init__(fname)
+        layout = layout or uncompressed_layout(fname)
+        if layout is None:
+            raise ValueError("{!r} is not an uncompressed WAV, Wave64 or AIFF file".format(fname))
+        self.layout = layout
+        self.sample_rate = layout.sample_rate
+        self.channels = layout.channels
+        self.frames = layout.frames
+        with open(fname, 'rb') as f:
+            # An empty file cannot be mapped
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if layout.frames else None
+        endian = '>' if layout.big_endian else '<'
+        if layout.frames == 0:
+            self.view = np.zeros((0, layout.channels), dtype=np.float32)
+        elif layout.width == 3:
+            self.view = np.frombuffer(self.map, dtype=np.uint8, offset=layout.offset,
+                                      count=layout.frames * layout.channels * 3).reshape(-1, layout.channels, 3)
+        else:
+            kind = 'f' if layout.is_float else ('i' if layout.signed else 'u')
+            self.view = np.frombuffer(self.map, dtype='{}{}{}'.format(endian, kind, layout.width), offset=layout.offset,
+                                      count=layout.frames * layout.channels).reshape(-1, layout.channels)
+
+    def raw(self, start: int, count: Optional[int] = None) -> np.ndarray:
+        '''Return a view of count frames from frame start on, without copying.'''
+        return self.view[start:self.frames if count is None else start + count]
+
+    def read(self, start: int, count: Optional[int] = None) -> np.ndarray:
+        layout = self.layout
+        if layout.frames == 0:
+            return self.view
+        return pcm_to_float(self.raw(start, count), 8 * layout.width, layout.channels,
+                            signed=layout.signed, big_endian=layout.big_endian,
+                            is_float=layout.is_float)
+
+    def close(self) -> None:
+        self.view = None
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # Views of the map are still in use, so leave it to be
+                # closed when they are gone
+                pass
+            self.map = None
+
+class FFmpegSource(PCMSource):
+    '''Decodes any format that ffmpeg supports.
+
+    The format parameters come from mutagen, and every read runs
+    ffmpeg with input seeking, so it only decodes from about the
+    requested position on. blocks runs ffmpeg once for the whole
+    file and reads its output as it is decoded.
+
+    '''
+    def __init__(self, fname: str) -> None:
+        if not ffmpeg_path:
+            raise ValueError("Decoding {!r} requires ffmpeg, which was not found in $PATH. Set FFMPEG_PATH to the ffmpeg executable to use it.".format(fname))
+        super(FFmpegSource, self).__init__(fname)
+        info = MusicFile(fname).info
+        self.sample_rate = int(getattr(info, 'sample_rate', 0) or 44100)
+        self.channels = int(getattr(info, 'channels', 0) or 2)
+        self.frames = int(info.length * self.sample_rate)
+
+    def _command(self, start: int = 0, count: Optional[int] = None) -> List[str]:
+        cmd = [ffmpeg_path, '-nostdin', '-v', 'error']
+        if start:
+            cmd += ['-ss', '{:.6f}'.format(start / self.sample_rate)]
+        cmd += ['-i', self.filename]
+        if count is not None:
+            cmd += ['-t', '{:.6f}'.format(count / self.sample_rate)]
+        return cmd + ['-f', 'f32le', '-acodec', 'pcm_f32le',
+                      '-ac', str(self.channels), '-ar', str(self.sample_rate), '-']
+
+    def read(self, start: int, count: Optional[int] = None) -> np.ndarray:
+        cmd = self._command(start, count)
+        p = run(cmd, stdout=PIPE, stderr=PIPE)
+        if p.returncode != 0:
+            raise CalledProcessError(p.returncode, cmd, p.stdout, p.stderr)
+        samples = np.frombuffer(p.stdout, dtype='<f4')
+        samples = samples[:len(samples) - len(samples) % self.channels]
+        return samples.reshape(-1, self.channels)
+
+    def blocks(self, block_frames: int = 1 << 16) -> Iterator[np.ndarray]:
+        cmd = self._command()
+        # Errors are few with "-v error", so they cannot fill the pipe
+        p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        try:
+            while True:
+                data = p.stdout.read(block_frames * self.channels * 4)
+                if not data:
+                    break
+                samples = np.frombuffer(data, dtype='<f4')
+                yield samples[:len(samples) - len(samples) % self.channels].reshape(-1, self.channels)
+            stderr = p.stderr.read()
+            if p.wait() != 0:
+                raise CalledProcessError(p.returncode, cmd, None, stderr)
+        finally:
+            if p.poll() is None:
+                p.kill()
+            p.wait()
+            p.stdout.close()
+            p.stderr.close()
+
+def open_pcm(fname: str) -> PCMSource:
+    '''Return a PCMSource for fname.'''
+    layout = uncompressed_layout(fname)
+    if layout is not None:
+        return MappedPCMSource(fname, layout)
+    return FFmpegSource(fname)
+
+def can_decode(fname: str) -> bool:
+    '''Return True if open_pcm can probably decode fname.'''
+    try:
+        open_pcm(fname).close()
+        return True
+    except Exception:
+        return False
+
+def excerpt_ranges(frames: int, sample_rate: int, excerpt_seconds: float,
+                   interval_seconds: float) -> List[Tuple[int, int]]:
+    '''Return (start, count) frame ranges of evenly spaced excerpts.
+
+    Roughly one excerpt of excerpt_seconds is taken from every
+    interval_seconds of audio, and at least two from audio longer
+    than one interval, each centered in an equal share of the audio.
+    If the excerpts would cover all of it anyway, a single range
+    covering all of it is returned.
+
+    '''
+    (excerpt, interval) = (int(excerpt_seconds * sample_rate), int(interval_seconds * sample_rate))
+    if frames <= interval or excerpt >= interval or 2 * excerpt >= frames:
+        return [(0, frames)]
+    n = max(2, frames // interval)
+    spacing = frames / n
+    return [ (int(i * spacing + (spacing - excerpt) / 2), excerpt) for i in range(n) ]
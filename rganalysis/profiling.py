@@ -0,0 +1,192 @@
+'''Profiling a run across the main process and its workers.
+
+Most of the work of a run happens in short-lived worker processes,
+which an external profiler cannot easily follow. When profiling is
+enabled with start_session, the main process and every worker started
+by rganalysis.engine run cProfile (and optionally tracemalloc), and
+write their results to the profile directory when they finish.
+
+Profiles are kept separately for each stage of the work: "discover"
+(finding and reading music files), "group" (sorting them into track
+sets), "analyze" (computing gain, and everything else a worker does)
+and "write" (saving tags). Code marks its stage with the stage
+context manager, or by wrapping an iterator with staged. Both do
+nothing unless profiling is enabled.
+
+At the end of the run, summarize merges the profiles of all
+processes into one pstats file per stage and one overall, and writes
+a summary of the slowest functions.
+
+'''
+
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+import glob
+import io
+import os
+import time
+
+from contextlib import contextmanager
+
+from rganalysis.common import logger
+
+STAGES = ('discover', 'group', 'analyze', 'write')
+
+ProfileOptions = NamedTuple('ProfileOptions', [
+    ('directory', str),
+    ('memory', bool),
+])
+ProfileOptions.__doc__ = '''Where profiles go, and whether to trace memory allocations.'''
+
+class ProfileSession(object):
+    '''The profilers of one process, one for each stage.'''
+    def __init__(self, options: ProfileOptions, label: str, default_stage: str) -> None:
+        import cProfile
+        self.options = options
+        self.label = label
+        self.profilers = { name: cProfile.Profile() for name in STAGES + ('other',) }
+        self.stack = [ default_stage ]
+        if options.memory:
+            import tracemalloc
+            tracemalloc.start()
+        self.profilers[default_stage].enable()
+
+    def push(self, name: str) -> None:
+        self.profilers[self.stack[-1]].disable()
+        self.stack.append(name)
+        self.profilers[name].enable()
+
+    def pop(self) -> None:
+        self.profilers[self.stack.pop()].disable()
+        self.profilers[self.stack[-1]].enable()
+
+    def stop(self) -> None:
+        '''Stop profiling and write the results.'''
+        self.profilers[self.stack[-1]].disable()
+        os.makedirs(self.options.directory, exist_ok=True)
+        for (name, profiler) in self.profilers.items():
+            if profiler.getstats():
+                profiler.dump_stats(os.path.join(self.options.directory, "{}.{}.prof".format(self.label, name)))
+        if self.options.memory:
+            import tracemalloc
+            tracemalloc.take_snapshot().dump(os.path.join(self.options.directory, self.label + ".tracemalloc"))
+            tracemalloc.stop()
+
+_options = None                 # type: Optional[ProfileOptions]
+_session = None                 # type: Optional[ProfileSession]
+
+def current_options() -> Optional[ProfileOptions]:
+    '''Return the options of the profiling session, or None if profiling is off.
+
+    These are passed to worker processes, which call
+    start_worker_session with them.
+
+    '''
+    return _options
+
+def start_session(directory: str, memory: bool = False) -> None:
+    '''Start profiling this process and, from now on, its workers.'''
+    global _options, _session
+    if glob.glob(os.path.join(directory, "*.prof")):
+        logger.warning("%s already contains profiles, which will be merged with the new ones", repr(directory))
+    _options = ProfileOptions(directory, memory)
+    _session = ProfileSession(_options, "main", "other")
+
+def start_worker_session(options: Optional[ProfileOptions]) -> None:
+    '''Start profiling a worker process, if options is not None.'''
+    global _options, _session
+    if options is None:
+        return
+    _options = options
+    _session = ProfileSession(options, "worker-{}-{}".format(os.getpid(), time.monotonic_ns()), "analyze")
+
+def stop_session() -> None:
+    '''Stop profiling this process, if it is being profiled, and write the results.'''
+    global _session
+    if _session is not None:
+        _session.stop()
+        _session = None
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    '''Attribute the time spent in the with block to stage name.'''
+    if _session is None:
+        yield
+        return
+    _session.push(name)
+    try:
+        yield
+    finally:
+        _session.pop()
+
+def staged(iterable: Iterable, name: str) -> Iterator:
+    '''Attribute the time spent producing each item of iterable to stage name.'''
+    if _session is None:
+        return iter(iterable)
+    return _staged(iter(iterable), name)
+
+def _staged(iterator: Iterator, name: str) -> Iterator:
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+def summarize(directory: str, top: int = 25) -> str:
+    '''Merge the profiles in directory, and return a summary of them.
+
+    Writes all.prof, with the profiles of every process and stage,
+    and STAGE.prof for each stage, which can be examined with the
+    pstats module (e.g. "python -m pstats all.prof"), as well as the
+    summary, to summary.txt.
+
+    '''
+    import pstats
+    out = io.StringIO()
+    by_stage = {}               # type: Dict[str, List[str]]
+    # The profiles of each process are named LABEL.STAGE.prof
+    for fname in sorted(glob.glob(os.path.join(directory, "*.*.prof"))):
+        by_stage.setdefault(fname.rsplit('.', 2)[1], []).append(fname)
+    if not by_stage:
+        return "No profiles found in {}\n".format(directory)
+    workers = len({ os.path.basename(f).split('.')[0] for files in by_stage.values() for f in files }) - 1
+    out.write("Profiles of the main process and {} worker processes\n\n".format(workers))
+    merged = None               # type: Any
+    for stage_name in sorted(by_stage, key=lambda s: (STAGES + ('other',)).index(s)):
+        stats = pstats.Stats(*by_stage[stage_name], stream=out)
+        stats.dump_stats(os.path.join(directory, stage_name + ".prof"))
+        out.write("Stage {}: {:.2f} seconds in {} processes\n".format(
+            stage_name, stats.total_tt, len(by_stage[stage_name])))
+        if merged is None:
+            merged = pstats.Stats(*by_stage[stage_name], stream=out)
+        else:
+            merged.add(*by_stage[stage_name])
+    merged.dump_stats(os.path.join(directory, "all.prof"))
+    out.write("\nFunctions with the most time spent in them, over all stages:\n")
+    # Otherwise the name of every profile file is printed first
+    merged.files = []
+    merged.sort_stats('tottime').print_stats(top)
+    memory = _memory_summary(directory, top)
+    if memory:
+        out.write(memory)
+    summary = out.getvalue()
+    with open(os.path.join(directory, "summary.txt"), "w") as f:
+        f.write(summary)
+    return summary
+
+def _memory_summary(directory: str, top: int) -> str:
+    snapshots = sorted(glob.glob(os.path.join(directory, "*.tracemalloc")))
+    if not snapshots:
+        return ""
+    import tracemalloc
+    sizes = {}                  # type: Dict[Any, List[int]]
+    for fname in snapshots:
+        for stat in tracemalloc.Snapshot.load(fname).statistics('lineno'):
+            (size, count) = sizes.setdefault(stat.traceback, [0, 0])
+            sizes[stat.traceback] = [size + stat.size, count + stat.count]
+    lines = [ "\nLines with the most memory allocated at the end of each process, summed over {} processes:\n".format(len(snapshots)) ]
+    for (tb, (size, count)) in sorted(sizes.items(), key=lambda item: item[1][0], reverse=True)[:top]:
+        lines.append("{:>10.1f} KiB in {:>8} blocks  {}\n".format(size / 1024, count, tb))
+    return "".join(lines)
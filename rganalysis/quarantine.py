@@ -0,0 +1,119 @@
+'''Persistent list of files that could not be analyzed.
+
+A file whose analysis repeatedly hangs or crashes the worker process
+is added to a skip list, so that later runs don't spend time on it
+again. A single bad run (e.g. on an overloaded system) is not enough:
+each failure is recorded, and a file is only skipped once it has
+failed in SkipList.quarantine_runs different runs without being
+analyzed successfully in between. Entries remember the size and
+modification time of the file, and are forgotten once the file
+changes (e.g. because it has been replaced by a good copy).
+
+'''
+
+from typing import Any, Dict, Iterable, List
+
+import json
+import os
+import threading
+
+from rganalysis.common import logger
+
+class SkipList(object):
+    '''A set of quarantined files, stored as a JSON file.
+
+    The methods are thread-safe, since the threads of a WorkerPool
+    add files to the list concurrently. Changes are only written to
+    disk by save, and only if there are any.
+
+    '''
+    # Number of runs in which a file must fail before it is skipped
+    quarantine_runs = 2
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}       # type: Dict[str, Dict[str, Any]]
+        # Files that failed in this run, and those of them that are
+        # now quarantined
+        self.failed = []        # type: List[str]
+        self.added = []         # type: List[str]
+        self.skipped = []       # type: List[str]
+        self.changed = False
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            logger.warning("Ignoring unreadable skip list %s", repr(path))
+
+    def __repr__(self) -> str:
+        return "SkipList({!r})".format(self.path)
+
+    def _unchanged(self, fname: str, entry: Dict[str, Any]) -> bool:
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return False
+        return (st.st_size, st.st_mtime_ns) == (entry['size'], entry['mtime'])
+
+    def __contains__(self, fname: str) -> bool:
+        '''True if fname is quarantined and has not changed since.'''
+        entry = self.entries.get(fname)
+        if entry is None or entry['failures'] < self.quarantine_runs:
+            return False
+        return self._unchanged(fname, entry)
+
+    def should_skip(self, fname: str) -> bool:
+        '''Like "fname in self", but also records fname as skipped.'''
+        if fname in self:
+            logger.info("Skipping quarantined file %s", repr(fname))
+            with self.lock:
+                self.skipped.append(fname)
+            return True
+        return False
+
+    def add(self, fname: str, reason: str) -> bool:
+        '''Record a failure of fname in this run.
+
+        Returns True if fname is now quarantined.'''
+        st = os.stat(fname)
+        with self.lock:
+            if fname in self.failed:
+                return fname in self.added
+            entry = self.entries.get(fname)
+            if entry is None or (entry['size'], entry['mtime']) != (st.st_size, st.st_mtime_ns):
+                entry = self.entries[fname] = {'failures': 0}
+            entry.update(size=st.st_size, mtime=st.st_mtime_ns, reason=reason)
+            entry['failures'] += 1
+            self.failed.append(fname)
+            self.changed = True
+            if entry['failures'] >= self.quarantine_runs:
+                self.added.append(fname)
+                return True
+            return False
+
+    def clear(self, fnames: Iterable[str]) -> None:
+        '''Forget earlier failures of fnames, which were analyzed successfully.'''
+        with self.lock:
+            for fname in fnames:
+                if fname in self.entries and fname not in self.failed:
+                    del self.entries[fname]
+                    self.changed = True
+
+    def save(self) -> None:
+        '''Write the list, if it has changed.'''
+        with self.lock:
+            # Forget files that have changed or disappeared
+            entries = { k: v for (k, v) in self.entries.items() if self._unchanged(k, v) }
+            if not self.changed and len(entries) == len(self.entries):
+                return
+            dirname = os.path.dirname(self.path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(entries, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+            (self.entries, self.changed) = (entries, False)
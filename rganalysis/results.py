@@ -0,0 +1,92 @@
+'''Structured results of analyzing track sets.
+
+These are plain named tuples, so they can be passed between
+processes and are easy to consume from other programs.
+
+'''
+
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+# Values for AlbumResult.status
+ANALYZED = "analyzed"
+SKIPPED = "skipped"
+FAILED = "failed"
+# Statuses of track sets whose results are applied from a file
+APPLIED = "applied"
+STALE = "stale"
+# Statuses of audited track sets
+CONSISTENT = "consistent"
+DRIFTED = "drifted"
+
+TrackResult = NamedTuple('TrackResult', [
+    ('filename', str),
+    ('gain', Optional[float]),
+    ('peak', Optional[float]),
+    ('gain_error', Optional[float]),
+    ('true_peak', Optional[float]),
+])
+TrackResult.__doc__ = '''Gain values of a single track.
+
+gain_error is the half-width in dB of the 95% confidence interval of
+a provisional gain, if known (see AlbumResult). true_peak is only set
+if it is stored in a separate tag.'''
+
+AlbumResult = NamedTuple('AlbumResult', [
+    ('key', str),
+    ('directory', str),
+    ('status', str),
+    ('gain_type', str),
+    ('album_gain', Optional[float]),
+    ('album_peak', Optional[float]),
+    ('tracks', List[TrackResult]),
+    ('error', Optional[str]),
+    ('quarantined', List[str]),
+    ('provisional', bool),
+    ('album_gain_error', Optional[float]),
+    ('drift', Optional[float]),
+    ('album_true_peak', Optional[float]),
+])
+AlbumResult.__doc__ = '''Outcome of processing one track set.
+
+status is one of "analyzed", "skipped" (the track set already had
+valid tags) or "failed", in which case error holds a description of
+the failure. quarantined lists any files that were added to the
+skip list because they caused the failure. gain_type is "album" or
+"track"; for "track", album_gain and album_peak are None. The gain
+values are the ones written to the files, or the ones that would have
+been written in dry-run mode. provisional is True if they are fast
+estimates, to be replaced by a later full analysis, in which case
+album_gain_error is the half-width in dB of the 95% confidence
+interval of album_gain, if known.
+
+When a track set is audited (see rganalysis.audit), status is
+"consistent" or "drifted" instead, the gain values are the newly
+measured ones (the files are not modified), and drift is the largest
+difference in dB between a measured gain and the stored one.
+
+When results exported with rganalysis.export are applied, status is
+"applied", "stale" (a file changed since it was analyzed, so nothing
+was written) or "failed".'''
+
+AuditReport = NamedTuple('AuditReport', [
+    ('tolerance', float),
+    ('population', int),
+    ('untagged', int),
+    ('sampled', int),
+    ('failed', int),
+    ('drift_rate', float),
+    ('drift_rate_error', float),
+    ('strata', Dict[str, Tuple[int, int, int]]),
+    ('drifted', List[AlbumResult]),
+])
+AuditReport.__doc__ = '''Outcome of auditing a collection.
+
+population is the number of track sets with valid tags, from which
+sampled track sets were audited (of which failed could not be
+analyzed); untagged is the number without valid tags. drift_rate is
+the estimated fraction of the population whose gain differs from the
+stored one by more than tolerance dB, and drift_rate_error the
+half-width of its 95% confidence interval. strata maps each stratum
+(file type) to its population, sample size and number of drifted
+track sets, and drifted lists the results of the drifted track
+sets.'''
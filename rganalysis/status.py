@@ -0,0 +1,156 @@
+'''Read-only report of the state of the ReplayGain tags of a library.
+
+Before a tagging run, it helps to know how much of a collection needs
+work. status walks the given paths, reads the tags of every music
+file (and, for ID3 files without valid tags, the ID3 header again to
+look for RVA2 frames), groups the files into track sets as analysis
+would, and gives each track set one of these statuses:
+
+- "rva2 only": some ID3 track has ReplayGain values only in RVA2
+  frames, which analysis does not read, and no TXXX frames. Copying
+  them with --fixup-only (see rganalysis.fixup_id3) may be enough.
+- "untagged": some track has no track gain or peak tags.
+- "inconsistent": every track has track tags, but the album gain
+  tags are missing, disagree between tracks, or are present where
+  no album gain is wanted (see RGTrackSet.want_album_gain, which
+  also checks for TRACKGAIN signal files).
+- "provisional": the tags are valid, but are estimates from
+  --fast-estimate (see RGTrack.is_provisional), which a full
+  analysis would replace.
+- "ok": nothing to do.
+
+No backend is loaded and nothing is decoded, so this only takes as
+long as reading the tags. Each directory is read in one of several
+worker processes.
+
+'''
+
+from typing import IO, Iterable, Iterator, List, NamedTuple, Sequence, Tuple
+
+import itertools
+import json
+import os
+import traceback
+
+from functools import partial
+from multiprocessing import Pool
+
+from rganalysis import MusicFile, RGTrack, RGTrackSet, find_candidate_files
+from rganalysis.backends import NullGainComputer
+from rganalysis.common import logger
+
+# Album statuses, in order of precedence
+RVA2_ONLY = "rva2 only"
+UNTAGGED = "untagged"
+INCONSISTENT = "inconsistent"
+PROVISIONAL = "provisional"
+OK = "ok"
+FAILED = "failed"
+
+STATUSES = (RVA2_ONLY, UNTAGGED, INCONSISTENT, PROVISIONAL, OK, FAILED)
+
+AlbumStatus = NamedTuple('AlbumStatus', [
+    ('key', str),
+    ('directory', str),
+    ('status', str),
+    ('gain_type', str),
+    ('filenames', List[str]),
+])
+AlbumStatus.__doc__ = '''The tag status of one track set.
+
+gain_type is "album" or "track", as analysis would choose it, and is
+empty for directories that failed to be read.
+
+'''
+
+class TagOnlyGainComputer(NullGainComputer):
+    '''Accepts every file, so that track sets can be made without a backend.
+
+    It still cannot compute gain.
+
+    '''
+    def supports_file(self, fname: str) -> bool:
+        return True
+
+def has_rva2_only(fname: str) -> bool:
+    '''Return True if the ID3 tag of fname has RVA2 frames but no TXXX:replaygain_* frames.'''
+    from mutagen.id3 import ID3, ID3NoHeaderError
+    try:
+        tags = ID3(fname)
+    except ID3NoHeaderError:
+        return False
+    keys = [ k.lower() for k in tags.keys() ]
+    return any(k.startswith('rva2:') for k in keys) and not any(k.startswith('txxx:replaygain_') for k in keys)
+
+def track_set_status(track_set: RGTrackSet) -> str:
+    '''Return the status of track_set, as described in the module documentation.'''
+    if track_set.has_valid_rgdata():
+        return PROVISIONAL if track_set.has_provisional_tags() else OK
+    from mutagen.id3 import ID3FileType
+    if any(isinstance(t.track, ID3FileType) and has_rva2_only(t.filename)
+           for t in track_set.RGTracks.values()):
+        return RVA2_ONLY
+    if not track_set.has_track_rgdata():
+        return UNTAGGED
+    return INCONSISTENT
+
+def directory_status(gain_type: str, directory: Tuple[str, Sequence[str]]) -> List[AlbumStatus]:
+    '''Return the status of each track set among the files of one directory.
+
+    directory is (directory name, file names).
+
+    '''
+    (dirname, fnames) = directory
+    try:
+        tracks = []             # type: List[RGTrack]
+        for fname in fnames:
+            try:
+                track = MusicFile(fname, easy=True)
+            except Exception:
+                logger.debug("File %s is not recognized", repr(fname))
+                continue
+            if track is not None:
+                tracks.append(RGTrack(track))
+        statuses = []           # type: List[AlbumStatus]
+        # The CUE sheets are only read, so the DSP modules that
+        # analyzing them needs are not loaded
+        for ts in RGTrackSet.MakeTrackSets(tracks, gain_backend=TagOnlyGainComputer(), cue_sheets=True):
+            ts.gain_type = gain_type
+            statuses.append(AlbumStatus(
+                key=ts.track_set_key_string(),
+                directory=ts.directory,
+                status=track_set_status(ts),
+                gain_type="album" if ts.want_album_gain() else "track",
+                filenames=ts.filenames))
+        return statuses
+    except Exception:
+        logger.error("Failed to read the tags in %s:\n\n%s\n", repr(dirname), traceback.format_exc())
+        return [ AlbumStatus(key=dirname, directory=dirname, status=FAILED, gain_type='', filenames=list(fnames)) ]
+
+def library_status(paths: Iterable[str], gain_type: str = 'auto', jobs: int = 1,
+                   include_hidden: bool = False) -> Iterator[AlbumStatus]:
+    '''Yield the AlbumStatus of every track set in paths, reading them with jobs processes.
+
+    Track sets are yielded in order of completion. gain_type is as for
+    RGTrackSet.
+
+    '''
+    if gain_type not in ('album', 'track', 'auto'):
+        raise ValueError('gain_type must be either "track", "album", or "auto"')
+    candidates = find_candidate_files(paths, ignore_hidden=not include_hidden)
+    # os.walk lists each directory's files together
+    directories = ( (dirname, [ fname for (fname, _) in group ])
+                    for (dirname, group) in itertools.groupby(candidates, key=lambda c: os.path.dirname(c[0])) )
+    func = partial(directory_status, gain_type)
+    if jobs <= 1:
+        for statuses in map(func, directories):
+            yield from statuses
+        return
+    with Pool(jobs) as pool:
+        for statuses in pool.imap_unordered(func, directories, chunksize=8):
+            yield from statuses
+
+def write_status(statuses: Iterable[AlbumStatus], f: IO[str]) -> None:
+    '''Write statuses to the text file f as JSON Lines, one object per track set.'''
+    for s in statuses:
+        f.write(json.dumps(s._asdict(), separators=(',', ':')) + '\n')
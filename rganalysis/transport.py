@@ -0,0 +1,272 @@
+'''Passing decoded audio between processes through shared memory.
+
+Sending decoded audio through a multiprocessing pipe pickles and
+copies every block twice, which at high sample rates is hundreds of
+MB per second. A PCMRing instead holds a fixed number of fixed-size
+slots of float32 samples in a multiprocessing.shared_memory segment.
+A producer process fills a free slot and passes only its length to
+the consumer, which reads the samples in place as a NumPy view and
+hands the slot back once it is done with it. Semaphores count the
+free and filled slots, so the producer blocks when the consumer falls
+behind and vice versa, and memory use is bounded by the size of the
+ring.
+
+decode_in_processes runs a decode function (e.g. that of the pipe
+backend, see rganalysis.backends.pipe) in several decoder processes,
+each writing into its own ring. Each decoder takes the next file not
+yet taken by another, so long and short tracks are spread over all
+of them, and the consumer takes blocks from all rings as they arrive,
+so that a single analyzer measures the tracks of a whole album while
+they are decoded in parallel. The number of decoders is independent
+of the number of analysis workers.
+
+Requires numpy and Python 3.8 or later.
+
+'''
+
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple, cast
+
+import multiprocessing
+import os
+import traceback
+
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from rganalysis.common import logger
+
+# Slot lengths that mark the start of a file (whose index is passed
+# along), the end of a file, the end of all files and a failure of
+# the producer
+START_OF_FILE = -1
+END_OF_FILE = -2
+END_OF_STREAM = -3
+FAILED = -4
+
+# Samples (not frames) per slot, and slots per ring: 4 MB per ring
+SLOT_SAMPLES = 1 << 17
+SLOTS = 8
+
+# Yields (sample rate, samples of shape (frames, channels)) for a file
+DecodeFunction = Callable[[str], Iterable[Tuple[int, np.ndarray]]]
+
+class PCMRing(object):
+    '''A ring of shared-memory slots for one producer and one consumer.
+
+    Each slot holds up to slot_samples samples, i.e. slot_samples //
+    channels frames. The producer calls put for each block (which may
+    be of any length; longer ones take several slots) and mark for
+    markers; the consumer calls get to wait for the next slot, and
+    release once it no longer needs the view that get returned.
+
+    The ring must be created before the producer process is started,
+    and unlink should be called once both sides are done with it.
+
+    '''
+    def __init__(self, slot_samples: int = SLOT_SAMPLES, slots: int = SLOTS, ctx: Any = None) -> None:
+        ctx = ctx or multiprocessing.get_context()
+        self.slot_samples = slot_samples
+        self.slots = slots
+        self.shm = SharedMemory(create=True, size=slots * slot_samples * 4)
+        self.samples = np.ndarray((slots, slot_samples), dtype=np.float32, buffer=self.shm.buf)
+        # Frames, channels and sample rate (or marker argument) of
+        # the contents of each slot
+        self.header = ctx.Array('q', 3 * slots, lock=False)
+        self.free = ctx.Semaphore(slots)
+        self.filled = ctx.Semaphore(0)
+        self.put_index = 0
+        self.get_index = 0
+        self.consumer_pid = os.getpid()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state['samples']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.samples = np.ndarray((self.slots, self.slot_samples), dtype=np.float32, buffer=self.shm.buf)
+
+    def _put_slot(self, frames: int, channels: int, value: int,
+                  samples: Optional[np.ndarray] = None) -> None:
+        # A consumer that was killed never frees a slot again
+        while not self.free.acquire(timeout=1.0):
+            if os.getppid() != self.consumer_pid:
+                raise RuntimeError("The consumer of the ring exited")
+        slot = self.put_index % self.slots
+        if samples is not None:
+            self.samples[slot, :samples.size].reshape(samples.shape)[...] = samples
+        self.header[3 * slot:3 * slot + 3] = [frames, channels, value]
+        self.put_index += 1
+        self.filled.release()
+
+    def put(self, samples: np.ndarray, sample_rate: int) -> None:
+        '''Copy samples of shape (frames, channels) into the ring.'''
+        channels = samples.shape[1]
+        block_frames = self.slot_samples // channels
+        if not block_frames:
+            raise ValueError("Audio has {} channels, but a slot only holds {} samples".format(channels, self.slot_samples))
+        for start in range(0, len(samples), block_frames):
+            block = samples[start:start + block_frames]
+            self._put_slot(len(block), channels, sample_rate, block)
+
+    def mark(self, marker: int, value: int = 0) -> None:
+        '''Put a marker (e.g. END_OF_FILE) and its argument into the ring.'''
+        self._put_slot(marker, 0, value)
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Tuple[int, int, Optional[np.ndarray]]]:
+        '''Wait for the next slot, and return (frames, sample rate, samples).
+
+        samples is a view into shared memory of shape (frames,
+        channels), valid until release is called. For a marker,
+        frames is the marker, the sample rate is replaced by its
+        argument, samples is None and release must not be called.
+        Returns None if nothing arrived within timeout seconds.
+
+        '''
+        if not self.filled.acquire(timeout=timeout):
+            return None
+        slot = self.get_index % self.slots
+        (frames, channels, value) = self.header[3 * slot:3 * slot + 3]
+        if frames < 0:
+            self.release()
+            return (frames, value, None)
+        return (frames, value, self.samples[slot, :frames * channels].reshape(frames, channels))
+
+    def release(self) -> None:
+        '''Hand the slot returned by the last get back to the producer.'''
+        self.get_index += 1
+        self.free.release()
+
+    def close(self) -> None:
+        '''Stop using the shared memory in this process.'''
+        del self.samples
+        self.shm.close()
+
+    def unlink(self) -> None:
+        '''Close and free the shared memory.'''
+        self.close()
+        self.shm.unlink()
+
+def _decode_files(ring: PCMRing, decode: DecodeFunction, fnames: List[str],
+                  next_file: Any, errors: Any) -> None:
+    try:
+        while True:
+            with next_file.get_lock():
+                index = next_file.value
+                next_file.value += 1
+            if index >= len(fnames):
+                break
+            ring.mark(START_OF_FILE, index)
+            for (sample_rate, samples) in decode(fnames[index]):
+                ring.put(samples, sample_rate)
+            ring.mark(END_OF_FILE)
+        ring.mark(END_OF_STREAM)
+    except Exception as ex:
+        logger.debug("Decoder process failed:\n\n%s\n", traceback.format_exc())
+        # The marker goes first, since the consumer only reads the
+        # error once it has seen it, and a large one would not fit
+        # into the pipe
+        ring.mark(FAILED)
+        try:
+            errors.send(ex)
+        except Exception:
+            # Not picklable
+            errors.send(RuntimeError(traceback.format_exc()))
+    finally:
+        errors.close()
+        ring.close()
+
+class DecoderProcess(object):
+    '''A process that decodes files into its own PCMRing.
+
+    It takes files from fnames, in order, by incrementing the shared
+    counter next_file, until none are left. current is the index of
+    the file whose blocks the consumer is reading.
+
+    '''
+    def __init__(self, fnames: List[str], decode: DecodeFunction, next_file: Any,
+                 slot_samples: int = SLOT_SAMPLES, slots: int = SLOTS) -> None:
+        self.ring = PCMRing(slot_samples, slots)
+        (self.errors, send_errors) = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(target=_decode_files,
+                                               args=(self.ring, decode, fnames, next_file, send_errors))
+        self.process.start()
+        send_errors.close()
+        self.current = -1
+
+    def error(self) -> BaseException:
+        '''Return the exception that stopped the process.'''
+        try:
+            return self.errors.recv()
+        except EOFError:
+            return RuntimeError("The decoder process exited with code {}".format(self.process.exitcode))
+
+    def close(self) -> None:
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        self.errors.close()
+        self.ring.unlink()
+
+def decode_in_processes(fnames: Iterable[str], decode: DecodeFunction, processes: int,
+                        slot_samples: int = SLOT_SAMPLES, slots: int = SLOTS
+                        ) -> Iterator[Tuple[str, Optional[Tuple[int, np.ndarray]]]]:
+    '''Decode fnames with decode in up to processes decoder processes.
+
+    Yields (file name, (sample rate, samples)) for each block of each
+    file as it arrives from any decoder, and (file name, None) once
+    a file is complete. The blocks of each file come in order, but
+    those of different files are interleaved. samples is a view into
+    shared memory of shape (frames, channels) that is only valid
+    until the next item is requested.
+
+    If decode raises an exception in a decoder process, it is raised
+    here (or a RuntimeError, if it cannot be pickled), and the other
+    decoders are stopped.
+
+    '''
+    fnames = list(fnames)
+    next_file = multiprocessing.Value('i', 0)
+    decoders = []               # type: List[DecoderProcess]
+    try:
+        for _ in range(max(1, min(processes, len(fnames)))):
+            decoders.append(DecoderProcess(fnames, decode, next_file, slot_samples, slots))
+        active = list(decoders)
+        # Number of rings found empty since the last block
+        idle = 0
+        i = 0
+        while active:
+            decoder = active[i % len(active)]
+            # Checked first: if the process had already exited, an
+            # empty ring means that it died before the end
+            alive = decoder.process.is_alive()
+            # Only wait once every ring has been found empty
+            item = decoder.ring.get(timeout=0.05 if idle >= len(active) else 0)
+            if item is None:
+                if not alive:
+                    raise decoder.error()
+                idle += 1
+                i += 1
+                continue
+            idle = 0
+            (frames, value, samples) = item
+            if frames == START_OF_FILE:
+                decoder.current = value
+            elif frames == END_OF_FILE:
+                yield (fnames[decoder.current], None)
+            elif frames == END_OF_STREAM:
+                active.remove(decoder)
+            elif frames == FAILED:
+                raise decoder.error()
+            else:
+                try:
+                    yield (fnames[decoder.current], (value, cast(np.ndarray, samples)))
+                finally:
+                    decoder.ring.release()
+                # Take turns, so that no ring fills up while another is read
+                i += 1
+    finally:
+        for decoder in decoders:
+            decoder.close()
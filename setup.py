@@ -28,6 +28,10 @@ setup(
         'progress_bars':  ['tqdm'],
         'audiotools_backend': ['audiotools'],
         'bs1770gain_backend': ['lxml'],
+        'adaptive_jobs': ['psutil'],
+        'true_peak': ['numpy'],
+        'fast_estimate': ['numpy', 'scipy'],
+        'native_backend': ['numpy', 'scipy'],
     },
     scripts=['scripts/rganalysis',],
 )
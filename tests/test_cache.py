@@ -0,0 +1,163 @@
+'''Audio fingerprints and the gain cache.
+
+Copies of a track with different tags must have the same fingerprint,
+and so share cached values, while different audio must not. Values
+cached without a true peak must not be used when one is wanted.
+
+'''
+
+import os
+import shutil
+import struct
+
+from typing import Dict, Iterable, List, Tuple
+
+from mutagen.id3 import TALB
+from mutagen.wave import WAVE
+
+from rganalysis.backends import GainComputer
+from rganalysis.cache import CachingGainComputer, GainCache
+from rganalysis.fingerprint import audio_fingerprint
+
+def write_wav(fname: str, data: bytes, rate: int = 44100, album: str = None) -> None:
+    fmt = struct.pack('<HHIIHH', 1, 2, rate, rate * 4, 4, 16)
+    body = b'WAVE' + b'fmt ' + struct.pack('<I', len(fmt)) + fmt + b'data' + struct.pack('<I', len(data)) + data
+    with open(fname, 'wb') as f:
+        f.write(b'RIFF' + struct.pack('<I', len(body)) + body)
+    if album is not None:
+        track = WAVE(fname)
+        track.add_tags()
+        track.tags.add(TALB(encoding=3, text=[album]))
+        track.save()
+
+def write_flac(fname: str, md5: bytes, frames: bytes, comment: bytes = b'') -> None:
+    '''Write a FLAC file with a STREAMINFO block, an optional
+    VORBIS_COMMENT block, and frames as the audio (not decodable).'''
+    streaminfo = bytes(18) + md5
+    blocks = [ (0, streaminfo) ]
+    if comment:
+        blocks.append((4, comment))
+    data = b'fLaC'
+    for (i, (block_type, block)) in enumerate(blocks):
+        last = 0x80 if i == len(blocks) - 1 else 0
+        data += bytes([ last | block_type ]) + len(block).to_bytes(3, 'big') + block
+    with open(fname, 'wb') as f:
+        f.write(data + frames)
+
+def test_flac_md5_fingerprint(tmpdir) -> None:
+    md5 = bytes(range(1, 17))
+    (a, b, c) = [ str(tmpdir.join(name)) for name in ('a.flac', 'b.flac', 'c.flac') ]
+    write_flac(a, md5, b'frames')
+    # Other tags and even other frames: the MD5 of the decoded audio is what counts
+    write_flac(b, md5, b'other frames', comment=b'tags')
+    write_flac(c, bytes(reversed(md5)), b'frames')
+    assert audio_fingerprint(a) == audio_fingerprint(b) == 'flac-md5:' + md5.hex()
+    assert audio_fingerprint(c) != audio_fingerprint(a)
+
+def test_flac_without_md5_hashes_frames(tmpdir) -> None:
+    (a, b, c) = [ str(tmpdir.join(name)) for name in ('a.flac', 'b.flac', 'c.flac') ]
+    write_flac(a, bytes(16), b'frames')
+    write_flac(b, bytes(16), b'frames', comment=b'tags')
+    write_flac(c, bytes(16), b'other frames')
+    assert audio_fingerprint(a).startswith('sha1:')
+    assert audio_fingerprint(a) == audio_fingerprint(b)
+    assert audio_fingerprint(c) != audio_fingerprint(a)
+
+def test_wav_fingerprint(tmpdir) -> None:
+    data = bytes(range(256)) * 16
+    (a, b, c, d) = [ str(tmpdir.join(name)) for name in ('a.wav', 'b.wav', 'c.wav', 'd.wav') ]
+    write_wav(a, data)
+    write_wav(b, data, album='Tagged')
+    # The same samples at another rate are other audio
+    write_wav(c, data, rate=48000)
+    write_wav(d, data[::-1])
+    assert audio_fingerprint(a) == audio_fingerprint(b)
+    assert len({ audio_fingerprint(f) for f in (a, c, d) }) == 3
+    # Retagging keeps the fingerprint
+    track = WAVE(a)
+    track.add_tags()
+    track.tags.add(TALB(encoding=3, text=['Retagged']))
+    track.save()
+    assert audio_fingerprint(a) == audio_fingerprint(b)
+
+class CountingGainComputer(GainComputer):
+    '''Returns made-up values, and records the files of each call.'''
+    def __init__(self) -> None:
+        self.calls = []         # type: List[Tuple[List[str], bool, bool]]
+
+    def compute_gain(self, fnames: Iterable[str], album: bool = True,
+                     true_peak: bool = False) -> Dict[str, Dict[str, float]]:
+        fnames = list(fnames)
+        self.calls.append((fnames, album, true_peak))
+        rginfo = {}
+        for fname in fnames:
+            tags = { "replaygain_track_gain": -6.0, "replaygain_track_peak": 0.5 }
+            if album:
+                tags.update({ "replaygain_album_gain": -7.0, "replaygain_album_peak": 0.75 })
+            if true_peak:
+                tags["replaygain_track_true_peak"] = 0.6
+                if album:
+                    tags["replaygain_album_true_peak"] = 0.8
+            rginfo[fname] = tags
+        return rginfo
+
+    def supports_file(self, fname: str) -> bool:
+        return True
+
+def make_cache(tmpdir) -> Tuple[CachingGainComputer, CountingGainComputer]:
+    backend = CountingGainComputer()
+    return (CachingGainComputer(backend, 'counting', GainCache(str(tmpdir.join('cache.sqlite')))), backend)
+
+def test_cache_hits_and_misses(tmpdir) -> None:
+    (cached, backend) = make_cache(tmpdir)
+    (a, copy, other) = [ str(tmpdir.join(name)) for name in ('a.wav', 'copy.wav', 'other.wav') ]
+    write_wav(a, bytes(400))
+    write_wav(copy, bytes(400), album='Compilation')
+    write_wav(other, bytes(800))
+    assert cached.compute_gain([a], album=False)[a]["replaygain_track_gain"] == -6.0
+    assert len(backend.calls) == 1
+    # The same file, and a copy with other tags, are hits
+    assert cached.compute_gain([a], album=False)[a]["replaygain_track_gain"] == -6.0
+    assert cached.compute_gain([copy], album=False)[copy]["replaygain_track_peak"] == 0.5
+    assert len(backend.calls) == 1
+    # Other audio is a miss
+    cached.compute_gain([other], album=False)
+    assert backend.calls[-1][0] == [other]
+    # An album is cached as a whole, even if all of its tracks are
+    rginfo = cached.compute_gain([a, other], album=True)
+    assert len(backend.calls) == 3
+    assert rginfo[a]["replaygain_album_gain"] == -7.0
+    assert cached.compute_gain([copy, other], album=True)[other]["replaygain_album_peak"] == 0.75
+    assert len(backend.calls) == 3
+
+def test_true_peak_invalidates_cached_values(tmpdir) -> None:
+    (cached, backend) = make_cache(tmpdir)
+    fnames = [ str(tmpdir.join('{}.wav'.format(i))) for i in range(2) ]
+    for (i, fname) in enumerate(fnames):
+        write_wav(fname, bytes([i]) * 400)
+    cached.compute_gain(fnames, album=True)
+    assert len(backend.calls) == 1
+    # Cached without true peak, so of no use when it is wanted
+    rginfo = cached.compute_gain(fnames, album=True, true_peak=True)
+    assert backend.calls[-1] == (fnames, True, True)
+    assert rginfo[fnames[0]]["replaygain_track_true_peak"] == 0.6
+    # Now cached with true peak, which is also fine without
+    rginfo = cached.compute_gain(fnames, album=True, true_peak=True)
+    assert rginfo[fnames[1]]["replaygain_album_true_peak"] == 0.8
+    cached.compute_gain(fnames, album=True)
+    assert len(backend.calls) == 2
+
+def test_fingerprints_follow_file_changes(tmpdir) -> None:
+    (cached, backend) = make_cache(tmpdir)
+    fname = str(tmpdir.join('a.wav'))
+    write_wav(fname, bytes(400))
+    cached.compute_gain([fname], album=False)
+    # Replaced by other audio: the remembered fingerprint is not reused
+    write_wav(fname, bytes(range(200)) * 2)
+    st = os.stat(fname)
+    os.utime(fname, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    cached.compute_gain([fname], album=False)
+    assert len(backend.calls) == 2
+    shutil.copy(fname, fname + '.copy.wav')
+    cached.compute_gain([fname + '.copy.wav'], album=False)
+    assert len(backend.calls) == 2
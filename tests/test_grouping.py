@@ -0,0 +1,50 @@
+'''Sorting and grouping files by directory (see rganalysis.grouping).'''
+
+import random
+
+from collections import namedtuple
+
+from rganalysis import grouping
+from rganalysis.grouping import group_by_directory, sort_by_directory
+
+Track = namedtuple('Track', ['directory', 'filename'])
+
+def candidates(seed: int = 0):
+    names = [ ('/music/{:02d}/{:02d}.mp3'.format(d, t), bool(t % 2)) for d in range(20) for t in range(10) ]
+    random.Random(seed).shuffle(names)
+    return names
+
+def test_sort_in_memory() -> None:
+    assert list(sort_by_directory(candidates())) == sorted(candidates())
+
+def test_sort_with_runs(monkeypatch) -> None:
+    runs = []
+    write_run = grouping._write_run
+    def counting_write_run(buffered):
+        runs.append(len(buffered))
+        return write_run(buffered)
+    monkeypatch.setattr(grouping, '_write_run', counting_write_run)
+    result = list(sort_by_directory(candidates(), max_files=15))
+    assert result == sorted(candidates())
+    # Names were written out whenever more than max_files were held
+    assert len(runs) == 12 and all(n == 16 for n in runs)
+
+def test_sort_keeps_directories_together() -> None:
+    # "/a/b" sorts between "/a/b-c" and "/a/b/c" as a name, but its
+    # files must not be mixed with those of either
+    names = [ ('/a/b/c/1.mp3', False), ('/a/b-c/1.mp3', False), ('/a/b/1.mp3', False), ('/a/b/2.mp3', False) ]
+    directories = [ name.rsplit('/', 1)[0] for (name, _) in sort_by_directory(names, max_files=1) ]
+    assert directories == [ '/a/b', '/a/b', '/a/b-c', '/a/b/c' ]
+
+def test_group_ordered() -> None:
+    tracks = [ Track('/a', '1'), Track('/a', '2'), Track('/b', '1'), Track('/a', '3') ]
+    groups = list(group_by_directory(iter(tracks), ordered=True))
+    # Consecutive tracks only, so "/a" comes twice
+    assert [ (d, [ t.filename for t in ts ]) for (d, ts) in groups ] == \
+        [ ('/a', ['1', '2']), ('/b', ['1']), ('/a', ['3']) ]
+
+def test_group_unordered() -> None:
+    tracks = [ Track('/b', '1'), Track('/a', '1'), Track('/b', '2'), Track('/a', '2') ]
+    groups = list(group_by_directory(tracks))
+    assert [ (d, [ t.filename for t in ts ]) for (d, ts) in groups ] == \
+        [ ('/a', ['1', '2']), ('/b', ['1', '2']) ]
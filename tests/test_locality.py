@@ -0,0 +1,45 @@
+'''Ordering track sets by disk position, and splitting them between workers.'''
+
+from collections import namedtuple
+
+from rganalysis import locality
+from rganalysis.locality import order_by_locality, split_evenly
+
+TrackSet = namedtuple('TrackSet', ['name', 'filenames'])
+
+def test_split_evenly_balances_weight() -> None:
+    items = list(range(10))
+    runs = split_evenly(items, 3, weight=lambda i: 1)
+    # Contiguous runs, in order, covering every item
+    assert [ i for run in runs for i in run ] == items
+    assert [ len(run) for run in runs ] == [4, 3, 3]
+
+def test_split_evenly_by_weight() -> None:
+    # One heavy item gets a run of its own
+    runs = split_evenly(['big', 'a', 'b', 'c'], 2, weight=lambda s: 30 if s == 'big' else 10)
+    assert runs == [['big'], ['a', 'b', 'c']]
+
+def test_split_evenly_few_items() -> None:
+    assert split_evenly([1, 2], 4, weight=lambda i: 1) == [[1], [2]]
+    assert split_evenly([], 4, weight=lambda i: 1) == []
+    assert split_evenly([1, 2, 3], 1, weight=lambda i: 1) == [[1, 2, 3]]
+
+def test_order_by_locality(monkeypatch) -> None:
+    positions = { 'a1': (1, 0, 300), 'a2': (1, 0, 50), 'b1': (1, 0, 100), 'c1': (0, 1, 900) }
+    def physical_position(fname):
+        if fname not in positions:
+            raise OSError("No such file")
+        return positions[fname]
+    monkeypatch.setattr(locality, 'physical_position', physical_position)
+    track_sets = [ TrackSet('missing1', ['x']), TrackSet('a', ['a1', 'a2']), TrackSet('b', ['b1']),
+                   TrackSet('missing2', []), TrackSet('c', ['c1']) ]
+    # Device first, then the lowest position of any file; track sets
+    # that cannot be examined come last, in their original order
+    assert [ ts.name for ts in order_by_locality(track_sets) ] == ['c', 'a', 'b', 'missing1', 'missing2']
+
+def test_physical_position_of_real_files(tmpdir) -> None:
+    fname = str(tmpdir.join('a'))
+    with open(fname, 'wb') as f:
+        f.write(bytes(4096))
+    key = locality.physical_position(fname)
+    assert len(key) == 3 and key[1] in (0, 1)
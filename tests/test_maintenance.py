@@ -0,0 +1,75 @@
+'''Bulk tag maintenance without analysis (see rganalysis.maintenance).'''
+
+import struct
+
+from mutagen import File
+from mutagen.id3 import ID3, RVA2, TALB, TXXX
+from mutagen.wave import WAVE
+
+from rganalysis.maintenance import FAILED, FIXED, NOT_MUSIC, STRIPPED, UNCHANGED, maintain, maintain_files
+
+def write_wav(fname: str, replaygain: bool = True) -> None:
+    fmt = struct.pack('<HHIIHH', 1, 2, 44100, 44100 * 4, 4, 16)
+    data = bytes(400)
+    body = b'WAVE' + b'fmt ' + struct.pack('<I', len(fmt)) + fmt + b'data' + struct.pack('<I', len(data)) + data
+    with open(fname, 'wb') as f:
+        f.write(b'RIFF' + struct.pack('<I', len(body)) + body)
+    track = WAVE(fname)
+    track.add_tags()
+    track.tags.add(TALB(encoding=3, text=['Album']))
+    if replaygain:
+        track.tags.add(TXXX(encoding=3, desc='replaygain_track_gain', text=['-6.00 dB']))
+        track.tags.add(TXXX(encoding=3, desc='replaygain_track_peak', text=['0.500000']))
+    track.save()
+
+def write_mp3(fname: str) -> None:
+    '''Write an MP3 file of silent frames with RVA2 frames only.'''
+    with open(fname, 'wb') as f:
+        # MPEG-1 layer III, 128 kbit/s, 44100 Hz
+        f.write((b'\xff\xfb\x90\x64' + bytes(413)) * 20)
+    tags = ID3()
+    tags.add(TALB(encoding=3, text=['Album']))
+    tags.add(RVA2(desc='track', channel=1, gain=-6.0, peak=0.5))
+    tags.save(fname)
+
+def test_fixup(tmpdir) -> None:
+    fname = str(tmpdir.join('a.mp3'))
+    write_mp3(fname)
+    assert list(maintain_files([fname], 'fixup')) == [ (fname, FIXED) ]
+    tags = ID3(fname)
+    assert tags['TXXX:replaygain_track_gain'].text[0].startswith('-6.00')
+    assert list(maintain_files([fname], 'fixup')) == [ (fname, UNCHANGED) ]
+
+def test_strip(tmpdir) -> None:
+    fname = str(tmpdir.join('a.wav'))
+    write_wav(fname)
+    assert list(maintain_files([fname], 'strip')) == [ (fname, STRIPPED) ]
+    tags = File(fname).tags
+    assert 'TALB' in tags
+    assert not any(k.startswith('TXXX:replaygain_') for k in tags.keys())
+    # Nothing is left to strip the second time
+    assert list(maintain_files([fname], 'strip')) == [ (fname, UNCHANGED) ]
+
+def test_strip_dry_run(tmpdir) -> None:
+    fname = str(tmpdir.join('a.wav'))
+    write_wav(fname)
+    with open(fname, 'rb') as f:
+        before = f.read()
+    assert list(maintain_files([fname], 'strip', dry_run=True)) == [ (fname, STRIPPED) ]
+    with open(fname, 'rb') as f:
+        assert f.read() == before
+
+def test_outcomes(tmpdir) -> None:
+    write_wav(str(tmpdir.join('tagged.wav')))
+    write_wav(str(tmpdir.join('untagged.wav')), replaygain=False)
+    tmpdir.join('notes.txt').write('not music')
+    counts = maintain([str(tmpdir)], 'strip')
+    assert counts == { STRIPPED: 1, UNCHANGED: 1, NOT_MUSIC: 1 }
+    write_mp3(str(tmpdir.join('rva2.mp3')))
+    # Only ID3 files with RVA2 frames are fixed
+    counts = maintain([str(tmpdir)], 'fixup', jobs=2)
+    assert counts == { FIXED: 1, UNCHANGED: 2, NOT_MUSIC: 1 }
+
+def test_failure(tmpdir) -> None:
+    fname = str(tmpdir.join('missing.wav'))
+    assert list(maintain_files([fname], 'strip')) == [ (fname, FAILED) ]
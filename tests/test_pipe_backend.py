@@ -0,0 +1,74 @@
+'''The pipe backend, with benchmarks/synthetic_decoder.py as the decoder.
+
+The synthetic decoder ignores the contents of the file and writes a
+tone whose level depends on the file name, so the gain and peak that
+the pipe backend measures are checked against those of the native
+backend for a WAV file of the same samples, with the decoders read
+by threads and by decoder processes (see rganalysis.transport).
+
+'''
+
+import json
+import os
+import subprocess
+import sys
+import wave
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('scipy')
+
+from rganalysis.backends import GainComputer, get_backend
+
+DECODER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                       'benchmarks', 'synthetic_decoder.py')
+DECODER_ARGS = [ '--seconds', '2', '--rate', '{rate}', '--channels', '{channels}' ]
+
+def write_wav(fname: str, data: bytes = bytes(4)) -> None:
+    with wave.open(fname, 'wb') as w:
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(44100)
+        w.writeframes(data)
+
+def pipe_backend(tmpdir, monkeypatch, command, decode_jobs=None) -> GainComputer:
+    config = str(tmpdir.join('decoders.json'))
+    with open(config, 'w') as f:
+        json.dump({ "*": { "command": command, "format": "s16le" } }, f)
+    monkeypatch.setenv('RGANALYSIS_DECODERS', config)
+    from rganalysis.backends.pipe import PipeGainComputer, load_decoders
+    return PipeGainComputer(load_decoders(), jobs=2, decode_jobs=decode_jobs)
+
+@pytest.mark.parametrize('decode_jobs', [ None, 1, 2 ])
+def test_gain_matches_native(tmpdir, monkeypatch, decode_jobs) -> None:
+    backend = pipe_backend(tmpdir, monkeypatch, [ sys.executable, DECODER ] + DECODER_ARGS + [ '{file}' ], decode_jobs)
+    fnames = [ str(tmpdir.join('{}.wav'.format(i))) for i in range(3) ]
+    # What the decoder writes for each file, as WAV files for the native backend
+    expected = []
+    for fname in fnames:
+        write_wav(fname)
+        decoded = subprocess.run([ sys.executable, DECODER, '--seconds', '2', '--rate', '44100', '--channels', '2', fname ],
+                                 stdout=subprocess.PIPE, check=True).stdout
+        expected.append(fname + '.decoded.wav')
+        write_wav(expected[-1], decoded)
+    rginfo = backend.compute_gain(fnames, album=True)
+    native = get_backend('native').compute_gain(expected, album=True)
+    for (fname, native_fname) in zip(fnames, expected):
+        for tag in ('replaygain_track_gain', 'replaygain_album_gain'):
+            assert rginfo[fname][tag] == pytest.approx(native[native_fname][tag], abs=0.01)
+        for tag in ('replaygain_track_peak', 'replaygain_album_peak'):
+            assert rginfo[fname][tag] == pytest.approx(native[native_fname][tag], abs=1e-4)
+    # The tone's level depends on the file name
+    assert abs(rginfo[fnames[0]]['replaygain_track_gain'] - rginfo[fnames[1]]['replaygain_track_gain']) > 0.1
+
+@pytest.mark.parametrize('decode_jobs', [ None, 2 ])
+def test_decoder_failure(tmpdir, monkeypatch, decode_jobs) -> None:
+    backend = pipe_backend(tmpdir, monkeypatch, [ sys.executable, '-c', 'import sys; sys.stderr.write("broken"); sys.exit(3)' ],
+                           decode_jobs)
+    fname = str(tmpdir.join('0.wav'))
+    write_wav(fname)
+    with pytest.raises(subprocess.CalledProcessError) as excinfo:
+        backend.compute_gain([fname])
+    assert excinfo.value.returncode == 3
+    assert b'broken' in excinfo.value.stderr
@@ -0,0 +1,91 @@
+'''Classification of track sets by the state of their tags (see rganalysis.status).'''
+
+import io
+import json
+import os
+import struct
+
+from mutagen.id3 import ID3, RVA2, TALB
+from mutagen.wave import WAVE
+
+from rganalysis import RGTrack
+from rganalysis.status import (INCONSISTENT, OK, PROVISIONAL, RVA2_ONLY, UNTAGGED,
+                               directory_status, library_status, write_status)
+
+def write_wav(fname: str) -> None:
+    fmt = struct.pack('<HHIIHH', 1, 2, 44100, 44100 * 4, 4, 16)
+    data = bytes(400)
+    body = b'WAVE' + b'fmt ' + struct.pack('<I', len(fmt)) + fmt + b'data' + struct.pack('<I', len(data)) + data
+    with open(fname, 'wb') as f:
+        f.write(b'RIFF' + struct.pack('<I', len(body)) + body)
+    track = WAVE(fname)
+    track.add_tags()
+    track.tags.add(TALB(encoding=3, text=['Album']))
+    track.save()
+
+def write_album(directory: str, track_tags: bool = True, album_tags: bool = True,
+                gain_error: bool = False) -> None:
+    os.makedirs(directory)
+    for i in range(2):
+        fname = os.path.join(directory, '{}.wav'.format(i))
+        write_wav(fname)
+        track = RGTrack(fname)
+        if track_tags:
+            (track.gain, track.peak) = (-6.0 - i, 0.5)
+        if album_tags:
+            (track.album_gain, track.album_peak) = (-6.5, 0.5)
+        if gain_error:
+            (track.gain_error, track.album_gain_error) = (0.5, 0.3)
+        track.track.save()
+
+def album_status(directory: str, gain_type: str = 'auto') -> str:
+    statuses = directory_status(gain_type, (directory, sorted(os.path.join(directory, f) for f in os.listdir(directory))))
+    assert len(statuses) == 1
+    return statuses[0].status
+
+def test_ok(tmpdir) -> None:
+    write_album(str(tmpdir.join('ok')))
+    assert album_status(str(tmpdir.join('ok'))) == OK
+
+def test_untagged(tmpdir) -> None:
+    write_album(str(tmpdir.join('untagged')), track_tags=False, album_tags=False)
+    assert album_status(str(tmpdir.join('untagged'))) == UNTAGGED
+
+def test_inconsistent(tmpdir) -> None:
+    directory = str(tmpdir.join('no album gain'))
+    write_album(directory, album_tags=False)
+    assert album_status(directory) == INCONSISTENT
+    # Unless only track gain is wanted
+    assert album_status(directory, 'track') == OK
+    # Album tags where none are wanted
+    directory = str(tmpdir.join('unwanted album gain'))
+    write_album(directory)
+    assert album_status(directory, 'track') == INCONSISTENT
+
+def test_provisional(tmpdir) -> None:
+    directory = str(tmpdir.join('estimated'))
+    write_album(directory, gain_error=True)
+    assert album_status(directory) == PROVISIONAL
+
+def test_rva2_only(tmpdir) -> None:
+    fname = str(tmpdir.join('a.mp3'))
+    with open(fname, 'wb') as f:
+        # MPEG-1 layer III, 128 kbit/s, 44100 Hz
+        f.write((b'\xff\xfb\x90\x64' + bytes(413)) * 20)
+    tags = ID3()
+    tags.add(TALB(encoding=3, text=['Album']))
+    tags.add(RVA2(desc='track', channel=1, gain=-6.0, peak=0.5))
+    tags.save(fname)
+    assert album_status(str(tmpdir)) == RVA2_ONLY
+
+def test_library_status(tmpdir) -> None:
+    write_album(str(tmpdir.join('a')))
+    write_album(str(tmpdir.join('b')), track_tags=False, album_tags=False)
+    statuses = sorted(library_status([str(tmpdir)]), key=lambda s: s.directory)
+    assert [ (os.path.basename(s.directory), s.status, s.gain_type) for s in statuses ] == \
+        [ ('a', OK, 'album'), ('b', UNTAGGED, 'album') ]
+    out = io.StringIO()
+    write_status(statuses, out)
+    records = [ json.loads(line) for line in out.getvalue().splitlines() ]
+    assert [ r["status"] for r in records ] == [ OK, UNTAGGED ]
+    assert len(records[0]["filenames"]) == 2
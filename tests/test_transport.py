@@ -0,0 +1,92 @@
+'''Passing decoded audio from decoder processes through shared memory.'''
+
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from rganalysis.transport import PCMRing, END_OF_FILE, decode_in_processes
+
+def synthetic_blocks(fname: str):
+    '''Blocks of several sizes, whose samples encode the file and position.'''
+    n = int(os.path.basename(fname))
+    pos = 0
+    for frames in (1000, 5000, 1, 0, 3000 + 100 * n):
+        yield (44100 + n, expected_samples(n, pos, frames))
+        pos += frames
+
+def expected_samples(n: int, start: int, frames: int):
+    t = np.arange(start, start + frames, dtype=np.float32)
+    return np.stack([ t, -t - n ], axis=1)
+
+def failing_decode(fname: str):
+    yield (44100, np.zeros((10, 2), dtype=np.float32))
+    if fname == 'bad':
+        raise ValueError("cannot decode " + fname)
+    yield (44100, np.zeros((10, 2), dtype=np.float32))
+
+def dying_decode(fname: str):
+    yield (44100, np.zeros((10, 2), dtype=np.float32))
+    os._exit(7)
+
+class Unpicklable(Exception):
+    def __reduce__(self):
+        raise TypeError("not picklable")
+
+def unpicklable_decode(fname: str):
+    raise Unpicklable()
+    yield
+
+def test_ring_in_one_process() -> None:
+    ring = PCMRing(slot_samples=100, slots=4)
+    try:
+        samples = expected_samples(0, 0, 120)
+        # 50 stereo frames per slot
+        ring.put(samples, 48000)
+        ring.mark(END_OF_FILE, 5)
+        received = []
+        for _ in range(3):
+            (frames, rate, view) = ring.get(timeout=0)
+            assert rate == 48000 and view.shape == (frames, 2)
+            received.append(view.copy())
+            ring.release()
+        assert ring.get(timeout=0) == (END_OF_FILE, 5, None)
+        assert ring.get(timeout=0) is None
+        assert np.array_equal(np.concatenate(received), samples)
+    finally:
+        ring.unlink()
+
+@pytest.mark.parametrize('processes', [ 1, 3, 10 ])
+def test_decode_in_processes(processes) -> None:
+    fnames = [ str(n) for n in range(6) ]
+    received = { f: [] for f in fnames }
+    ended = []
+    rates = {}
+    # Small slots, so that files take many slots and the rings fill up
+    for (fname, block) in decode_in_processes(fnames, synthetic_blocks, processes, slot_samples=1024, slots=2):
+        assert fname not in ended
+        if block is None:
+            ended.append(fname)
+        else:
+            rates[fname] = block[0]
+            received[fname].append(block[1].copy())
+    assert sorted(ended) == fnames
+    for (n, fname) in enumerate(fnames):
+        assert rates[fname] == 44100 + n
+        samples = np.concatenate(received[fname])
+        assert np.array_equal(samples, expected_samples(n, 0, len(samples)))
+        assert len(samples) == 9001 + 100 * n
+
+def test_decoder_exception() -> None:
+    with pytest.raises(ValueError, match="cannot decode bad"):
+        for _ in decode_in_processes(['good', 'bad', 'good'], failing_decode, 2):
+            pass
+
+def test_unpicklable_exception() -> None:
+    with pytest.raises(RuntimeError, match="Unpicklable"):
+        list(decode_in_processes(['a'], unpicklable_decode, 1))
+
+def test_decoder_death() -> None:
+    with pytest.raises(RuntimeError, match="exited with code 7"):
+        list(decode_in_processes(['a', 'b'], dying_decode, 1))
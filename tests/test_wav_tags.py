@@ -0,0 +1,102 @@
+'''End-to-end tagging of WAV and AIFF files with the native backend.
+
+mutagen gives WAV and AIFF files raw ID3 tags, even with easy=True,
+so these check that the ReplayGain values are written to, and read
+back from, TXXX frames (see rganalysis.easyiff).
+
+'''
+
+import os
+import wave
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('scipy')
+
+from mutagen import File
+from mutagen.aiff import AIFF
+from mutagen.id3 import TALB
+from mutagen.wave import WAVE
+
+from rganalysis import RGTrack, RGTrackDryRun, RGTrackSet
+from rganalysis.backends import get_backend
+
+def write_wav(fname: str, scale: float, album: str = 'Album') -> None:
+    rng = np.random.default_rng(0)
+    samples = (scale * rng.standard_normal((44100 * 2, 2)) * 32767).astype('<i2')
+    with wave.open(fname, 'wb') as w:
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(44100)
+        w.writeframes(samples.tobytes())
+    track = WAVE(fname)
+    track.add_tags()
+    track.tags.add(TALB(encoding=3, text=[album]))
+    track.save()
+
+def make_track_set(fnames, track_class=RGTrack) -> RGTrackSet:
+    return RGTrackSet([ track_class(f) for f in fnames ], gain_backend=get_backend('native'))
+
+def test_do_gain_writes_txxx_frames(tmpdir) -> None:
+    fnames = [ str(tmpdir.join('{}.wav'.format(i))) for i in range(2) ]
+    for (i, fname) in enumerate(fnames):
+        write_wav(fname, 0.1 * (i + 1))
+    make_track_set(fnames).do_gain(force=True, gain_type='album')
+    for fname in fnames:
+        tags = File(fname).tags
+        assert 'TALB' in tags
+        for tag in ('track_gain', 'track_peak', 'album_gain', 'album_peak'):
+            assert 'TXXX:replaygain_' + tag in tags
+        track = RGTrack(fname)
+        assert track.gain is not None and track.album_gain is not None
+    # Read back, the tags are valid, so nothing is analyzed again
+    assert make_track_set(fnames).has_valid_rgdata()
+
+def test_dry_run_leaves_file_unchanged(tmpdir) -> None:
+    fname = str(tmpdir.join('0.wav'))
+    write_wav(fname, 0.1)
+    with open(fname, 'rb') as f:
+        before = f.read()
+    track_set = make_track_set([fname], RGTrackDryRun)
+    track_set.do_gain(force=True, gain_type='track')
+    assert track_set.RGTracks[fname].gain is not None
+    with open(fname, 'rb') as f:
+        assert f.read() == before
+
+def test_aiff_tags(tmpdir) -> None:
+    fname = str(tmpdir.join('0.aiff'))
+    with open(fname, 'wb') as f:
+        # A minimal AIFF file: a COMM chunk and an empty SSND chunk
+        comm = b'COMM' + (18).to_bytes(4, 'big') + (2).to_bytes(2, 'big') + (0).to_bytes(4, 'big') \
+               + (16).to_bytes(2, 'big') + bytes.fromhex('400EAC44000000000000')
+        ssnd = b'SSND' + (8).to_bytes(4, 'big') + bytes(8)
+        body = b'AIFF' + comm + ssnd
+        f.write(b'FORM' + len(body).to_bytes(4, 'big') + body)
+    track = AIFF(fname)
+    track.add_tags()
+    track.save()
+    rg_track = RGTrack(fname)
+    rg_track.gain = -6.5
+    rg_track.peak = 0.5
+    rg_track.track.save()
+    assert 'TXXX:replaygain_track_gain' in File(fname).tags
+    assert RGTrack(fname).gain == -6.5
+
+def test_estimates_are_replaced_by_full_analysis(tmpdir) -> None:
+    from rganalysis.backends.estimate import EstimateGainComputer
+    fnames = [ str(tmpdir.join('{}.wav'.format(i))) for i in range(2) ]
+    for (i, fname) in enumerate(fnames):
+        write_wav(fname, 0.1 * (i + 1))
+    estimate = RGTrackSet([ RGTrack(f) for f in fnames ], gain_backend=EstimateGainComputer(0.5, 1.0))
+    estimate.do_gain(gain_type='album')
+    assert all(RGTrack(f).is_provisional() for f in fnames)
+    assert 'TXXX:replaygain_album_gain_error' in File(fnames[0]).tags
+    # Without a gain cache, the tags alone show that the values are estimates
+    track_set = make_track_set(fnames)
+    assert track_set.has_provisional_tags()
+    track_set.do_gain(gain_type='album')
+    for fname in fnames:
+        assert not RGTrack(fname).is_provisional()
+        assert 'TXXX:replaygain_track_gain_error' not in File(fname).tags
+    assert not make_track_set(fnames).has_provisional_tags()